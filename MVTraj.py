@@ -1,28 +1,32 @@
+import math
 import joblib
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 from torch_geometric.utils import dropout_adj
 from torch_geometric.nn import GATConv
 from basemodel import BaseModel
+from utils import autocast, inference_mode
 import torch.nn.utils.rnn as rnn_utils
 
 class MVTraj(BaseModel):
-    def __init__(self, vocab_size, grid_vocab_size, route_max_len, road_feat_num, road_embed_size, gps_feat_num, gps_embed_size, route_embed_size, hidden_size, edge_index, drop_edge_rate, drop_route_rate, drop_road_rate, mode='p'):
+    def __init__(self, vocab_size, grid_vocab_size, route_max_len, road_feat_num, road_embed_size, gps_feat_num, gps_embed_size, route_embed_size, hidden_size, edge_index, drop_edge_rate, drop_route_rate, drop_road_rate, mode='p', mlm_num_sampled=0, queue_size=2048):
         super(MVTraj, self).__init__()
 
         self.vocab_size = vocab_size # 路段数量
         self.grid_vocab_size = grid_vocab_size # grid数量
-        self.edge_index = torch.tensor(edge_index).cuda()
+        # 不需要保存在 state_dict 中的常量用 buffer 保存，随 model.to(device) 移动
+        self.register_buffer('edge_index', torch.as_tensor(edge_index, dtype=torch.long), persistent=False)
         self.mode = mode
         self.drop_edge_rate = drop_edge_rate
 
         # node embedding
-        self.route_padding_vec = torch.zeros(1, road_embed_size, requires_grad=True).cuda()
+        self.register_buffer('route_padding_vec', torch.zeros(1, road_embed_size), persistent=False)
         self.node_embedding = nn.Embedding(vocab_size, road_embed_size)
         self.node_embedding.requires_grad_(True)
 
         # grid embedding
-        self.grid_padding_vec = torch.zeros(1, road_embed_size, requires_grad=True).cuda()
+        self.register_buffer('grid_padding_vec', torch.zeros(1, road_embed_size), persistent=False)
         self.grid_embedding = nn.Embedding(grid_vocab_size, road_embed_size)
         self.grid_embedding.requires_grad_(True)
 
@@ -72,56 +76,165 @@ class MVTraj(BaseModel):
         self.modal_embedding_four_module = nn.Embedding(4, hidden_size)
         self.fc4 = nn.Linear(hidden_size, hidden_size) # shared transformer position transform
 
-        # mlm classifier head
-        self.gps_mlm_head = nn.Linear(hidden_size, vocab_size)
-        self.route_mlm_head = nn.Linear(hidden_size, vocab_size)
+        # mlm classifier head，mlm_num_sampled > 0 时训练使用 sampled softmax，路网很大时节省显存
+        self.gps_mlm_head = MLMHead(hidden_size, vocab_size, mlm_num_sampled)
+        self.route_mlm_head = MLMHead(hidden_size, vocab_size, mlm_num_sampled)
 
-        self.gps_grid_mlm_head = nn.Linear(hidden_size, grid_vocab_size)
-        self.grid_mlm_head = nn.Linear(hidden_size, grid_vocab_size)
+        self.gps_grid_mlm_head = MLMHead(hidden_size, grid_vocab_size, mlm_num_sampled)
+        self.grid_mlm_head = MLMHead(hidden_size, grid_vocab_size, mlm_num_sampled)
 
         # matching
         self.matching_predictor = nn.Linear(hidden_size*2, 2)
-        self.register_buffer("gps_queue", torch.randn(hidden_size, 2048))
-        self.register_buffer("route_queue", torch.randn(hidden_size, 2048))
-
-        self.image_queue = nn.functional.normalize(self.gps_queue, dim=0)
-        self.text_queue = nn.functional.normalize(self.route_queue, dim=0)
+        # matching 负样本队列 (ring buffer)，四个视图各一个 (hidden_size, queue_size)，保存之前 batch 投影并 normalize 后的轨迹表示
+        # queue_ptr 为下一个写入的位置（最旧的表示），queue_num 为已写入的数量
+        self.queue_size = queue_size
+        for view in QUEUE_VIEWS:
+            self.register_buffer('{}_queue'.format(view), F.normalize(torch.randn(hidden_size, queue_size), dim=0))
+        self.register_buffer('queue_ptr', torch.zeros(1, dtype=torch.long))
+        self.register_buffer('queue_num', torch.zeros(1, dtype=torch.long))
 
         self.add_cross = True
-        self.cross_attn_route_to_gps = CrossAttention(hidden_size, 8).cuda()
-        self.cross_attn_route_to_grid = CrossAttention(hidden_size, 8).cuda()
-        self.cross_attn_route_to_gps_g = CrossAttention(hidden_size, 8).cuda()
-        # self.cross_attn_route_to_route = CrossAttention(hidden_size, 8).cuda()
-
-        self.cross_attn_gps_to_route = CrossAttention(hidden_size, 8).cuda()
-        self.cross_attn_gps_to_grid = CrossAttention(hidden_size, 8).cuda()
-        self.cross_attn_gps_to_gps_g = CrossAttention(hidden_size, 8).cuda()
-        # self.cross_attn_gps_to_gps = CrossAttention(hidden_size, 8).cuda()
-
-        self.cross_attn_grid_to_route = CrossAttention(hidden_size, 8).cuda()
-        self.cross_attn_grid_to_gps = CrossAttention(hidden_size, 8).cuda()
-        self.cross_attn_grid_to_gps_g = CrossAttention(hidden_size, 8).cuda()
-        # self.cross_attn_grid_to_grid = CrossAttention(hidden_size, 8).cuda()
-
-        self.cross_attn_gps_g_to_route = CrossAttention(hidden_size, 8).cuda()
-        self.cross_attn_gps_g_to_gps = CrossAttention(hidden_size, 8).cuda()
-        self.cross_attn_gps_g_to_grid = CrossAttention(hidden_size, 8).cuda()
-        # self.cross_attn_gps_g_to_gps_g = CrossAttention(hidden_size, 8).cuda()
-
-
+        # 4 个视图两两之间的 cross attention (route/gps/grid/gps_g 各自作为 query)，融合为一个模块
+        self.multi_view_attn = MultiViewCrossAttention(hidden_size, 8, len(CROSS_VIEWS))
+        # eval 时 GAT 输出的路段表示缓存，(参数版本, node_enc)
+        self._node_enc_cache = None
+
+    def __getstate__(self):
+        # torch.save 整个模型时不保存缓存
+        state = self.__dict__.copy()
+        state['_node_enc_cache'] = None
+        return state
+
+    def __setstate__(self, state):
+        # 兼容 torch.save 保存的旧模型对象：12 个 cross_attn_{query}_to_{key} 转换为 multi_view_attn
+        super(MVTraj, self).__setstate__(state)
+        self.__dict__.setdefault('_node_enc_cache', None)
+        # 旧模型的 edge_index 和 padding vec 是直接 .cuda() 的 tensor 属性，转为 buffer 才能随 model.to(device) 移动
+        for name in ['edge_index', 'route_padding_vec', 'grid_padding_vec']:
+            if name in self.__dict__:
+                self.register_buffer(name, self.__dict__.pop(name).detach(), persistent=False)
+        if 'multi_view_attn' not in self._modules and 'cross_attn_route_to_gps' in self._modules:
+            modules = self._modules
+            attentions = {name: modules.pop(name).attention for name in list(modules.keys()) if name.startswith('cross_attn_')}
+            self.multi_view_attn = MultiViewCrossAttention.from_cross_attention(attentions)
+        # 旧模型的 mlm head 为 nn.Linear
+        for name in ['gps_mlm_head', 'route_mlm_head', 'gps_grid_mlm_head', 'grid_mlm_head']:
+            if not isinstance(self._modules[name], MLMHead):
+                setattr(self, name, MLMHead.from_linear(self._modules[name]))
+
+        # 旧模型只有未使用的 gps_queue / route_queue
+        if 'queue_ptr' not in self._buffers:
+            self.queue_size = self.gps_queue.shape[1]
+            for view in QUEUE_VIEWS:
+                self.register_buffer('{}_queue'.format(view), F.normalize(torch.randn_like(self.gps_queue), dim=0))
+            self.register_buffer('queue_ptr', torch.zeros(1, dtype=torch.long, device=self.gps_queue.device))
+            self.register_buffer('queue_num', torch.zeros(1, dtype=torch.long, device=self.gps_queue.device))
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # 兼容旧 checkpoint 的 state_dict
+        convert_cross_attention_state_dict(state_dict, prefix)
+        if prefix + 'queue_num' not in state_dict:
+            # 旧 checkpoint 中的队列从未写入过，保留当前的空队列
+            for name in ['{}_queue'.format(view) for view in QUEUE_VIEWS] + ['queue_ptr', 'queue_num']:
+                state_dict[prefix + name] = getattr(self, name)
+        super(MVTraj, self)._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    def project_traj(self, gps_traj_rep, route_traj_rep, gps_traj_grid_rep, grid_traj_rep):
+        # project rep into the same space，用于 matching loss 和负样本队列
+        return self.gps_proj_head(gps_traj_rep), self.route_proj_head(route_traj_rep), \
+               self.gps_proj_grid_head(gps_traj_grid_rep), self.grid_proj_head(grid_traj_rep)
+
+    @torch.no_grad()
+    def enqueue(self, gps_traj_rep, route_traj_rep, gps_traj_grid_rep, grid_traj_rep):
+        # 投影后的轨迹表示 (batch_size, hidden_size) 写入队列，覆盖最旧的表示
+        if self.queue_size == 0:
+            return
+        reps = [rep[-self.queue_size:] for rep in [gps_traj_rep, route_traj_rep, gps_traj_grid_rep, grid_traj_rep]]
+        batch_size = reps[0].shape[0]
+        index = (self.queue_ptr + torch.arange(batch_size, device=self.queue_ptr.device)) % self.queue_size
+        for view, rep in zip(QUEUE_VIEWS, reps):
+            queue = getattr(self, '{}_queue'.format(view))
+            queue[:, index] = F.normalize(rep.detach().float(), dim=1).t().to(queue) # 混合精度下 rep 可能为 fp16
+        self.queue_ptr.copy_((self.queue_ptr + batch_size) % self.queue_size)
+        self.queue_num.add_(batch_size).clamp_(max=self.queue_size)
+
+    def queued(self, view):
+        # 队列中已写入的表示 (queue_num, hidden_size)
+        return getattr(self, '{}_queue'.format(view))[:, :int(self.queue_num)].t()
+
+    @torch.no_grad()
+    def momentum_update(self, model, momentum):
+        # 作为 momentum encoder 时，参数为 model 参数的滑动平均
+        for param_m, param in zip(self.parameters(), model.parameters()):
+            param_m.mul_(momentum).add_(param.detach(), alpha=1 - momentum)
+
+    def train(self, mode=True):
+        # 切换 train/eval 时丢弃缓存的路段表示
+        self._node_enc_cache = None
+        return super(MVTraj, self).train(mode)
 
     def encode_graph(self, drop_rate=0.):
         node_emb = self.node_embedding.weight
-        edge_index = dropout_adj(self.edge_index, p=drop_rate)[0]
+        edge_index = dropout_adj(self.edge_index, p=drop_rate, training=self.training)[0] # eval 时不 drop edge
         node_enc = self.graph_encoder(node_emb, edge_index)
         return node_enc
 
+    def _graph_version(self):
+        # 参数被替换或 .to(device) 后 data_ptr 改变，optimizer.step / load_state_dict 等原地修改后 _version 改变
+        params = [self.node_embedding.weight] + list(self.graph_encoder.parameters())
+        return tuple((param.data_ptr(), param._version) for param in params) + (torch.is_autocast_enabled(),)
+
+    def node_encoding(self):
+        # mode='x' 时的路段表示 (vocab_size, route_embed_size)
+        # 训练或需要梯度时每次重新计算；eval 且不需要梯度时按参数版本缓存，不同 batch 之间复用，不必每个 batch 都跑一遍整个路网的 GAT
+        if self.training or torch.is_grad_enabled():
+            return self.encode_graph(self.drop_edge_rate)
+        version = self._graph_version()
+        if self._node_enc_cache is None or self._node_enc_cache[0] != version:
+            self._node_enc_cache = (version, self.encode_graph(self.drop_edge_rate))
+        return self._node_enc_cache[1]
+
+    def neutral_time_emb(self):
+        # 无时间特征输入时的时间表示：星期、分钟取各自表示的平均（不含 mask 位），时间间隔取各个 bin 表示的平均
+        week_emb = self.week_embedding.weight.detach()[1:].mean(dim=0)
+        min_emb = self.minute_embedding.weight.detach()[1:].mean(dim=0)
+        delta_emb = self.delta_embedding.emb.weight.detach().mean(dim=0)
+        return week_emb, min_emb, delta_emb
+
+    def encode_single(self, ids=None, view='route', batch_size=4096):
+        """
+        批量编码单个路段/栅格：每个 id 作为长度为1的序列输入 route / grid 编码器，时间特征使用 neutral_time_emb，
+        grid 不加区域特征；在 inference_mode 下运行，调用前需要 eval()
+
+        Args:
+            ids: view='route' 时为路段 id，view='grid' 时为栅格 id；None 时编码整个词表
+            batch_size: 每次输入编码器的 id 数量
+
+        Returns:
+            (num_ids, hidden_size)，第 i 行为 ids[i] 的表示
+        """
+        assert view in ['route', 'grid'], 'view must be one of [\'route\', \'grid\']'
+        embedding = self.node_embedding if view == 'route' else self.grid_embedding
+        encode = self.encode_route if view == 'route' else self.encode_grid
+        device = embedding.weight.device
+        if ids is None:
+            ids = torch.arange(embedding.num_embeddings, device=device)
+        ids = torch.as_tensor(ids, device=device).long().view(-1)
+
+        with inference_mode():
+            reps = [embedding.weight.new_zeros(0, self.fc1.out_features)]
+            for start in range(0, ids.shape[0], batch_size):
+                assign_mat = ids[start:start + batch_size].unsqueeze(1) # (batch_size, 1)
+                unpooled, _ = encode(None, assign_mat, assign_mat)
+                reps.append(unpooled[:, 0])
+            return torch.cat(reps, dim=0)
+
     def encode_route(self, route_data, route_assign_mat, masked_route_assign_mat):
         # 返回路段表示和轨迹的表示
         if self.mode == 'p':
             lookup_table = torch.cat([self.node_embedding.weight, self.route_padding_vec], 0)
         else:
-            node_enc = self.encode_graph(self.drop_edge_rate)
+            node_enc = self.node_encoding()
             lookup_table = torch.cat([node_enc, self.route_padding_vec], 0)
 
         # 先对原始序列进行mask，然后再进行序列建模，防止信息泄露
@@ -135,10 +248,7 @@ class MVTraj(BaseModel):
 
         # time embedding
         if route_data is None: # node evaluation的时候使用
-            # 取时间表示的平均作为无时间特征输入时的表示
-            week_emb = self.week_embedding.weight.detach()[1:].mean(dim=0)
-            min_emb = self.minute_embedding.weight.detach()[1:].mean(dim=0)
-            delta_emb = self.minute_embedding.weight.detach()[1:].mean(dim=0)
+            week_emb, min_emb, delta_emb = self.neutral_time_emb()
         else:
             week_data = route_data[:, :, 0].long()
             min_data = route_data[:, :, 1].long()
@@ -148,7 +258,7 @@ class MVTraj(BaseModel):
             delta_emb = self.delta_embedding(delta_data)
 
         # position embedding
-        position = torch.arange(route_emb.shape[1]).long().cuda()
+        position = torch.arange(route_emb.shape[1], device=route_emb.device)
         pos_emb = position.unsqueeze(0).repeat(route_emb.shape[0], 1)  # (S,) -> (B, S)
         pos_emb = self.position_embedding1(pos_emb)
 
@@ -156,7 +266,7 @@ class MVTraj(BaseModel):
         route_emb = route_emb + pos_emb + week_emb + min_emb + delta_emb
         route_emb = self.fc1(route_emb)
         route_enc = self.route_encoder(route_emb, None, src_key_padding_mask) # mask 被在这里处理，mask不参与计算attention
-        route_enc = torch.where(torch.isnan(route_enc), torch.full_like(route_enc, 0), route_enc) # 将nan变为0,防止溢出
+        route_enc = torch.nan_to_num(route_enc, nan=0.) # 将nan变为0,防止溢出；混合精度下溢出的 ±inf 截断为该 dtype 的最大值
 
         route_enc = route_enc.permute(1, 0, 2)  # 从 (47, 32, 256) 调整为 (32, 47, 256)
         route_unpooled = route_enc * pool_mask.repeat(1, 1, route_enc.shape[-1]) # (batch_size,max_len,feat_num)
@@ -183,10 +293,7 @@ class MVTraj(BaseModel):
 
         # time embedding
         if grid_data is None: # node evaluation的时候使用
-            # 取时间表示的平均作为无时间特征输入时的表示
-            week_emb = self.week_embedding.weight.detach()[1:].mean(dim=0)
-            min_emb = self.minute_embedding.weight.detach()[1:].mean(dim=0)
-            delta_emb = self.minute_embedding.weight.detach()[1:].mean(dim=0)
+            week_emb, min_emb, delta_emb = self.neutral_time_emb()
         else:
             week_data = grid_data[:, :, 0].long()
             min_data = grid_data[:, :, 1].long()
@@ -195,12 +302,15 @@ class MVTraj(BaseModel):
             min_emb = self.minute_embedding(min_data)
             delta_emb = self.delta_embedding(delta_data)
 
-        # regionn embedding
-        weights = grid_data[:, :, 3:16]
-        weighted_embeddings = torch.einsum('bmn,nd->bmd', weights, self.region_embedding)  # (batch_size, max_seq_len, embed_dim)
+        # regionn embedding，没有 grid 特征时不加
+        if grid_data is None:
+            weighted_embeddings = 0
+        else:
+            weights = grid_data[:, :, 3:16]
+            weighted_embeddings = torch.einsum('bmn,nd->bmd', weights, self.region_embedding)  # (batch_size, max_seq_len, embed_dim)
 
         # position embedding
-        position = torch.arange(grid_emb.shape[1]).long().cuda()
+        position = torch.arange(grid_emb.shape[1], device=grid_emb.device)
         pos_emb = position.unsqueeze(0).repeat(grid_emb.shape[0], 1)  # (S,) -> (B, S)
         pos_emb = self.position_embedding3(pos_emb)
 
@@ -208,7 +318,7 @@ class MVTraj(BaseModel):
         grid_emb = grid_emb + pos_emb + week_emb + min_emb + delta_emb + weighted_embeddings
         grid_emb = self.fc3(grid_emb)
         grid_enc = self.grid_encoder(grid_emb, None, src_key_padding_mask) # mask 被在这里处理，mask不参与计算attention
-        grid_enc = torch.where(torch.isnan(grid_enc), torch.full_like(grid_enc, 0), grid_enc) # 将nan变为0,防止溢出
+        grid_enc = torch.nan_to_num(grid_enc, nan=0.) # 将nan变为0,防止溢出；混合精度下溢出的 ±inf 截断为该 dtype 的最大值
 
         grid_enc = grid_enc.permute(1, 0, 2)  # 从 (47, 32, 256) 调整为 (32, 47, 256)
         grid_unpooled = grid_enc * pool_mask.repeat(1, 1, grid_enc.shape[-1]) # (batch_size,max_len,feat_num)
@@ -229,13 +339,12 @@ class MVTraj(BaseModel):
         masked_gps_data = gps_data * gps_mask_mat # (batch_size,gps_max_len,feat_num)
 
         # flatten gps data 便于进行路段内gru的并行
-        flattened_gps_data, route_length = self.gps_flatten(masked_gps_data, gps_length) # flattened_gps_data (road_num, max_pt_len ,gps_fea_size)
-        _, gps_emb = self.gps_intra_encoder(flattened_gps_data) # gps_emb (1, road_num, gps_embed_size) # 不输入hidden默认输入全0为序列的hidden state
-        gps_emb = gps_emb[-1] # 只保留前向的表示
+        flattened_gps_data, point_length, segment_index = self.gps_flatten(masked_gps_data, gps_length) # flattened_gps_data (road_num, max_pt_len ,gps_fea_size)
+        gps_emb = self.encode_segment(self.gps_intra_encoder, flattened_gps_data, point_length) # gps_emb (road_num, gps_embed_size)
         # gps_emb = torch.cat([gps_emb[0].squeeze(0), gps_emb[1].squeeze(0)],dim=-1) # 前后向表示拼接
 
         # stack gps emb 便于进行路段间gru的计算
-        stacked_gps_emb = self.route_stack(gps_emb, route_length) # stacked_gps_emb (batch_size, max_route_len, gps_embed_size)
+        stacked_gps_emb = self.route_stack(gps_emb, segment_index, gps_data.shape[0]) # stacked_gps_emb (batch_size, max_route_len, gps_embed_size)
         gps_emb, _ = self.gps_inter_encoder(stacked_gps_emb)  # (batch_size, max_route_len, 2*gps_embed_size) # 不输入hidden默认输入全0为序列的hidden state
 
         route_src_key_padding_mask = (masked_route_assign_mat == self.vocab_size).transpose(0, 1)
@@ -256,12 +365,11 @@ class MVTraj(BaseModel):
         masked_gps_data = gps_data * gps_mask_mat # (batch_size,gps_max_len,feat_num)
 
         # flatten gps data 便于进行路段内gru的并行
-        flattened_gps_data, route_length = self.gps_flatten(masked_gps_data, gps_length_grid) # flattened_gps_data (road_num, max_pt_len ,gps_fea_size)
-        _, gps_emb = self.gps_intra_encoder_grid(flattened_gps_data) # gps_emb (1, road_num, gps_embed_size) # 不输入hidden默认输入全0为序列的hidden state
-        gps_emb = gps_emb[-1] # 只保留前向的表示
+        flattened_gps_data, point_length, segment_index = self.gps_flatten(masked_gps_data, gps_length_grid) # flattened_gps_data (road_num, max_pt_len ,gps_fea_size)
+        gps_emb = self.encode_segment(self.gps_intra_encoder_grid, flattened_gps_data, point_length) # gps_emb (road_num, gps_embed_size)
 
         # stack gps emb 便于进行路段间gru的计算
-        stacked_gps_emb = self.route_stack(gps_emb, route_length) # stacked_gps_emb (batch_size, max_route_len, gps_embed_size)
+        stacked_gps_emb = self.route_stack(gps_emb, segment_index, gps_data.shape[0]) # stacked_gps_emb (batch_size, max_route_len, gps_embed_size)
         gps_emb, _ = self.gps_inter_encoder_grid(stacked_gps_emb)  # (batch_size, max_route_len, 2*gps_embed_size) # 不输入hidden默认输入全0为序列的hidden state
 
         route_src_key_padding_mask = (masked_grid_assign_mat == self.grid_vocab_size).transpose(0, 1)
@@ -272,45 +380,45 @@ class MVTraj(BaseModel):
 
         return gps_unpooled, gps_pooled
     
-    def route_stack(self, gps_emb, route_length):
-        # flatten_gps_data tensor = (real_len, max_gps_in_route_len, emb_size)
-        # route_length dict = { key:tid, value: road_len }
-        values = list(route_length.values())
-        route_max_len = max(values)
-        data_list = []
-        for idx in range(len(route_length)):
-            start_idx = sum(values[:idx])
-            end_idx = sum(values[:idx+1])
-            data = gps_emb[start_idx:end_idx]
-            data_list.append(data)
-
-        stacked_gps_emb = rnn_utils.pad_sequence(data_list, padding_value=0, batch_first=True)
+    def route_stack(self, gps_emb, segment_index, traj_num):
+        # gps_emb tensor = (road_num, emb_size)，按 (轨迹, 路段) 的顺序排列
+        # segment_index = (traj_idx, seg_idx)，每个路段在 (batch_size, max_route_len) 中的位置
+        traj_idx, seg_idx = segment_index
+        route_max_len = int(seg_idx.max()) + 1 if seg_idx.numel() > 0 else 0
+        stacked_gps_emb = gps_emb.new_zeros(traj_num, route_max_len, gps_emb.shape[-1])
+        stacked_gps_emb[traj_idx, seg_idx] = gps_emb
 
         return stacked_gps_emb
 
     def gps_flatten(self, gps_data, gps_length):
-        # 把gps_data按照gps_assign_mat做形变，把每个路段上的gps点单独拿出来，拼成一个新的tensor (road_num, gps_max_len, gps_feat_num)，
+        # 把gps_data按照gps_length做形变，把每个路段上的gps点单独拿出来，拼成一个新的tensor (road_num, max_pt_len, gps_feat_num)，
         # 该tensor用于输入GRU进行并行计算
+        # gps_length (batch_size, max_route_len) [7,9,12,1,0,0,0,0,0,0] # padding_value = 0
         traj_num, gps_max_len, gps_feat_num = gps_data.shape
-        flattened_gps_list = []
-        route_index = {}
-        for idx in range(traj_num):
-            gps_feat = gps_data[idx] # (max_len, feat_num)
-            length_list = gps_length[idx] # (max_len, 1) [7,9,12,1,0,0,0,0,0,0] # padding_value = 0
-            # 遍历每个轨迹中的路段
-            for _idx, length in enumerate(length_list):
-                if length != 0:
-                    start_idx = sum(length_list[:_idx])
-                    end_idx = start_idx + length_list[_idx]
-                    cnt = route_index.get(idx, 0)
-                    route_index[idx] = cnt+1
-                    road_feat = gps_feat[start_idx:end_idx]
-                    flattened_gps_list.append(road_feat)
-
-        flattened_gps_data = rnn_utils.pad_sequence(flattened_gps_list, padding_value=0, batch_first=True) # (road_num, gps_max_len, gps_feat_num)
-
-
-        return flattened_gps_data, route_index
+        gps_length = gps_length.long()
+
+        # 每个路段第一个gps点在轨迹中的位置 = 前面路段的gps点数之和
+        start_idx = torch.cumsum(gps_length, dim=1) - gps_length
+        seg_mask = gps_length > 0
+        point_length = gps_length[seg_mask] # (road_num,)
+        seg_start = start_idx[seg_mask]
+        traj_idx = torch.arange(traj_num, device=gps_data.device).unsqueeze(1).expand_as(gps_length)[seg_mask]
+        seg_idx = torch.cumsum(seg_mask.long(), dim=1)[seg_mask] - 1 # 路段在轨迹中是第几个非空路段
+
+        # 一次 gather 取出所有路段上的gps点，超出路段长度的位置置0
+        max_pt_len = int(point_length.max()) if point_length.numel() > 0 else 0
+        offset = torch.arange(max_pt_len, device=gps_data.device)
+        point_mask = offset.unsqueeze(0) < point_length.unsqueeze(1) # (road_num, max_pt_len)
+        point_idx = (seg_start.unsqueeze(1) + offset.unsqueeze(0)).clamp(max=gps_max_len - 1) + traj_idx.unsqueeze(1) * gps_max_len
+        flattened_gps_data = gps_data.reshape(traj_num * gps_max_len, gps_feat_num)[point_idx] * point_mask.unsqueeze(-1).to(gps_data.dtype)
+
+        return flattened_gps_data, point_length, (traj_idx, seg_idx)
+
+    def encode_segment(self, gru, flattened_gps_data, point_length):
+        # 按路段的真实gps点数 pack，反向的 GRU 从路段的最后一个gps点开始，不经过 padding
+        packed_gps_data = rnn_utils.pack_padded_sequence(flattened_gps_data, point_length.cpu(), batch_first=True, enforce_sorted=False)
+        _, gps_emb = gru(packed_gps_data) # gps_emb (2, road_num, gps_embed_size) # 不输入hidden默认输入全0为序列的hidden state
+        return gps_emb[-1] # 只保留反向的表示
 
     def encode_joint(self, route_road_rep, route_traj_rep, gps_road_rep, gps_traj_rep, route_assign_mat):
         max_len = torch.max((route_assign_mat!=self.vocab_size).int().sum(1)).item()
@@ -319,8 +427,8 @@ class MVTraj(BaseModel):
         mask_list = []
         route_length = [length[length!=self.vocab_size].shape[0] for length in route_assign_mat]
 
-        modal_emb0 = self.modal_embedding(torch.tensor(0).cuda())
-        modal_emb1 = self.modal_embedding(torch.tensor(1).cuda())
+        modal_emb0 = self.modal_embedding.weight[0]
+        modal_emb1 = self.modal_embedding.weight[1]
 
         for i, length in enumerate(route_length):
             route_road_token = route_road_rep[i][:length]
@@ -329,7 +437,7 @@ class MVTraj(BaseModel):
             gps_cls_token = gps_traj_rep[i].unsqueeze(0)
 
             # position
-            position = torch.arange(length+1).long().cuda()
+            position = torch.arange(length+1, device=route_road_rep.device)
             pos_emb = self.position_embedding2(position)
 
             # update route_emb
@@ -347,7 +455,7 @@ class MVTraj(BaseModel):
             data = torch.cat([gps_emb, route_emb], dim=0)
             data_list.append(data)
 
-            mask = torch.tensor([False] * data.shape[0]).cuda() # mask的位置为true
+            mask = torch.zeros(data.shape[0], dtype=torch.bool, device=data.device) # mask的位置为true
             mask_list.append(mask)
 
         joint_data = rnn_utils.pad_sequence(data_list, padding_value=0, batch_first=True)
@@ -366,259 +474,88 @@ class MVTraj(BaseModel):
 
         return gps_road_rep, gps_traj_rep, route_road_rep, route_traj_rep
     
-    def encode_joint_four_stream(self, route_road_rep, route_traj_rep, gps_road_rep, gps_traj_rep, route_assign_mat, \
-                                 grid_road_rep, grid_traj_rep, gps_grid_rep, gps_traj_grid_rep, grid_assign_mat):
-        
+    def fuse_stream(self, stream_emb, length, modal_idx, fc):
+        # stream_emb (batch_size, 1+max_len, hidden)，第0位为cls，只保留每条轨迹的前 length+1 个位置
+        stream_emb = stream_emb[:, :int(length.max()) + 1]
+        position = torch.arange(stream_emb.shape[1], device=stream_emb.device)
+        stream_emb = stream_emb + self.position_embedding2(position).unsqueeze(0) + self.modal_embedding_four_module.weight[modal_idx]
+        return fc(stream_emb)
+
+    def gather_tokens(self, joint_emb, start, length):
+        # 取出每条轨迹 joint_emb[i, start[i]:start[i]+length[i]]，padding 到 batch 内的最大长度，padding位为0
+        offset = torch.arange(int(length.max()), device=joint_emb.device)
+        valid = offset.unsqueeze(0) < length.unsqueeze(1) # (batch_size, max_len)
+        index = (start.unsqueeze(1) + offset.unsqueeze(0)).clamp(max=joint_emb.shape[1] - 1)
+        tokens = torch.gather(joint_emb, 1, index.unsqueeze(-1).expand(-1, -1, joint_emb.shape[-1]))
+        return tokens.masked_fill(~valid.unsqueeze(-1), 0)
 
-        max_len = torch.max((route_assign_mat!=self.vocab_size).int().sum(1)).item()
-        max_len = max_len*2+2
-        max_len_grid = torch.max((grid_assign_mat!=self.grid_vocab_size).int().sum(1)).item()
-        max_len_grid = max_len_grid*2+2
-        if not self.add_cross:
-            data_list = []
-            mask_list = []
-            data_list_grid = []
-            mask_list_grid = []
-            route_length = [length[length!=self.vocab_size].shape[0] for length in route_assign_mat]
-            grid_length = [length[length!=self.grid_vocab_size].shape[0] for length in grid_assign_mat]
-
-            modal_emb0 = self.modal_embedding_four_module(torch.tensor(0).cuda())
-            modal_emb1 = self.modal_embedding_four_module(torch.tensor(1).cuda())
-            modal_emb2 = self.modal_embedding_four_module(torch.tensor(2).cuda())
-            modal_emb3 = self.modal_embedding_four_module(torch.tensor(3).cuda())
-
-            for i, (length_r, length_g) in enumerate(zip(route_length, grid_length)):
-
-                route_road_token = route_road_rep[i][:length_r]
-                gps_road_token = gps_road_rep[i][:length_r]
-                route_cls_token = route_traj_rep[i].unsqueeze(0)
-                gps_cls_token = gps_traj_rep[i].unsqueeze(0)
-
-                grid_road_token = grid_road_rep[i][:length_g]
-                gps_grid_token = gps_grid_rep[i][:length_g]
-                grid_cls_token = grid_traj_rep[i].unsqueeze(0)
-                gps_cls_grid_token = gps_traj_grid_rep[i].unsqueeze(0)
-
-                # position
-                position_r = torch.arange(length_r+1).long().cuda()
-                pos_emb_r = self.position_embedding2(position_r)
-
-                position_g = torch.arange(length_g+1).long().cuda()
-                pos_emb_g = self.position_embedding2(position_g)
-
-                # update route_emb
-                route_emb = torch.cat([route_cls_token, route_road_token], dim=0)
-                modal_emb = modal_emb0.unsqueeze(0).repeat(length_r+1, 1)
-                route_emb = route_emb + pos_emb_r + modal_emb
-                route_emb = self.fc2(route_emb)
-
-                # update grid_emb
-                grid_emb = torch.cat([grid_cls_token, grid_road_token], dim=0)
-                modal_emb = modal_emb2.unsqueeze(0).repeat(length_g+1, 1)
-                grid_emb = grid_emb + pos_emb_g + modal_emb
-                grid_emb = self.fc4(grid_emb)
-
-                # update gps_emb_r
-                gps_emb = torch.cat([gps_cls_token, gps_road_token], dim=0)
-                modal_emb = modal_emb1.unsqueeze(0).repeat(length_r+1, 1)
-                gps_emb = gps_emb + pos_emb_r + modal_emb
-                gps_emb = self.fc2(gps_emb)
-
-                # update gps_emb_g
-                gps_g_emb = torch.cat([gps_cls_grid_token, gps_grid_token], dim=0)
-                modal_emb = modal_emb3.unsqueeze(0).repeat(length_g+1, 1)
-                gps_g_emb = gps_g_emb + pos_emb_g + modal_emb
-                gps_g_emb = self.fc4(gps_g_emb)
-                
-                data = torch.cat([gps_emb, route_emb, gps_g_emb, grid_emb], dim=0)
-                data_list.append(data)
-
-                mask = torch.tensor([False] * data.shape[0]).cuda() # mask的位置为true
-                mask_list.append(mask)
-        else:
-            data_list = []
-            mask_list = []
-            route_emb_list = []
-            grid_emb_list = []
-            gps_emb_list = []
-            gps_g_emb_list = []
-
-            mask_list_route_emb = []
-            mask_list_grid_emb = []
-            mask_list_gps_emb = []
-            mask_list_gps_g_emb = []
-
-            route_length = [length[length!=self.vocab_size].shape[0] for length in route_assign_mat]
-            grid_length = [length[length!=self.grid_vocab_size].shape[0] for length in grid_assign_mat]
-
-            modal_emb0 = self.modal_embedding_four_module(torch.tensor(0).cuda())
-            modal_emb1 = self.modal_embedding_four_module(torch.tensor(1).cuda())
-            modal_emb2 = self.modal_embedding_four_module(torch.tensor(2).cuda())
-            modal_emb3 = self.modal_embedding_four_module(torch.tensor(3).cuda())
-
-            for i, (length_r, length_g) in enumerate(zip(route_length, grid_length)):
-
-                route_road_token = route_road_rep[i]
-                gps_road_token = gps_road_rep[i]
-                route_cls_token = route_traj_rep[i].unsqueeze(0)
-                gps_cls_token = gps_traj_rep[i].unsqueeze(0)
-
-                grid_road_token = grid_road_rep[i]
-                gps_grid_token = gps_grid_rep[i]
-                grid_cls_token = grid_traj_rep[i].unsqueeze(0)
-                gps_cls_grid_token = gps_traj_grid_rep[i].unsqueeze(0)
-
-
-                route_emb = torch.cat([route_cls_token, route_road_token], dim=0)
-                grid_emb = torch.cat([grid_cls_token, grid_road_token], dim=0)
-                gps_emb = torch.cat([gps_cls_token, gps_road_token], dim=0)
-                gps_g_emb = torch.cat([gps_cls_grid_token, gps_grid_token], dim=0)
-
-
-                route_emb_list.append(route_emb)
-                grid_emb_list.append(grid_emb)
-                gps_emb_list.append(gps_emb)
-                gps_g_emb_list.append(gps_g_emb)
-
-                mask_route_emb = torch.tensor([False] * (length_r+1) + [True] * (route_emb.shape[0]-(length_r+1))).cuda()
-                mask_list_route_emb.append(mask_route_emb)
-                mask_grid_emb = torch.tensor([False] * (length_g+1) + [True] * (grid_emb.shape[0]-(length_g+1))).cuda()
-                mask_list_grid_emb.append(mask_grid_emb)
-                mask_gps_emb = torch.tensor([False] * (length_r+1) + [True] * (gps_emb.shape[0]-(length_r+1))).cuda()
-                mask_list_gps_emb.append(mask_gps_emb)
-                mask_gps_g_emb = torch.tensor([False] * (length_g+1) + [True] * (gps_g_emb.shape[0]-(length_g+1))).cuda()
-                mask_list_gps_g_emb.append(mask_gps_g_emb)
-
-            route_emb = torch.stack(route_emb_list, dim=0)
-            mask_route_emb = torch.stack(mask_list_route_emb, dim=0)
-            grid_emb = torch.stack(grid_emb_list, dim=0)
-            mask_grid_emb = torch.stack(mask_list_grid_emb, dim=0)
-            gps_emb = torch.stack(gps_emb_list, dim=0)
-            mask_gps_emb = torch.stack(mask_list_gps_emb, dim=0)
-            gps_g_emb = torch.stack(gps_g_emb_list, dim=0)
-            mask_gps_g_emb = torch.stack(mask_list_gps_g_emb, dim=0)
+    def encode_joint_four_stream(self, route_road_rep, route_traj_rep, gps_road_rep, gps_traj_rep, route_assign_mat, \
+                                 grid_road_rep, grid_traj_rep, gps_grid_rep, gps_traj_grid_rep, grid_assign_mat, road_outputs=True):
+        # road_outputs 为 False 时只返回轨迹表示，路段/栅格表示为 None
+        batch_size = route_assign_mat.shape[0]
+        device = route_assign_mat.device
+        route_length = (route_assign_mat != self.vocab_size).long().sum(1) # (batch_size,)
+        grid_length = (grid_assign_mat != self.grid_vocab_size).long().sum(1)
+
+        route_emb = torch.cat([route_traj_rep.unsqueeze(1), route_road_rep], dim=1)
+        grid_emb = torch.cat([grid_traj_rep.unsqueeze(1), grid_road_rep], dim=1)
+        gps_emb = torch.cat([gps_traj_rep.unsqueeze(1), gps_road_rep], dim=1)
+        gps_g_emb = torch.cat([gps_traj_grid_rep.unsqueeze(1), gps_grid_rep], dim=1)
+
+        if self.add_cross:
+            # mask的位置为true，cls 和前 length 个 token 为有效位置
+            mask_route_emb = torch.arange(route_emb.shape[1], device=device).unsqueeze(0) > route_length.unsqueeze(1)
+            mask_grid_emb = torch.arange(grid_emb.shape[1], device=device).unsqueeze(0) > grid_length.unsqueeze(1)
+            mask_gps_emb = torch.arange(gps_emb.shape[1], device=device).unsqueeze(0) > route_length.unsqueeze(1)
+            mask_gps_g_emb = torch.arange(gps_g_emb.shape[1], device=device).unsqueeze(0) > grid_length.unsqueeze(1)
 
             # 将输入张量的维度调整为 (S, N, E)，其中 S 是序列长度，N 是批次大小，E 是嵌入维度
-            route_emb = route_emb.permute(1, 0, 2).cuda()
-            gps_emb = gps_emb.permute(1, 0, 2).cuda()
-            grid_emb = grid_emb.permute(1, 0, 2).cuda()
-            gps_g_emb = gps_g_emb.permute(1, 0, 2).cuda()
-
-            mask_route_emb = mask_route_emb.cuda()
-            mask_grid_emb = mask_grid_emb.cuda()
-            mask_gps_emb = mask_gps_emb.cuda()
-            mask_gps_g_emb = mask_gps_g_emb.cuda()
-
-            # Route embedding as query, others as key and value
-            attn_route_to_gps = self.cross_attn_route_to_gps(route_emb, gps_emb, gps_emb,mask_route_emb, mask_gps_emb)
-            attn_route_to_grid = self.cross_attn_route_to_grid(route_emb, grid_emb, grid_emb,mask_route_emb, mask_grid_emb)
-            attn_route_to_gps_g = self.cross_attn_route_to_gps_g(route_emb, gps_g_emb, gps_g_emb,mask_route_emb, mask_gps_g_emb)
-            # attn_route_to_route = self.cross_attn_route_to_route(route_emb, route_emb, route_emb,mask_route_emb, mask_route_emb)
-
-            # GPS embedding as query, others as key and value
-            attn_gps_to_route = self.cross_attn_gps_to_route(gps_emb, route_emb, route_emb,mask_gps_emb, mask_route_emb)
-            attn_gps_to_grid = self.cross_attn_gps_to_grid(gps_emb, grid_emb, grid_emb,mask_gps_emb, mask_grid_emb)
-            attn_gps_to_gps_g = self.cross_attn_gps_to_gps_g(gps_emb, gps_g_emb, gps_g_emb,mask_gps_emb, mask_gps_g_emb)
-            # attn_gps_to_gps = self.cross_attn_gps_to_gps(gps_emb, gps_emb, gps_emb,mask_gps_emb, mask_gps_emb)
-
-            # Grid embedding as query, others as key and value
-            attn_grid_to_route = self.cross_attn_grid_to_route(grid_emb, route_emb, route_emb,mask_grid_emb, mask_route_emb)
-            attn_grid_to_gps =self. cross_attn_grid_to_gps(grid_emb, gps_emb, gps_emb,mask_grid_emb, mask_gps_emb)
-            attn_grid_to_gps_g = self.cross_attn_grid_to_gps_g(grid_emb, gps_g_emb, gps_g_emb,mask_grid_emb, mask_gps_g_emb)
-            # attn_grid_to_grid = self.cross_attn_grid_to_grid(grid_emb, grid_emb, grid_emb,mask_grid_emb, mask_grid_emb)
-
-            # GPS Grid embedding as query, others as key and value
-            attn_gps_g_to_route = self.cross_attn_gps_g_to_route(gps_g_emb, route_emb, route_emb,mask_gps_g_emb, mask_route_emb)
-            attn_gps_g_to_gps = self.cross_attn_gps_g_to_gps(gps_g_emb, gps_emb, gps_emb,mask_gps_g_emb, mask_gps_emb)
-            attn_gps_g_to_grid = self.cross_attn_gps_g_to_grid(gps_g_emb, grid_emb, grid_emb,mask_gps_g_emb, mask_grid_emb)
-            # attn_gps_g_to_gps_g = self.cross_attn_gps_g_to_gps_g(gps_g_emb, gps_g_emb, gps_g_emb,mask_gps_g_emb, mask_gps_g_emb)
-
-            final_route_emb = attn_route_to_gps + attn_route_to_grid + attn_route_to_gps_g #+ attn_route_to_route
-            final_gps_emb = attn_gps_to_route + attn_gps_to_grid + attn_gps_to_gps_g #+ attn_gps_to_gps
-            final_grid_emb = attn_grid_to_route + attn_grid_to_gps + attn_grid_to_gps_g #+ attn_grid_to_grid
-            final_gps_g_emb = attn_gps_g_to_route + attn_gps_g_to_gps + attn_gps_g_to_grid #+ attn_gps_g_to_gps_g
-
-            final_route_emb = final_route_emb.permute(1, 0, 2)
-            final_gps_emb = final_gps_emb.permute(1, 0, 2)
-            final_grid_emb = final_grid_emb.permute(1, 0, 2)
-            final_gps_g_emb = final_gps_g_emb.permute(1, 0, 2)
-
-            non_route_padding_mask = ~mask_route_emb
-            non_grid_padding_mask = ~mask_grid_emb
-            non_gps_padding_mask = ~mask_gps_emb
-            non_gps_g_padding_mask = ~mask_gps_g_emb
-
-            # 对于每个 batch，使用非 padding mask 从 final_route_emb 中选择有效位置
-            non_route_padding_emb = []
-            non_grid_padding_emb = []
-            non_gps_padding_emb = []
-            non_gps_g_padding_emb = []
-
-            for i, (length_r, length_g) in enumerate(zip(route_length, grid_length)):
-                # 选择每个 batch 的非 padding 部分
-                route_emb = final_route_emb[i][non_route_padding_mask[i]]
-                non_route_padding_emb.append(route_emb)
-                grid_emb = final_grid_emb[i][non_grid_padding_mask[i]]
-                non_grid_padding_emb.append(grid_emb)
-                gps_emb = final_gps_emb[i][non_gps_padding_mask[i]]
-                non_gps_padding_emb.append(gps_emb)
-                gps_g_emb = final_gps_g_emb[i][non_gps_g_padding_mask[i]]
-                non_gps_g_padding_emb.append(gps_g_emb)
-
-
-                # position
-                position_r = torch.arange(length_r+1).long().cuda()
-                pos_emb_r = self.position_embedding2(position_r) 
-
-                position_g = torch.arange(length_g+1).long().cuda()
-                pos_emb_g = self.position_embedding2(position_g) 
-
-                # update route_emb
-                modal_emb = modal_emb0.unsqueeze(0).repeat(length_r+1, 1)
-                route_emb = route_emb + pos_emb_r + modal_emb
-                route_emb = self.fc2(route_emb)
-
-                # update grid_emb
-                modal_emb = modal_emb2.unsqueeze(0).repeat(length_g+1, 1)
-                grid_emb = grid_emb + pos_emb_g + modal_emb
-                grid_emb = self.fc4(grid_emb)
-
-                # update gps_emb_r
-                modal_emb = modal_emb1.unsqueeze(0).repeat(length_r+1, 1)
-                gps_emb = gps_emb + pos_emb_r + modal_emb
-                gps_emb = self.fc2(gps_emb)
-
-                # update gps_emb_g
-                modal_emb = modal_emb3.unsqueeze(0).repeat(length_g+1, 1)
-                gps_g_emb = gps_g_emb + pos_emb_g + modal_emb
-                gps_g_emb = self.fc4(gps_g_emb)
-
-                data = torch.cat([gps_emb, route_emb, gps_g_emb, grid_emb], dim=0)
-                data_list.append(data)
-                mask = torch.tensor([False] * data.shape[0]).cuda() # mask的位置为true
-                mask_list.append(mask)
-
-        joint_data = rnn_utils.pad_sequence(data_list, padding_value=0, batch_first=True)
-        mask_mat = rnn_utils.pad_sequence(mask_list, padding_value=True, batch_first=True)
+            # 每个视图作为 query 对其余三个视图做 cross attention 并求和，视图顺序与 CROSS_VIEWS 一致
+            route_emb, gps_emb, grid_emb, gps_g_emb = self.multi_view_attn(
+                [route_emb.permute(1, 0, 2), gps_emb.permute(1, 0, 2), grid_emb.permute(1, 0, 2), gps_g_emb.permute(1, 0, 2)],
+                [mask_route_emb, mask_gps_emb, mask_grid_emb, mask_gps_g_emb])
+            route_emb = route_emb.permute(1, 0, 2)
+            gps_emb = gps_emb.permute(1, 0, 2)
+            grid_emb = grid_emb.permute(1, 0, 2)
+            gps_g_emb = gps_g_emb.permute(1, 0, 2)
+
+        # position + modal embedding，route/gps 共用 fc2，grid/gps_g 共用 fc4，整个 batch 一次计算
+        route_emb = self.fuse_stream(route_emb, route_length, 0, self.fc2)
+        gps_emb = self.fuse_stream(gps_emb, route_length, 1, self.fc2)
+        grid_emb = self.fuse_stream(grid_emb, grid_length, 2, self.fc4)
+        gps_g_emb = self.fuse_stream(gps_g_emb, grid_length, 3, self.fc4)
+
+        # 每条轨迹拼接为 [gps, route, gps_g, grid]，各段长度为 length+1，按起点把各段 scatter 到 joint_data 中
+        route_start = route_length + 1
+        gps_g_start = 2 * route_length + 2
+        grid_start = 2 * route_length + grid_length + 3
+        joint_length = 2 * route_length + 2 * grid_length + 4
+        joint_data = route_emb.new_zeros(batch_size, int(joint_length.max()), route_emb.shape[-1])
+        for stream_emb, start, length in [(gps_emb, torch.zeros_like(route_length), route_length), (route_emb, route_start, route_length),
+                                          (gps_g_emb, gps_g_start, grid_length), (grid_emb, grid_start, grid_length)]:
+            offset = torch.arange(stream_emb.shape[1], device=device)
+            valid = offset.unsqueeze(0) <= length.unsqueeze(1)
+            batch_idx = torch.arange(batch_size, device=device).unsqueeze(1).expand_as(valid)
+            joint_data[batch_idx[valid], (start.unsqueeze(1) + offset.unsqueeze(0))[valid]] = stream_emb[valid]
+        mask_mat = torch.arange(joint_data.shape[1], device=device).unsqueeze(0) >= joint_length.unsqueeze(1) # mask的位置为true
 
         joint_emb = self.sharedtransformer(joint_data, None, mask_mat)
         joint_emb = joint_emb.permute(1, 0, 2)
         # 每一行的0 和 length+1 对应的是 gps_traj_rep 和 route_traj_rep
-        # 2length+1 和 2length+length_g+1 对应的是 gps_traj_grid_rep 和 grid_traj_rep
+        # 2length+2 和 2length+length_g+3 对应的是 gps_traj_grid_rep 和 grid_traj_rep
         # 因为有cls
+        batch_idx = torch.arange(batch_size, device=device)
         gps_traj_rep = joint_emb[:, 0]
-        route_traj_rep = torch.stack([joint_emb[i, length+1] for i, length in enumerate(route_length)], dim=0)
-        gps_traj_grid_rep = torch.stack([joint_emb[i, 2*length+2] for i, length in enumerate(route_length)], dim=0)
-        grid_traj_rep = torch.stack([joint_emb[i, 2*length_r+length_g+3] for i, (length_r, length_g) in enumerate(zip(route_length, grid_length))], dim=0)
+        route_traj_rep = joint_emb[batch_idx, route_start]
+        gps_traj_grid_rep = joint_emb[batch_idx, gps_g_start]
+        grid_traj_rep = joint_emb[batch_idx, grid_start]
+        if not road_outputs:
+            return gps_traj_rep, route_traj_rep, gps_traj_grid_rep, grid_traj_rep, None, None, None, None
 
-        gps_road_rep = rnn_utils.pad_sequence([joint_emb[i, 1:length+1] for i, length in enumerate(route_length)],
-                                              padding_value=0, batch_first=True)
-        route_road_rep = rnn_utils.pad_sequence([joint_emb[i, length+2:2*length+2] for i, length in enumerate(route_length)],
-                                                padding_value=0, batch_first=True)
-        gps_grid_rep = rnn_utils.pad_sequence([joint_emb[i, 2*length_r+3:2*length_r+length_g+3] for i, (length_r, length_g) in enumerate(zip(route_length, grid_length))],
-                                                padding_value=0, batch_first=True)
-        grid_road_rep = rnn_utils.pad_sequence([joint_emb[i, 2*length_r+length_g+4:2*length_r+2*length_g+4] for i, (length_r, length_g) in enumerate(zip(route_length, grid_length))],
-                                                padding_value=0, batch_first=True)
+        gps_road_rep = self.gather_tokens(joint_emb, torch.ones_like(route_length), route_length)
+        route_road_rep = self.gather_tokens(joint_emb, route_start + 1, route_length)
+        gps_grid_rep = self.gather_tokens(joint_emb, gps_g_start + 1, grid_length)
+        grid_road_rep = self.gather_tokens(joint_emb, grid_start + 1, grid_length)
 
         return gps_traj_rep, route_traj_rep, gps_traj_grid_rep, grid_traj_rep, gps_road_rep, route_road_rep, gps_grid_rep, grid_road_rep
 
@@ -642,6 +579,55 @@ class MVTraj(BaseModel):
                gps_traj_joint_rep, route_traj_joint_rep, gps_traj_grid_joint_rep, grid_traj_joint_rep, gps_road_joint_rep, route_road_joint_rep, \
               gps_grid_joint_rep, grid_road_joint_rep
 
+    def encode(self, batch, views=None, outputs=('traj', 'road')):
+        """
+        推理接口：只计算需要的视图和输出，在 inference_mode 下运行（torch<1.9 为 no_grad），调用前需要 eval()
+        返回的是 inference tensor，直接作为需要反向传播的模型的输入前先 clone()（torch.cat 等得到的新 tensor 不受影响）
+
+        Args:
+            batch: TrainBatch，或与 forward 参数顺序相同的 tuple
+            views: QUEUE_VIEWS 的子集，默认全部；四个视图都选时为经过 cross attention 和 shared transformer 的 joint 表示，
+                   否则只运行所选视图的编码器，返回编码器的表示（joint 需要四个视图）
+            outputs: 'traj' 为轨迹表示 (batch_size, hidden_size)，'road' 为路段/栅格表示 (batch_size, max_len, hidden_size)
+
+        Returns:
+            dict{'{view}_{output}': tensor}，如 'route_traj'、'grid_road'
+        """
+        views = QUEUE_VIEWS if views is None else tuple(views)
+        unknown = set(views) - set(QUEUE_VIEWS)
+        if unknown or set(outputs) - {'traj', 'road'}:
+            raise ValueError('unknown views {} or outputs {}'.format(sorted(unknown), outputs))
+        route_data, masked_route_assign_mat, gps_data, masked_gps_assign_mat, route_assign_mat, gps_length, \
+            grid_data, masked_grid_assign_mat, gps_data_grid, masked_gps_assign_mat_grid, grid_assign_mat, gps_length_grid = batch
+
+        with inference_mode():
+            # 每个视图为 (路段表示, 轨迹表示)
+            reps = {}
+            if 'gps' in views:
+                reps['gps'] = self.encode_gps(gps_data, masked_gps_assign_mat, masked_route_assign_mat, gps_length)
+            if 'route' in views:
+                reps['route'] = self.encode_route(route_data, route_assign_mat, masked_route_assign_mat)
+            if 'gps_grid' in views:
+                reps['gps_grid'] = self.encode_gps_grid(gps_data_grid, masked_gps_assign_mat_grid, masked_grid_assign_mat, gps_length_grid)
+            if 'grid' in views:
+                reps['grid'] = self.encode_grid(grid_data, grid_assign_mat, masked_grid_assign_mat)
+
+            if len(reps) == len(QUEUE_VIEWS):
+                joint = self.encode_joint_four_stream(reps['route'][0], reps['route'][1], reps['gps'][0], reps['gps'][1], route_assign_mat,
+                                                      reps['grid'][0], reps['grid'][1], reps['gps_grid'][0], reps['gps_grid'][1],
+                                                      grid_assign_mat, road_outputs='road' in outputs)
+                # encode_joint_four_stream 依次返回 QUEUE_VIEWS 顺序的四个轨迹表示和四个路段表示
+                reps = {view: (joint[len(QUEUE_VIEWS) + i], joint[i]) for i, view in enumerate(QUEUE_VIEWS)}
+
+            encoded = {}
+            for view in views:
+                road_rep, traj_rep = reps[view]
+                if 'traj' in outputs:
+                    encoded['{}_traj'.format(view)] = traj_rep
+                if 'road' in outputs:
+                    encoded['{}_road'.format(view)] = road_rep
+        return encoded
+
 # GAT
 class GraphEncoder(nn.Module):
     def __init__(self, input_size, output_size):
@@ -675,7 +661,9 @@ class IntervalEmbedding(nn.Module):
         self.emb = nn.Embedding(num_bins, hidden_size)
         self.activation = nn.Softmax()
     def forward(self, x):
-        logit = self.activation(self.layer1(x.unsqueeze(-1)))
+        # 时间间隔（秒）可达上千，layer1 的输出在 fp16 下会溢出为 inf，softmax 后为 nan，因此这里始终用 fp32 计算
+        with autocast(x.device, 'fp32'):
+            logit = self.activation(self.layer1(x.float().unsqueeze(-1)))
         output = logit @ self.emb.weight
         return output
 
@@ -685,28 +673,206 @@ class CrossAttention(nn.Module):
         super(CrossAttention, self).__init__()
         self.attention = nn.MultiheadAttention(embed_size, num_heads)
 
-    def forward(self, query, key, value, mask_q=None, mask_k=None):
-        batch_size = query.size(1)  # 批处理大小
-        seq_q, seq_k = query.size(0), key.size(0)  # 序列长度
+    def build_mask(self, mask_q, mask_k):
+        # mask_q (batch_size, seq_q), mask_k (batch_size, seq_k)，padding位为True
+        # query 和 key 都是 padding 的位置为 -inf，其余为0，直接在 query 所在的 device 上广播得到
+        both_padding = mask_q.unsqueeze(2) & mask_k.unsqueeze(1) # (batch_size, seq_q, seq_k)
+        attn_mask = torch.zeros(both_padding.shape, device=mask_q.device).masked_fill(both_padding, float('-inf'))
 
+        # Expand attn_mask for multi-head attention
+        return attn_mask.repeat_interleave(self.attention.num_heads, dim=0) # (batch_size * num_heads, seq_q, seq_k)
 
-        # Create attention mask
+    def forward(self, query, key, value, mask_q=None, mask_k=None):
         if mask_q is not None and mask_k is not None:
-            attn_mask = torch.full((batch_size, seq_q, seq_k), float('-inf'))  # Initialize with -inf
-
-            for b in range(batch_size):
-                # Set valid positions to 0
-                attn_mask[b, :, ~mask_k[b]] = 0  # mask_k 是布尔掩码，~mask_k 表示相反的掩码
-                attn_mask[b, ~mask_q[b], :] = 0  # mask_q 是布尔掩码，~mask_q 表示相反的掩码
-
-            attn_mask = attn_mask.to(query.device)  # Move to the same device as query
-
-            # Expand attn_mask for multi-head attention
-            num_heads = self.attention.num_heads
-            attn_mask = attn_mask.unsqueeze(1).expand(-1, num_heads, -1, -1).reshape(batch_size * num_heads, seq_q, seq_k)
+            attn_mask = self.build_mask(mask_q, mask_k)
         else:
             attn_mask = None
 
         # Compute attention
         attention_output, _ = self.attention(query, key, value, attn_mask=attn_mask)
-        return attention_output
\ No newline at end of file
+        return attention_output
+
+
+class MLMHead(nn.Linear):
+    """
+    MLM 分类头，参数与 nn.Linear(hidden_size, vocab_size) 相同，forward 返回全部类别的 logits
+
+    loss 只需输入被 mask 位置的表示。num_sampled > 0 且处于训练模式时使用 sampled softmax：
+    每个 batch 均匀采样 num_sampled 个类别作为共享的负样本，只计算 正确类别 + 负样本 的 logits；
+    eval 模式下始终为完整的 softmax
+    """
+    def __init__(self, hidden_size, vocab_size, num_sampled=0):
+        super(MLMHead, self).__init__(hidden_size, vocab_size)
+        self.vocab_size = vocab_size
+        self.num_sampled = num_sampled
+
+    @classmethod
+    def from_linear(cls, linear, num_sampled=0):
+        head = cls(linear.in_features, linear.out_features, num_sampled).to(linear.weight.device)
+        head.load_state_dict(linear.state_dict())
+        return head
+
+    def loss(self, x, labels):
+        # x (masked_num, hidden_size)，labels (masked_num,)
+        if not self.training or not 0 < self.num_sampled < self.vocab_size:
+            return F.cross_entropy(self(x), labels)
+
+        sampled = torch.randint(self.vocab_size, (self.num_sampled,), device=x.device)
+        true_logits = (x * self.weight[labels]).sum(-1, keepdim=True) + self.bias[labels].unsqueeze(-1) # (masked_num, 1)
+        sampled_logits = F.linear(x, self.weight[sampled], self.bias[sampled]) # (masked_num, num_sampled)
+        # 均匀采样时 log Q 修正对所有类别相同，可以省略；只需去掉与正确类别相同的负样本
+        sampled_logits = sampled_logits.masked_fill(sampled.unsqueeze(0) == labels.unsqueeze(1), float('-inf'))
+        logits = torch.cat([true_logits, sampled_logits], dim=1)
+        return F.cross_entropy(logits, torch.zeros_like(labels))
+
+
+CROSS_VIEWS = ('route', 'gps', 'grid', 'gps_g')
+QUEUE_VIEWS = ('gps', 'route', 'gps_grid', 'grid')
+
+class MultiViewCrossAttention(nn.Module):
+    """
+    多视图 cross attention：每个视图作为 query，分别对其余视图做 multi-head attention 后求和，
+    与每对 (query 视图, key 视图) 一个 CrossAttention 再相加的结果一致
+
+    每个视图只做一次输入投影（作为 query 的 q，作为 key 的 k/v 一起算），每个 query 视图对其余视图的
+    attention 在一次 batched matmul 中完成，输出拼接后一次投影
+    """
+    def __init__(self, embed_size, num_heads, num_views=4):
+        super(MultiViewCrossAttention, self).__init__()
+        self.embed_size = embed_size
+        self.num_heads = num_heads
+        self.num_views = num_views
+        self.head_dim = embed_size // num_heads
+        num_pairs = num_views - 1
+
+        # 视图 v 的输入投影按行依次为：对其余视图的 q，被其余视图查询时的 k，被其余视图查询时的 v
+        self.in_proj_weight = nn.Parameter(torch.empty(num_views, 3 * num_pairs * embed_size, embed_size))
+        self.in_proj_bias = nn.Parameter(torch.empty(num_views, 3 * num_pairs * embed_size))
+        # 视图 u 对其余视图的 attention 输出拼接后投影，bias 为各对 bias 之和
+        self.out_proj_weight = nn.Parameter(torch.empty(num_views, embed_size, num_pairs * embed_size))
+        self.out_proj_bias = nn.Parameter(torch.empty(num_views, embed_size))
+        self.reset_parameters()
+
+    def reset_parameters(self):
+        # 与 nn.MultiheadAttention 的 in_proj (3E, E) xavier_uniform_ 以及 weight_init 中 out_proj 的 xavier_normal_ 一致
+        bound = math.sqrt(6. / (4 * self.embed_size))
+        nn.init.uniform_(self.in_proj_weight, -bound, bound)
+        nn.init.normal_(self.out_proj_weight, std=math.sqrt(1. / self.embed_size))
+        nn.init.zeros_(self.in_proj_bias)
+        nn.init.zeros_(self.out_proj_bias)
+
+    @staticmethod
+    def others(view, num_views):
+        return [other for other in range(num_views) if other != view]
+
+    @staticmethod
+    def pair_slices(query_view, key_view, num_views, embed_size):
+        # (query 视图, key 视图) 的 q/k/v 在融合后 in_proj 中的行，以及 attention 输出在 out_proj 中的列
+        num_pairs = num_views - 1
+        j = MultiViewCrossAttention.others(query_view, num_views).index(key_view)
+        i = MultiViewCrossAttention.others(key_view, num_views).index(query_view)
+        q = slice(j * embed_size, (j + 1) * embed_size)
+        k = slice((num_pairs + i) * embed_size, (num_pairs + i + 1) * embed_size)
+        v = slice((2 * num_pairs + i) * embed_size, (2 * num_pairs + i + 1) * embed_size)
+        return q, k, v, q
+
+    @classmethod
+    def from_cross_attention(cls, attentions):
+        # attentions: {'cross_attn_{query}_to_{key}': nn.MultiheadAttention}，由旧模型的 12 个 CrossAttention 构造
+        any_attn = next(iter(attentions.values()))
+        module = cls(any_attn.embed_dim, any_attn.num_heads, len(CROSS_VIEWS)).to(any_attn.in_proj_weight.device)
+        state_dict = {}
+        for name, attention in attentions.items():
+            for param_name, param in attention.state_dict().items():
+                state_dict['{}.attention.{}'.format(name, param_name)] = param
+        convert_cross_attention_state_dict(state_dict)
+        module.load_state_dict({name[len('multi_view_attn.'):]: param for name, param in state_dict.items()})
+        return module
+
+    def forward(self, views, padding_masks):
+        """
+        Args:
+            views: 每个视图 (seq_len, batch_size, embed_size)
+            padding_masks: 每个视图 (batch_size, seq_len)，padding位为True；query 和 key 都是 padding 的位置不参与 attention
+
+        Returns:
+            每个视图作为 query 的输出之和 (seq_len, batch_size, embed_size)
+        """
+        num_pairs = self.num_views - 1
+        batch_size = views[0].shape[1]
+        scaling = float(self.head_dim) ** -0.5
+
+        queries, keys, values = [], [], []
+        for view, emb in enumerate(views):
+            proj = F.linear(emb, self.in_proj_weight[view], self.in_proj_bias[view]) # (seq_len, batch_size, 3*num_pairs*embed_size)
+            proj = proj.view(emb.shape[0], batch_size, 3, num_pairs, self.num_heads, self.head_dim).permute(2, 1, 3, 4, 0, 5)
+            queries.append(proj[0] * scaling) # (batch_size, num_pairs, num_heads, seq_len, head_dim)
+            keys.append(proj[1])
+            values.append(proj[2])
+
+        outputs = []
+        for query_view, emb in enumerate(views):
+            others = self.others(query_view, self.num_views)
+            seq_k = max(views[other].shape[0] for other in others)
+
+            # 其余视图中被 query_view 查询的 k/v，补齐到相同长度后按 pair 拼接
+            pair_keys, pair_values, key_padding, key_missing = [], [], [], []
+            for other in others:
+                i = self.others(other, self.num_views).index(query_view)
+                pad = seq_k - views[other].shape[0]
+                pair_keys.append(F.pad(keys[other][:, i], (0, 0, 0, pad)))
+                pair_values.append(F.pad(values[other][:, i], (0, 0, 0, pad)))
+                key_padding.append(F.pad(padding_masks[other], (0, pad), value=True))
+                key_missing.append(torch.arange(seq_k, device=emb.device) >= views[other].shape[0])
+            pair_keys = torch.stack(pair_keys, dim=1) # (batch_size, num_pairs, num_heads, seq_k, head_dim)
+            pair_values = torch.stack(pair_values, dim=1)
+            key_padding = torch.stack(key_padding, dim=1) # (batch_size, num_pairs, seq_k)
+            key_missing = torch.stack(key_missing, dim=0) # (num_pairs, seq_k)
+
+            blocked = (padding_masks[query_view].unsqueeze(1).unsqueeze(-1) & key_padding.unsqueeze(2)) | key_missing.unsqueeze(1)
+            scores = torch.matmul(queries[query_view], pair_keys.transpose(-1, -2)) # (batch_size, num_pairs, num_heads, seq_q, seq_k)
+            # 用 dtype 的最小值代替 -inf：部分被屏蔽的行结果不变，全部被屏蔽的行（padding 的 query）不再是 nan，
+            # 否则 nan 会经 softmax 的反向传播进入梯度，fp16 下 GradScaler 会一直跳过更新；softmax 在 fp32 下计算
+            scores = scores.masked_fill(blocked.unsqueeze(2), torch.finfo(scores.dtype).min)
+            weights = torch.softmax(scores.float(), dim=-1).type_as(pair_values)
+            attn = torch.matmul(weights, pair_values) # (batch_size, num_pairs, num_heads, seq_q, head_dim)
+
+            attn = attn.permute(3, 0, 1, 2, 4).reshape(emb.shape[0], batch_size, num_pairs * self.embed_size)
+            outputs.append(F.linear(attn, self.out_proj_weight[query_view], self.out_proj_bias[query_view]))
+        return outputs
+
+
+def convert_cross_attention_state_dict(state_dict, prefix=''):
+    """
+    把旧 checkpoint 中 12 个 cross_attn_{query}_to_{key}.attention.* 的权重原地转换为 multi_view_attn.*
+    没有旧权重时不做修改
+    """
+    old_name = prefix + 'cross_attn_{}_to_{}.attention.'
+    if old_name.format(CROSS_VIEWS[0], CROSS_VIEWS[1]) + 'in_proj_weight' not in state_dict:
+        return state_dict
+
+    num_views = len(CROSS_VIEWS)
+    any_weight = state_dict[old_name.format(CROSS_VIEWS[0], CROSS_VIEWS[1]) + 'in_proj_weight']
+    embed_size = any_weight.shape[1]
+    in_proj_weight = any_weight.new_zeros(num_views, 3 * (num_views - 1) * embed_size, embed_size)
+    in_proj_bias = any_weight.new_zeros(num_views, 3 * (num_views - 1) * embed_size)
+    out_proj_weight = any_weight.new_zeros(num_views, embed_size, (num_views - 1) * embed_size)
+    out_proj_bias = any_weight.new_zeros(num_views, embed_size)
+
+    for query_view, query_name in enumerate(CROSS_VIEWS):
+        for key_view in MultiViewCrossAttention.others(query_view, num_views):
+            name = old_name.format(query_name, CROSS_VIEWS[key_view])
+            q, k, v, out = MultiViewCrossAttention.pair_slices(query_view, key_view, num_views, embed_size)
+            weight, bias = state_dict.pop(name + 'in_proj_weight'), state_dict.pop(name + 'in_proj_bias')
+            in_proj_weight[query_view, q], in_proj_bias[query_view, q] = weight[:embed_size], bias[:embed_size]
+            in_proj_weight[key_view, k], in_proj_bias[key_view, k] = weight[embed_size:2 * embed_size], bias[embed_size:2 * embed_size]
+            in_proj_weight[key_view, v], in_proj_bias[key_view, v] = weight[2 * embed_size:], bias[2 * embed_size:]
+            out_proj_weight[query_view, :, out] = state_dict.pop(name + 'out_proj.weight')
+            out_proj_bias[query_view] += state_dict.pop(name + 'out_proj.bias')
+
+    new_name = prefix + 'multi_view_attn.'
+    state_dict[new_name + 'in_proj_weight'] = in_proj_weight
+    state_dict[new_name + 'in_proj_bias'] = in_proj_bias
+    state_dict[new_name + 'out_proj_weight'] = out_proj_weight
+    state_dict[new_name + 'out_proj_bias'] = out_proj_bias
+    return state_dict
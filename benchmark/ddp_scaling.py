@@ -0,0 +1,89 @@
+# 单机多进程 DDP 训练的扩展效率：world_size = 1, 2, 4 时所有 rank 合计的吞吐
+# 每个 rank 的 batch_size 不变 (weak scaling)，--threads 个 CPU 线程由各进程平分；
+# 扩展效率 = 吞吐(n) / (n * 吞吐(1))
+# Usage (在 benchmark/ 目录下运行):
+#     python ddp_scaling.py --config ../config/xian.json --steps 20 --world_sizes 1 2 4 --device cpu
+import sys
+sys.path.append("..")
+import time
+import json
+import argparse
+import numpy as np
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from torch.nn.parallel import DistributedDataParallel as DDP
+from transformers import AdamW
+from dataloader import get_train_loader, DevicePrefetcher
+from MVTraj import MVTraj
+from model_train import PretrainModule, optimizer_step
+from utils import setup_seed, weight_init, autocast, make_grad_scaler
+
+
+def worker(rank, world_size, config, args, results):
+    torch.set_num_threads(max(1, args.threads // world_size))
+    dist.init_process_group('gloo', init_method='tcp://127.0.0.1:{}'.format(args.port + world_size),
+                            world_size=world_size, rank=rank)
+    device = torch.device('cpu') if args.device == 'cpu' else torch.device('cuda', rank)
+    setup_seed(config['random_seed'] + rank)
+
+    edge_index = np.load(config['adj_path'])
+    model = MVTraj(config['vocab_size'], config['grid_vocab_size'], config['route_max_len'], config['road_feat_num'],
+                   config['road_embed_size'], config['gps_feat_num'], config['gps_embed_size'], config['route_embed_size'],
+                   config['hidden_size'], edge_index, config['drop_edge_rate'], config['drop_route_rate'],
+                   config['drop_road_rate'], mode='x', mlm_num_sampled=config['mlm_num_sampled'], queue_size=0).to(device)
+    model.apply(weight_init)
+    loss_module = DDP(PretrainModule(model, config['match_hard_k']), device_ids=[device.index] if device.type == 'cuda' else None,
+                      broadcast_buffers=False, find_unused_parameters=True)
+    optimizer = AdamW(model.parameters(), lr=config['learning_rate'], weight_decay=config['weight_decay'])
+    scaler = make_grad_scaler(device, config['precision'])
+
+    loader = get_train_loader(config['data_path'], config['batch_size'], config['num_worker'],
+                              config['route_min_len'], config['route_max_len'], config['gps_min_len'],
+                              config['gps_max_len'], config['grid_min_len'], config['grid_max_len'],
+                              config['num_samples'], config['random_seed'], config['utc_offset'],
+                              config['cache_dir'], config['cache_size_gb'], config['length_bucket'], config['bucket_size'],
+                              config['vocab_size'], config['grid_vocab_size'], config['mask_length'], config['mask_prob'],
+                              pin_memory=device.type == 'cuda', num_replicas=world_size, rank=rank)
+
+    model.train()
+    traj_num = 0
+    for idx, batch in enumerate(DevicePrefetcher(loader, device)):
+        if idx == args.steps + 1:
+            break
+        with autocast(device, config['precision']):
+            loss, _, _ = loss_module(batch)
+        scaler.scale(loss).backward()
+        optimizer_step(model, optimizer, scaler, config['grad_clip'])
+        if idx == 0:
+            # 第一个 batch 作为 warm up 不计时，所有 rank 同时开始计时
+            dist.barrier()
+            st = time.time()
+        else:
+            traj_num += batch.route_data.shape[0] * world_size
+    dist.barrier()
+    if rank == 0:
+        results.put(traj_num / (time.time() - st))
+    dist.destroy_process_group()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config', default='../config/xian.json')
+    parser.add_argument('--steps', type=int, default=20)
+    parser.add_argument('--world_sizes', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--device', default='cpu', choices=['cpu', 'cuda'])
+    parser.add_argument('--threads', type=int, default=8, help='total number of CPU threads shared by all processes')
+    parser.add_argument('--port', type=int, default=29600)
+    args = parser.parse_args()
+    config = json.load(open(args.config, 'r'))
+
+    results = mp.get_context('spawn').SimpleQueue()
+    baseline = None
+    for world_size in args.world_sizes:
+        mp.spawn(worker, args=(world_size, config, args, results), nprocs=world_size)
+        traj_per_sec = results.get()
+        if baseline is None:
+            baseline = traj_per_sec / world_size
+        print('world_size={} | {:.1f} traj/s | speedup {:.2f}x | scaling efficiency {:.1%}'.format(
+            world_size, traj_per_sec, traj_per_sec / baseline, traj_per_sec / (world_size * baseline)))
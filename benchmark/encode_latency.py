@@ -0,0 +1,91 @@
+# MVTraj.encode 在不同 (views, outputs) 组合下每 1k 条轨迹的推理延迟，以 no_grad 下完整的 forward 为基准
+# 不指定 --model_path 时使用按 config 随机初始化的模型（延迟与参数取值无关）
+# Usage (在 benchmark/ 目录下运行):
+#     python encode_latency.py --config ../config/xian.json --data_path ../xian/xian_eval.pkl --num_traj 4096
+#     python encode_latency.py --config ../config/xian.json --data_path ../xian/xian_eval.pkl --model_path ../research/exp/.../xxx.pt --device cpu
+import sys
+sys.path.append("..")
+import time
+import json
+import argparse
+import numpy as np
+import torch
+from MVTraj import MVTraj, QUEUE_VIEWS
+from evluation_utils import prepare_data_from_file, sample_trajectories
+from utils import setup_seed, weight_init, synchronize
+
+# (名称, views, outputs)，views 为 None 时对应 forward
+CONFIGS = [
+    ('forward', None, None),
+    ('all views | traj', QUEUE_VIEWS, ('traj',)),
+    ('all views | road', QUEUE_VIEWS, ('road',)),
+    ('all views | traj+road', QUEUE_VIEWS, ('traj', 'road')),
+    ('route+gps | traj', ('gps', 'route'), ('traj',)),
+    ('route | traj', ('route',), ('traj',)),
+    ('route | road', ('route',), ('road',)),
+]
+
+
+def run(seq_model, batches, views, outputs):
+    if views is None:
+        with torch.no_grad():
+            for batch in batches:
+                seq_model(*batch)
+    else:
+        for batch in batches:
+            seq_model.encode(batch, views, outputs)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config', default='../config/xian.json')
+    parser.add_argument('--data_path', default='../xian/xian_eval.pkl')
+    parser.add_argument('--model_path', default=None)
+    parser.add_argument('--num_traj', type=int, default=4096)
+    parser.add_argument('--batch_size', type=int, default=256)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--device', default='cuda:0' if torch.cuda.is_available() else 'cpu')
+    args = parser.parse_args()
+    config = json.load(open(args.config, 'r'))
+    device = torch.device(args.device)
+
+    setup_seed(config['random_seed'])
+    if args.model_path is None:
+        edge_index = np.load(config['adj_path'])
+        seq_model = MVTraj(config['vocab_size'], config['grid_vocab_size'], config['route_max_len'], config['road_feat_num'],
+                           config['road_embed_size'], config['gps_feat_num'], config['gps_embed_size'], config['route_embed_size'],
+                           config['hidden_size'], edge_index, config['drop_edge_rate'], config['drop_route_rate'],
+                           config['drop_road_rate'], mode='x', queue_size=0).to(device)
+        seq_model.apply(weight_init)
+    else:
+        seq_model = torch.load(args.model_path, map_location=device)['model']
+    seq_model.eval()
+
+    route_data, masked_route_assign_mat, gps_data, masked_gps_assign_mat, route_assign_mat, \
+        grid_data, masked_grid_assign_mat, gps_data_grid, masked_gps_assign_mat_grid, grid_assign_mat, \
+        gps_length, gps_length_grid, dataset, mat_padding_value, mat_padding_value_grid = prepare_data_from_file(
+            args.data_path, config['route_min_len'], config['route_max_len'], config['gps_min_len'], config['gps_max_len'],
+            config['grid_min_len'], config['grid_max_len'], config['utc_offset'], cache_dir=config['cache_dir'],
+            preprocess=sample_trajectories, num_samples=args.num_traj, random_state=0)
+    # 与 downstream_task 中的评估脚本一致
+    seq_model.vocab_size = mat_padding_value
+    seq_model.grid_vocab_size = mat_padding_value_grid
+    tensors = (route_data, masked_route_assign_mat, gps_data, masked_gps_assign_mat, route_assign_mat, gps_length,
+               grid_data, masked_grid_assign_mat, gps_data_grid, masked_gps_assign_mat_grid, grid_assign_mat, gps_length_grid)
+    num_traj = route_data.shape[0]
+    batches = [[item[i:i + args.batch_size].to(device) for item in tensors] for i in range(0, num_traj, args.batch_size)]
+
+    baseline = None
+    for name, views, outputs in CONFIGS:
+        run(seq_model, batches[:1], views, outputs) # warm up
+        latency = []
+        for _ in range(args.repeat):
+            synchronize(device)
+            st = time.time()
+            run(seq_model, batches, views, outputs)
+            synchronize(device)
+            latency.append((time.time() - st) / num_traj * 1000 * 1000)
+        latency = min(latency)
+        if baseline is None:
+            baseline = latency
+        print('{:<22} | {:.1f} ms / 1k traj | {:.2f}x'.format(name, latency, baseline / latency))
@@ -0,0 +1,97 @@
+# 对比 encode_joint_four_stream 中 cross attention 的三种实现：
+#     legacy: 12 个 CrossAttention，逐样本在 CPU 上构造 attn_mask（原实现）
+#     pairwise: 12 个 CrossAttention，广播构造 attn_mask
+#     fused: MultiViewCrossAttention，权重由上面 12 个模块转换得到
+# 并检查 fused 与 pairwise 的输出是否一致。输入为随机生成的表示，不需要数据文件
+# Usage (在 benchmark/ 目录下运行):
+#     python joint_encoder.py --config ../config/xian.json --steps 50
+import sys
+sys.path.append("..")
+import time
+import json
+import argparse
+import torch
+from MVTraj import CrossAttention, MultiViewCrossAttention, CROSS_VIEWS
+
+
+def legacy_build_mask(self, mask_q, mask_k):
+    # 原实现：在 CPU 上逐样本填充 -inf mask，再搬到 device 上
+    batch_size, seq_q = mask_q.shape
+    seq_k = mask_k.shape[1]
+    attn_mask = torch.full((batch_size, seq_q, seq_k), float('-inf'))
+    for b in range(batch_size):
+        attn_mask[b, :, ~mask_k[b].cpu()] = 0
+        attn_mask[b, ~mask_q[b].cpu(), :] = 0
+    attn_mask = attn_mask.to(mask_q.device)
+    num_heads = self.attention.num_heads
+    return attn_mask.unsqueeze(1).expand(-1, num_heads, -1, -1).reshape(batch_size * num_heads, seq_q, seq_k)
+
+
+def random_views(batch_size, hidden_size, max_len, device):
+    # route/gps 与 grid/gps_g 各自共享长度，第0位为cls
+    route_length = torch.randint(10, max_len + 1, (batch_size,), device=device)
+    grid_length = torch.randint(10, max_len + 1, (batch_size,), device=device)
+    position = torch.arange(max_len + 1, device=device).unsqueeze(0)
+    route_mask = position > route_length.unsqueeze(1)
+    grid_mask = position > grid_length.unsqueeze(1)
+    views = [torch.randn(max_len + 1, batch_size, hidden_size, device=device) for _ in CROSS_VIEWS]
+    return views, [route_mask, route_mask, grid_mask, grid_mask]
+
+
+def pairwise_attention(attentions, views, masks):
+    outputs = []
+    for query_view, query_name in enumerate(CROSS_VIEWS):
+        output = 0
+        for key_view in MultiViewCrossAttention.others(query_view, len(CROSS_VIEWS)):
+            attention = attentions['cross_attn_{}_to_{}'.format(query_name, CROSS_VIEWS[key_view])]
+            output = output + attention(views[query_view], views[key_view], views[key_view], masks[query_view], masks[key_view])
+        outputs.append(output)
+    return outputs
+
+
+def synchronize(device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+
+
+def time_it(fn, steps, device):
+    fn()
+    synchronize(device)
+    st = time.time()
+    for _ in range(steps):
+        fn()
+    synchronize(device)
+    return (time.time() - st) / steps * 1000
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config', default='../config/xian.json')
+    parser.add_argument('--steps', type=int, default=50)
+    args = parser.parse_args()
+    config = json.load(open(args.config, 'r'))
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    hidden_size = config['hidden_size']
+
+    attentions = {}
+    for query_view, query_name in enumerate(CROSS_VIEWS):
+        for key_view in MultiViewCrossAttention.others(query_view, len(CROSS_VIEWS)):
+            attentions['cross_attn_{}_to_{}'.format(query_name, CROSS_VIEWS[key_view])] = CrossAttention(hidden_size, 8).to(device).eval()
+    fused = MultiViewCrossAttention.from_cross_attention(
+        {name: attention.attention for name, attention in attentions.items()}).eval()
+    views, masks = random_views(config['batch_size'], hidden_size, config['route_max_len'] - 1, device)
+
+    vectorized_build_mask = CrossAttention.build_mask
+    with torch.no_grad():
+        # 只比较有效位置，padding 的 query 在 encode_joint_four_stream 中会被丢弃
+        padding = [mask.t().unsqueeze(-1) for mask in masks]
+        diff = max((a - b).abs().masked_fill(m, 0).max().item()
+                   for a, b, m in zip(pairwise_attention(attentions, views, masks), fused(views, masks), padding))
+        print('max abs diff between pairwise and fused: {:.2e}'.format(diff))
+
+        CrossAttention.build_mask = legacy_build_mask
+        legacy_ms = time_it(lambda: pairwise_attention(attentions, views, masks), args.steps, device)
+        CrossAttention.build_mask = vectorized_build_mask
+        pairwise_ms = time_it(lambda: pairwise_attention(attentions, views, masks), args.steps, device)
+        fused_ms = time_it(lambda: fused(views, masks), args.steps, device)
+    print('legacy: {:.2f} ms | pairwise: {:.2f} ms | fused: {:.2f} ms'.format(legacy_ms, pairwise_ms, fused_ms))
@@ -0,0 +1,77 @@
+# 对比顺序 DataLoader 与按长度分桶 + 截断的 DataLoader 的 padding 比例和吞吐
+# Usage (在 benchmark/ 目录下运行):
+#     python length_bucket.py --config ../config/xian.json --steps 50 [--device cpu]
+import sys
+sys.path.append("..")
+import time
+import json
+import argparse
+import numpy as np
+import torch
+from dataloader import get_train_loader
+from MVTraj import MVTraj
+from utils import synchronize
+
+
+def padding_stats(batch, mat_padding_value, mat_padding_value_grid):
+    # 返回 batch 中 (有效 token 数, 总 token 数)，gps 点、路段、grid 三种序列合计
+    gps_data, gps_assign_mat, route_data, route_assign_mat, \
+    gps_data_grid, gps_assign_mat_grid, grid_data, grid_assign_mat, \
+    gps_length, gps_length_grid = batch
+    real = (gps_assign_mat != mat_padding_value).sum().item() + (route_assign_mat != mat_padding_value).sum().item() + \
+           (gps_assign_mat_grid != mat_padding_value_grid).sum().item() + (grid_assign_mat != mat_padding_value_grid).sum().item()
+    total = gps_assign_mat.numel() + route_assign_mat.numel() + gps_assign_mat_grid.numel() + grid_assign_mat.numel()
+    return real, total
+
+
+def run(model, loader, steps, device):
+    dataset = loader.dataset
+    real_tokens, total_tokens, elapsed = 0, 0, 0.
+    for idx, batch in enumerate(loader):
+        if idx == steps:
+            break
+        real, total = padding_stats(batch, dataset.mat_padding_value, dataset.mat_padding_value_grid)
+        real_tokens += real
+        total_tokens += total
+
+        gps_data, gps_assign_mat, route_data, route_assign_mat, \
+        gps_data_grid, gps_assign_mat_grid, grid_data, grid_assign_mat, \
+        gps_length, gps_length_grid = [data.to(device) for data in batch]
+
+        synchronize(device)
+        st = time.time()
+        outputs = model(route_data, route_assign_mat, gps_data, gps_assign_mat, route_assign_mat, gps_length,
+                        grid_data, grid_assign_mat, gps_data_grid, gps_assign_mat_grid, grid_assign_mat, gps_length_grid)
+        loss = sum(rep.sum() for rep in outputs[8:12])
+        model.zero_grad()
+        loss.backward()
+        synchronize(device)
+        elapsed += time.time() - st
+
+    return 1 - real_tokens / total_tokens, real_tokens / elapsed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config', default='../config/xian.json')
+    parser.add_argument('--steps', type=int, default=50)
+    parser.add_argument('--device', default='cuda:0')
+    args = parser.parse_args()
+    config = json.load(open(args.config, 'r'))
+
+    edge_index = np.load(config['adj_path'])
+    model = MVTraj(config['vocab_size'], config['grid_vocab_size'], config['route_max_len'], config['road_feat_num'],
+                   config['road_embed_size'], config['gps_feat_num'], config['gps_embed_size'], config['route_embed_size'],
+                   config['hidden_size'], edge_index, config['drop_edge_rate'], config['drop_route_rate'],
+                   config['drop_road_rate'], mode='x').to(args.device)
+    model.train()
+
+    for length_bucket in [False, True]:
+        loader = get_train_loader(config['data_path'], config['batch_size'], config['num_worker'],
+                                  config['route_min_len'], config['route_max_len'], config['gps_min_len'],
+                                  config['gps_max_len'], config['grid_min_len'], config['grid_max_len'],
+                                  config['num_samples'], config['random_seed'], config['utc_offset'],
+                                  config['cache_dir'], config['cache_size_gb'], length_bucket, config['bucket_size'])
+        padding_ratio, tokens_per_sec = run(model, loader, args.steps, args.device)
+        print('length_bucket={} | padding ratio: {:.2%} | tokens/sec: {:.0f}'.format(
+            length_bucket, padding_ratio, tokens_per_sec))
@@ -0,0 +1,92 @@
+# 对比 fp32 与混合精度 (fp16 / bf16) 预训练的吞吐、显存峰值和 loss
+# 每种精度从相同的初始参数出发，在相同的 batch 上跑 steps 个 batch（第一个 batch 作为 warm up 不计时）
+# Usage (在 benchmark/ 目录下运行):
+#     python precision.py --config ../config/xian.json --steps 50 --precisions fp32 fp16 --accum_steps 1
+#     python precision.py --config ../config/xian.json --steps 20 --precisions fp32 bf16 --device cpu
+import sys
+sys.path.append("..")
+import copy
+import time
+import json
+import argparse
+import numpy as np
+import torch
+from transformers import AdamW
+from dataloader import get_train_loader, DevicePrefetcher
+from MVTraj import MVTraj
+from model_train import get_pretrain_loss, optimizer_step
+from utils import setup_seed, weight_init, autocast, make_grad_scaler, synchronize, reset_peak_memory, peak_memory_mb
+
+
+def run(model, loader, config, precision, steps, accum_steps, device):
+    optimizer = AdamW(model.parameters(), lr=config['learning_rate'], weight_decay=config['weight_decay'])
+    scaler = make_grad_scaler(device, precision)
+    model.train()
+    optimizer.zero_grad()
+    reset_peak_memory(device)
+
+    traj_num, elapsed, losses, skipped = 0, 0., [], 0
+    for idx, batch in enumerate(DevicePrefetcher(loader, device)):
+        if idx == steps + 1:
+            break
+        synchronize(device)
+        st = time.time()
+        with autocast(device, precision):
+            loss, _, _ = get_pretrain_loss(model, batch, config['match_hard_k'])
+        scaler.scale(loss / accum_steps).backward()
+        if not (idx + 1) % accum_steps:
+            scale = scaler.get_scale() if scaler.is_enabled() else None
+            optimizer_step(model, optimizer, scaler, config['grad_clip'])
+            # fp16 下 scale 变小说明这一步因梯度 inf/nan 被跳过
+            skipped += int(scale is not None and scaler.get_scale() < scale)
+        synchronize(device)
+        if idx > 0:
+            elapsed += time.time() - st
+            traj_num += batch.route_data.shape[0]
+            losses.append(loss.item())
+
+    return traj_num / elapsed, peak_memory_mb(device), np.mean(losses), skipped
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config', default='../config/xian.json')
+    parser.add_argument('--steps', type=int, default=50)
+    parser.add_argument('--precisions', nargs='+', default=['fp32', 'fp16', 'bf16'])
+    parser.add_argument('--accum_steps', type=int, default=1)
+    parser.add_argument('--device', default='cuda:0')
+    args = parser.parse_args()
+    config = json.load(open(args.config, 'r'))
+    device = torch.device(args.device)
+
+    setup_seed(config['random_seed'])
+    edge_index = np.load(config['adj_path'])
+    init_model = MVTraj(config['vocab_size'], config['grid_vocab_size'], config['route_max_len'], config['road_feat_num'],
+                        config['road_embed_size'], config['gps_feat_num'], config['gps_embed_size'], config['route_embed_size'],
+                        config['hidden_size'], edge_index, config['drop_edge_rate'], config['drop_route_rate'],
+                        config['drop_road_rate'], mode='x', mlm_num_sampled=config['mlm_num_sampled'], queue_size=0).to(device)
+    init_model.apply(weight_init)
+
+    loader = get_train_loader(config['data_path'], config['batch_size'], config['num_worker'],
+                              config['route_min_len'], config['route_max_len'], config['gps_min_len'],
+                              config['gps_max_len'], config['grid_min_len'], config['grid_max_len'],
+                              config['num_samples'], config['random_seed'], config['utc_offset'],
+                              config['cache_dir'], config['cache_size_gb'], config['length_bucket'], config['bucket_size'],
+                              config['vocab_size'], config['grid_vocab_size'], config['mask_length'], config['mask_prob'],
+                              pin_memory=device.type == 'cuda')
+
+    baseline = None
+    for precision in args.precisions:
+        try:
+            autocast(device, precision)
+        except ValueError as e:
+            print('precision={} | skipped: {}'.format(precision, e))
+            continue
+        # 相同的初始参数和 batch 顺序
+        setup_seed(config['random_seed'])
+        traj_per_sec, max_memory, mean_loss, skipped = run(copy.deepcopy(init_model), loader, config, precision,
+                                                           args.steps, args.accum_steps, device)
+        if baseline is None:
+            baseline = (traj_per_sec, max_memory)
+        print('precision={} | {:.1f} traj/s ({:.2f}x) | max memory {:.0f} MB ({:.2f}x) | mean loss {:.4f} | skipped steps {}'.format(
+            precision, traj_per_sec, traj_per_sec / baseline[0], max_memory, max_memory / baseline[1], mean_loss, skipped))
@@ -1,6 +1,7 @@
 import torch
 import torch.nn.functional as F
 import torch.nn as nn
+import torch.distributed as dist
 from SupConLoss import SupConLoss
 # from sklearn.cluster import KMeans
 from kmeans_pytorch import kmeans
@@ -34,7 +35,7 @@ def get_traj_cluster_loss(gps_traj_rep, route_traj_rep, device, tau=0.07, n_clus
         X=data, num_clusters=n_clusters, distance='euclidean', device=device
     )
 
-    cluster_centers = cluster_centers.cuda()
+    cluster_centers = cluster_centers.to(data.device)
     # 计算 GPS 轨迹和聚类中心之间的相似度矩阵
     gps_cluster_sim = torch.mm(gps_traj_rep, cluster_centers.t())
     # 计算路线规划和聚类中心之间的相似度矩阵
@@ -49,13 +50,13 @@ def get_traj_cluster_loss(gps_traj_rep, route_traj_rep, device, tau=0.07, n_clus
     traj_cluster_loss = traj_cluster_loss.mean()
     return traj_cluster_loss
 
-def get_road_cluster_loss(gps_road_rep, route_road_rep, tau=0.07, n_clusters=64, dev_id=0):
+def get_road_cluster_loss(gps_road_rep, route_road_rep, tau=0.07, n_clusters=64):
     data = torch.cat([gps_road_rep, route_road_rep], dim=0)
     cluster_ids_x, cluster_centers = kmeans(
-        X=data, num_clusters=n_clusters, distance='euclidean', device=torch.device('cuda:{}'.format(dev_id)), tqdm_flag=False
+        X=data, num_clusters=n_clusters, distance='euclidean', device=data.device, tqdm_flag=False
     )
 
-    cluster_centers = cluster_centers.cuda()
+    cluster_centers = cluster_centers.to(data.device)
     # 计算 GPS 轨迹和聚类中心之间的相似度矩阵
     gps_cluster_sim = torch.mm(gps_road_rep, cluster_centers.t())
     # 计算路线规划和聚类中心之间的相似度矩阵
@@ -70,36 +71,60 @@ def get_road_cluster_loss(gps_road_rep, route_road_rep, tau=0.07, n_clusters=64,
     road_cluster_loss = road_cluster_loss.mean()
     return road_cluster_loss
 
-def get_traj_match_loss(gps_traj_rep, route_traj_rep, model, batch_size=64, tau=0.07):
+def sample_negative(sim, hard_negative_k=0):
+    """
+    sim: (batch_size, num_candidates) 相似度 / tau，前 batch_size 列为当前 batch，对角线为正样本
+    hard_negative_k = 0: 按 softmax(sim) 为每一行采样一个负样本（与原实现相同，按行整体一次 multinomial）
+    hard_negative_k > 0: 在除正样本外最相似的 k 个候选中均匀采样
+    """
+    sim = sim.detach()
+    if hard_negative_k <= 0:
+        return torch.multinomial(F.softmax(sim, dim=1), 1).squeeze(1)
+
+    batch_size = sim.shape[0]
+    sim = sim.clone()
+    sim[:, :batch_size].fill_diagonal_(float('-inf'))
+    k = min(hard_negative_k, sim.shape[1] - 1)
+    topk_idx = sim.topk(k, dim=1)[1] # (batch_size, k)
+    choice = torch.randint(k, (batch_size, 1), device=sim.device)
+    return topk_idx.gather(1, choice).squeeze(1)
+
+def gather_traj_rep(traj_rep):
+    """
+    DDP 训练时收集所有 rank 的轨迹表示 (不回传梯度)，作为 matching loss 额外的负样本候选，单进程时原样返回
+
+    Returns:
+        others: 其他 rank 的表示 (batch_size * (world_size - 1), hidden_size)
+        gathered: 按 rank 顺序拼接的全部表示 (batch_size * world_size, hidden_size)，所有 rank 上相同，用于写入负样本队列
+    """
+    if not dist.is_available() or not dist.is_initialized() or dist.get_world_size() == 1:
+        return traj_rep[:0].detach().float(), traj_rep
+    traj_rep = traj_rep.detach().float().contiguous()
+    gathered = [torch.empty_like(traj_rep) for _ in range(dist.get_world_size())]
+    dist.all_gather(gathered, traj_rep)
+    rank = dist.get_rank()
+    return torch.cat(gathered[:rank] + gathered[rank + 1:], dim=0), torch.cat(gathered, dim=0)
+
+def get_traj_match_loss(gps_traj_rep, route_traj_rep, model, batch_size=64, tau=0.07, hard_negative_k=0, queue=None):
+    """
+    queue: (gps_queue, route_queue)，各为 (num, hidden_size) 且已 normalize 的表示，与当前 batch 一起作为负样本的候选：
+    之前 batch 的表示（见 MVTraj.queued）以及 DDP 训练时其他 rank 的表示（见 gather_traj_rep）
+    """
     gps_traj_rep = F.normalize(gps_traj_rep, dim=1)
     route_traj_rep = F.normalize(route_traj_rep, dim=1)
+    batch_size = gps_traj_rep.shape[0]
 
-    # gps_traj_all = torch.cat([gps_traj_rep.t(), model.gps_queue.clone().detach()], dim=1) # 256 x 2048+64
-    # route_traj_all = torch.cat([route_traj_rep.t(), model.route_queue.clone().detach()], dim=1)
+    gps_traj_all, route_traj_all = gps_traj_rep, route_traj_rep
+    if queue is not None:
+        gps_traj_all = torch.cat([gps_traj_rep, queue[0].detach().type_as(gps_traj_rep)], dim=0)
+        route_traj_all = torch.cat([route_traj_rep, queue[1].detach().type_as(route_traj_rep)], dim=0)
 
-    sim_g2r = gps_traj_rep @ route_traj_rep.t() / tau
-    sim_r2g = route_traj_rep @ gps_traj_rep.t() / tau
-
-    weight_g2r = F.softmax(sim_g2r, dim=1)
-    weight_r2g = F.softmax(sim_r2g, dim=1)
-
-    sim_g2r.fill_diagonal_(0)
-    sim_r2g.fill_diagonal_(0)
-
-    # select a negative route for each gps
-    route_traj_rep_neg = []
-    for i in range(batch_size):
-        neg_idx = torch.multinomial(weight_g2r[i], 1).item()
-        route_traj_rep_neg.append(route_traj_rep[neg_idx])
-    route_traj_rep_neg = torch.stack(route_traj_rep_neg, dim=0)
-
-    # select a negative gps for each route
-    gps_traj_rep_neg = []
-    for i in range(batch_size):
-        neg_idx = torch.multinomial(weight_r2g[i], 1).item()
-        gps_traj_rep_neg.append(gps_traj_rep[neg_idx])
-    gps_traj_rep_neg = torch.stack(gps_traj_rep_neg, dim=0)
+    sim_g2r = gps_traj_rep @ route_traj_all.t() / tau
+    sim_r2g = route_traj_rep @ gps_traj_all.t() / tau
 
+    # select a negative route for each gps / a negative gps for each route，整个 batch 一次采样，不需要逐行同步
+    route_traj_rep_neg = route_traj_all[sample_negative(sim_g2r, hard_negative_k)]
+    gps_traj_rep_neg = gps_traj_all[sample_negative(sim_r2g, hard_negative_k)]
 
     # 每一个GR pair都有两个负样本 GR’ 和 G‘R，flat之后分为3组，GR,GR',G'R 64*3 x 256
 
@@ -111,8 +136,6 @@ def get_traj_match_loss(gps_traj_rep, route_traj_rep, model, batch_size=64, tau=
 
     pred = model.matching_predictor(all_pair) # 2 x 64*3
 
-    label = torch.cat([torch.ones(batch_size, dtype=torch.long), torch.zeros(2 * batch_size, dtype=torch.long)],dim=0).cuda() # 1 x 64*3
+    label = torch.cat([torch.ones(batch_size, dtype=torch.long), torch.zeros(2 * batch_size, dtype=torch.long)],dim=0).to(pred.device) # 1 x 64*3
     loss = F.cross_entropy(pred, label)
     return loss
-
-
@@ -0,0 +1,199 @@
+#!/usr/bin/python
+# 预处理结果的磁盘缓存
+# StaticDataset / prepare_data 得到的 tensor 按 (数据文件的路径/大小/修改时间, 预处理参数) 的哈希保存，
+# 再次运行时用 mmap 直接加载，不需要重新 unpickle 和 padding
+#
+# Usage:
+#     python data_cache.py list --cache_dir research/cache/
+#     python data_cache.py invalidate xian_train.pkl --cache_dir research/cache/
+#     python data_cache.py clear --cache_dir research/cache/
+import os
+import json
+import time
+import shutil
+import pickle
+import hashlib
+import argparse
+
+import numpy as np
+import torch
+
+# 预处理逻辑变化时加1，使旧的缓存失效
+CACHE_VERSION = 2
+META_FILE = 'meta.json'
+OBJECT_FILE = 'objects.pkl'
+
+
+def fingerprint(path):
+    # 数据文件（或列式存储目录中每个文件）的 (绝对路径, 大小, 修改时间)，不读取文件内容，命中缓存时不需要扫描整个数据文件
+    path = os.path.abspath(path)
+    if os.path.isdir(path):
+        paths = [os.path.join(path, name) for name in sorted(os.listdir(path))]
+    else:
+        paths = [path]
+    return [(file_path, os.stat(file_path).st_size, os.stat(file_path).st_mtime_ns) for file_path in paths]
+
+
+class TensorCache(object):
+    """
+    以目录为单位的缓存，每个 entry 为 <cache_dir>/<key>/
+        meta.json: 数据来源、参数、最近一次使用时间
+        <name>.npy: tensor，加载时 mmap (copy-on-write)
+        objects.pkl: 其他对象，如 DataFrame、padding id
+
+    超过 max_size_gb 时按最近使用时间淘汰 (LRU)
+    """
+    def __init__(self, cache_dir, max_size_gb=20):
+        self.cache_dir = cache_dir
+        self.max_size = max_size_gb * (1 << 30)
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+
+    def key(self, data_path, params):
+        content = json.dumps({'version': CACHE_VERSION, 'source': fingerprint(data_path), 'params': params},
+                             sort_keys=True, default=str)
+        return hashlib.sha1(content.encode('utf-8')).hexdigest()
+
+    def _entry(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    def _read_meta(self, key):
+        with open(os.path.join(self._entry(key), META_FILE), 'r') as f:
+            return json.load(f)
+
+    def _write_meta(self, entry, meta):
+        # 先写临时文件再 os.replace，多个进程同时更新 last_used 时 meta.json 始终是完整的
+        tmp_path = os.path.join(entry, '{}.tmp{}'.format(META_FILE, os.getpid()))
+        with open(tmp_path, 'w') as f:
+            json.dump(meta, f)
+        os.replace(tmp_path, os.path.join(entry, META_FILE))
+
+    def _last_used(self, key):
+        # 无法读取的 entry 最先被淘汰
+        try:
+            return self._read_meta(key)['last_used']
+        except (OSError, ValueError, KeyError):
+            return 0
+
+    def keys(self):
+        return [key for key in os.listdir(self.cache_dir)
+                if os.path.exists(os.path.join(self._entry(key), META_FILE))]
+
+    def load(self, key):
+        entry = self._entry(key)
+        if not os.path.exists(os.path.join(entry, META_FILE)):
+            return None
+        try:
+            meta = self._read_meta(key)
+            items = {}
+            for name in meta['tensors']:
+                items[name] = torch.from_numpy(np.load(os.path.join(entry, '{}.npy'.format(name)), mmap_mode='c'))
+            if meta['objects']:
+                items.update(pickle.load(open(os.path.join(entry, OBJECT_FILE), 'rb')))
+        except (OSError, ValueError, KeyError, EOFError, pickle.UnpicklingError):
+            # 损坏的 entry 当作未命中，删除后重新预处理
+            print('cache entry {} is unreadable, rebuilding'.format(entry))
+            self.invalidate(key)
+            return None
+
+        meta['last_used'] = time.time()
+        self._write_meta(entry, meta)
+        return items
+
+    def save(self, key, items, data_path=None, params=None):
+        entry = self._entry(key)
+        tmp_entry = '{}.tmp{}'.format(entry, os.getpid())
+        if os.path.exists(tmp_entry):
+            shutil.rmtree(tmp_entry)
+        os.makedirs(tmp_entry)
+
+        tensors = [name for name, item in items.items() if isinstance(item, torch.Tensor)]
+        objects = {name: item for name, item in items.items() if not isinstance(item, torch.Tensor)}
+        for name in tensors:
+            np.save(os.path.join(tmp_entry, '{}.npy'.format(name)), items[name].numpy())
+        if objects:
+            pickle.dump(objects, open(os.path.join(tmp_entry, OBJECT_FILE), 'wb'))
+
+        self._write_meta(tmp_entry, {'source': data_path, 'params': params, 'tensors': tensors,
+                                     'objects': list(objects.keys()), 'last_used': time.time()})
+        # 写完后再 rename，中断的写入不会被当作有效缓存；其他进程已经写好同一个 entry 时 rename 失败，保留已有的 entry
+        try:
+            os.rename(tmp_entry, entry)
+        except OSError:
+            shutil.rmtree(tmp_entry, ignore_errors=True)
+        self.evict(keep=key)
+
+    def size(self, key):
+        entry = self._entry(key)
+        return sum(os.path.getsize(os.path.join(entry, name)) for name in os.listdir(entry))
+
+    def evict(self, keep=None):
+        entries = sorted(self.keys(), key=self._last_used)
+        total = sum(self.size(key) for key in entries)
+        for key in entries:
+            if total <= self.max_size:
+                break
+            if key == keep:
+                continue
+            total -= self.size(key)
+            self.invalidate(key)
+
+    def invalidate(self, key):
+        shutil.rmtree(self._entry(key), ignore_errors=True)
+
+    def invalidate_source(self, data_path):
+        # 删除由某个数据文件生成的全部缓存
+        data_path = os.path.abspath(data_path)
+        removed = [key for key in self.keys() if self._read_meta(key)['source'] == data_path]
+        for key in removed:
+            self.invalidate(key)
+        return removed
+
+    def clear(self):
+        for key in self.keys():
+            self.invalidate(key)
+
+
+def cached_call(cache_dir, data_path, params, build_fn, max_size_gb=20):
+    """
+    Args:
+        cache_dir: 缓存目录，为 None 时不使用缓存
+        data_path: 原始数据文件，其 (绝对路径, 大小, 修改时间) 是 cache key 的一部分，
+            原地改写后大小和修改时间都不变的文件不会被识别，需要手动 invalidate
+        params: 影响预处理结果的参数（长度过滤、采样数量、随机种子等）
+        build_fn: 无缓存时调用，返回 dict{name: tensor 或其他可 pickle 的对象}
+
+    Returns:
+        dict{name: item}
+    """
+    if cache_dir is None:
+        return build_fn()
+    cache = TensorCache(cache_dir, max_size_gb)
+    key = cache.key(data_path, params)
+    items = cache.load(key)
+    if items is None:
+        items = build_fn()
+        cache.save(key, items, os.path.abspath(data_path), params)
+        print('preprocessed data cached in {}'.format(os.path.join(cache_dir, key)))
+    else:
+        print('load preprocessed data from {}'.format(os.path.join(cache_dir, key)))
+    return items
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='manage the preprocessed tensor cache')
+    parser.add_argument('command', choices=['list', 'invalidate', 'clear'])
+    parser.add_argument('data_path', nargs='?', help='invalidate all entries built from this data file')
+    parser.add_argument('--cache_dir', default='research/cache/')
+    args = parser.parse_args()
+
+    cache = TensorCache(args.cache_dir)
+    if args.command == 'list':
+        for key in cache.keys():
+            meta = cache._read_meta(key)
+            print('{} | {:.1f} MB | {} | {}'.format(key, cache.size(key) / (1 << 20), meta['source'], meta['params']))
+    elif args.command == 'invalidate':
+        assert args.data_path is not None, 'data_path is required for invalidate'
+        print('removed {} entries'.format(len(cache.invalidate_source(args.data_path))))
+    else:
+        cache.clear()
@@ -1,78 +1,171 @@
 #!/usr/bin/python
 import os
+from collections import namedtuple
 
 import numpy as np
 import torch
 import warnings
-from datetime import datetime
 from tqdm import tqdm
 warnings.filterwarnings('ignore')
-from torch.utils.data import DataLoader, Dataset
-import torch.nn.utils.rnn as rnn_utils
+from torch.utils.data import DataLoader, Dataset, Sampler
+from torch.utils.data.distributed import DistributedSampler
+from torch.utils.data.dataloader import default_collate
 import pickle
 import pandas as pd
 import json
+from traj_store import load_trajectories, trajectory_lengths, column_max, take_rows, ragged_arrays
+from data_cache import cached_call
 
-def extract_weekday_and_minute_from_list(timestamp_list):
-    weekday_list = []
-    minute_list = []
-    for timestamp in timestamp_list:
-        dt = datetime.fromtimestamp(timestamp)
-        weekday = dt.weekday() + 1
-        minute = dt.hour * 60 + dt.minute + 1
-        weekday_list.append(weekday)
-        minute_list.append(minute)
-    return torch.tensor(weekday_list).long(), torch.tensor(minute_list).long()
-
-def prepare_gps_data(df,mat_padding_value,data_padding_value,max_len):
+UTC_OFFSET = 8 # 西安、成都均为 UTC+8，单位小时
+
+def decode_weekday_and_minute(timestamps, utc_offset=UTC_OFFSET):
     """
+    向量化的时间戳解码，用整数运算代替逐个 datetime.fromtimestamp，结果与城市所在时区下的 datetime 一致
 
     Args:
-        df: cpath_list,
-        mat_padding_value: default num_nodes
-        data_padding_value: default 0
+        timestamps: (n,) unix 时间戳，单位秒
+        utc_offset: 城市所在时区相对 UTC 的偏移，单位小时
 
     Returns:
-        gps_data: (batch, gps_max_length, num_features)
-        gps_assign_mat: (batch, gps_max_length)
+        weekday: (n,) 1~7，周一为1
+        minute: (n,) 1~1440，一天中的第几分钟
 
     """
+    local = np.floor(np.asarray(timestamps, dtype=np.float64)).astype(np.int64) + int(utc_offset * 3600)
+    days = np.floor_divide(local, 86400)
+    weekday = (days + 3) % 7 + 1 # 1970-01-01 是周四
+    minute = (local - days * 86400) // 60 + 1
+    return weekday, minute
 
-    # padding opath_list
-    opath_list = [torch.tensor(opath_list, dtype=torch.float32) for opath_list in df['opath_list']]
-    gps_assign_mat = rnn_utils.pad_sequence(opath_list, padding_value=mat_padding_value,
-                                                               batch_first=True)
-    # padding gps point data
-    data_package = []
-    for col in df.drop(columns='opath_list').columns:
-        features = df[col].tolist()
-        features = [torch.tensor(f, dtype=torch.float32) for f in features]
-        features = rnn_utils.pad_sequence(features, padding_value=float('nan'), batch_first=True)
-        features = features.unsqueeze(dim=2)
-        data_package.append(features)
+def extract_weekday_and_minute_from_list(timestamp_list, utc_offset=UTC_OFFSET):
+    weekday, minute = decode_weekday_and_minute(timestamp_list, utc_offset)
+    return torch.from_numpy(weekday).long(), torch.from_numpy(minute).long()
 
-    gps_data = torch.cat(data_package, dim=2)
+def pad_ragged(values, lengths, padding_value, max_len=None):
+    """
+    把拼接后的变长序列一次 scatter 成 padding 后的 tensor，等价于逐条 torch.tensor 后 pad_sequence(batch_first=True)
 
+    Args:
+        values: (total_len, ...) 所有序列拼接后的值
+        lengths: (batch,) 每条序列的长度
+        padding_value: padding 位置填充的值
+        max_len: padding 后的长度, 默认为最长序列的长度
 
-    # todo 临时处理的方式, 把时间戳那维特征置1
-    gps_data[:, :, 0] = torch.ones_like(gps_data[:, :, 0])
+    Returns:
+        padded: (batch, max_len, ...)
+
+    """
+    lengths = torch.as_tensor(lengths, dtype=torch.long, device=values.device)
+    if max_len is None:
+        max_len = int(lengths.max()) if lengths.numel() > 0 else 0
+    padded = values.new_full((lengths.shape[0], max_len) + tuple(values.shape[1:]), padding_value)
+
+    # 每个值所在的行号，以及在行内的位置
+    row_idx = torch.repeat_interleave(torch.arange(lengths.shape[0], device=values.device), lengths)
+    starts = torch.cumsum(lengths, dim=0) - lengths
+    pos_idx = torch.arange(values.shape[0], device=values.device) - torch.repeat_interleave(starts, lengths)
+    padded[row_idx, pos_idx] = values
+    return padded
+
+def standardize_features(values, feature_stats=None):
+    """
+    对每一维特征做标准化，nan（没有前置节点无法计算的特征）不参与 mean 与 std 的计算，一次 masked reduction 得到所有特征的统计量
+
+    Args:
+        values: (total_len, num_features)
+        feature_stats: (mean, std)，为 None 时使用 values 自身的统计量
+
+    Returns:
+        values: (total_len, num_features)，nan 保持为 nan
+
+    """
+    if feature_stats is not None:
+        mean, std = feature_stats
+        return (values - torch.as_tensor(mean, dtype=values.dtype)) / torch.as_tensor(std, dtype=values.dtype)
+    valid = torch.isnan(values).logical_not()
+    count = valid.sum(dim=0)
+    zeros = torch.zeros_like(values)
+    mean = torch.where(valid, values, zeros).sum(dim=0) / count
+    var = (torch.where(valid, values - mean, zeros) ** 2).sum(dim=0) / (count - 1) # 与 torch.std 一致，无偏估计
+    return (values - mean) / torch.sqrt(var)
+
+# prepare_gps_features 中做标准化的 gps 特征（第一维 tm_list 不做标准化）
+GPS_STANDARDIZED_COLUMNS = ('lng_list', 'lat_list', 'speed', 'acceleration', 'angle_delta', 'interval', 'dist')
+
+def gps_feature_stats(dataset, columns=GPS_STANDARDIZED_COLUMNS, chunk_size=1 << 22):
+    """
+    整个数据集上 gps 特征的 (mean, std)，与 standardize_features 的计算方式一致（忽略 nan，无偏估计）
+    按 chunk_size 个 gps 点分块扫描 flat 数组，逐块用 Chan 的公式合并，列式存储时只 mmap 不整体加载
+
+    Returns:
+        mean: (num_features,) float32
+        std: (num_features,) float32
+    """
+    mean, std = [], []
+    for col in columns:
+        values, _ = ragged_arrays(dataset[col])
+        count, col_mean, m2 = 0, 0.0, 0.0
+        for start in range(0, len(values), chunk_size):
+            chunk = np.asarray(values[start:start + chunk_size], dtype=np.float64)
+            chunk = chunk[~np.isnan(chunk)]
+            if len(chunk) == 0:
+                continue
+            chunk_mean = chunk.mean()
+            chunk_m2 = ((chunk - chunk_mean) ** 2).sum()
+            total = count + len(chunk)
+            delta = chunk_mean - col_mean
+            m2 += chunk_m2 + delta ** 2 * count * len(chunk) / total
+            col_mean += delta * len(chunk) / total
+            count = total
+        mean.append(col_mean)
+        std.append(np.sqrt(m2 / (count - 1)))
+    return np.asarray(mean, dtype=np.float32), np.asarray(std, dtype=np.float32)
+
+def prepare_gps_features(df, assign_col, mat_padding_value, data_padding_value, max_len, feature_stats=None):
+    """
+    prepare_gps_data 和 prepare_gps_data_grid 的公共实现
+
+    Args:
+        df: assign_col 以及 gps 点的特征列，DataFrame 或 TrajFrame
+        assign_col: opath_list 或 ogrid_list，表示 gps 点属于哪个路段/栅格
+        mat_padding_value: default num_nodes
+        data_padding_value: default 0
+        feature_stats: gps_feature_stats 的结果，为 None 时在 df 内标准化
+
+    Returns:
+        gps_data: (batch, gps_max_length, num_features)
+        gps_assign_mat: (batch, gps_max_length)
+
+    """
+    # padding assign list
+    assign_values, assign_lengths = ragged_arrays(df[assign_col])
+    gps_assign_mat = pad_ragged(torch.as_tensor(assign_values, dtype=torch.float32), assign_lengths, mat_padding_value)
+
+    # 所有特征列拼成 (total_len, num_features)，统一标准化后一次 padding
+    feature_values = []
+    for col in [col for col in df.columns if col != assign_col]:
+        values, lengths = ragged_arrays(df[col])
+        assert np.array_equal(lengths, assign_lengths), 'gps feature {} is not aligned with {}'.format(col, assign_col)
+        feature_values.append(torch.as_tensor(np.asarray(values, dtype=np.float32)))
+    feature_values = torch.stack(feature_values, dim=1)
 
     # 对除第一维特征进行标准化
-    for i in range(1, gps_data.shape[2]):
-        fea = gps_data[:, :, i]
-        nozero_fea = torch.masked_select(fea, torch.isnan(fea).logical_not())  # 计算不为nan的值的fea的mean与std
-        gps_data[:, :, i] = (gps_data[:, :, i] - torch.mean(nozero_fea)) / torch.std(nozero_fea)
+    feature_values[:, 1:] = standardize_features(feature_values[:, 1:], feature_stats)
 
     # 把因为数据没有前置节点因此无法计算，加速度等特征的nan置0
-    gps_data = torch.where(torch.isnan(gps_data), torch.full_like(gps_data, data_padding_value), gps_data)
+    feature_values = torch.where(torch.isnan(feature_values), torch.full_like(feature_values, data_padding_value), feature_values)
+    gps_data = pad_ragged(feature_values, assign_lengths, data_padding_value)
+
+    # todo 临时处理的方式, 把时间戳那维特征置1（包括 padding 位）
+    gps_data[:, :, 0] = torch.ones_like(gps_data[:, :, 0])
 
     return gps_data, gps_assign_mat
 
-def prepare_gps_data_grid(df,mat_padding_value_grid,data_padding_value_grid,max_len):
+def prepare_gps_data(df,mat_padding_value,data_padding_value,max_len,feature_stats=None):
     """
 
     Args:
-        df: cgrid_list,
+        df: opath_list and gps features,
         mat_padding_value: default num_nodes
         data_padding_value: default 0
 
@@ -81,43 +174,62 @@ def prepare_gps_data_grid(df,mat_padding_value_grid,data_padding_value_grid,max_
         gps_assign_mat: (batch, gps_max_length)
 
     """
+    return prepare_gps_features(df, 'opath_list', mat_padding_value, data_padding_value, max_len, feature_stats)
 
-    # padding opath_list
-    ogrid_list = [torch.tensor(opath_list, dtype=torch.float32) for opath_list in df['ogrid_list']]
-    gps_assign_mat = rnn_utils.pad_sequence(ogrid_list, padding_value=mat_padding_value_grid,
-                                                               batch_first=True)
-    # padding gps point data
-    data_package = []
-    for col in df.drop(columns='ogrid_list').columns:
-        features = df[col].tolist()
-        features = [torch.tensor(f, dtype=torch.float32) for f in features]
-        features = rnn_utils.pad_sequence(features, padding_value=float('nan'), batch_first=True)
-        features = features.unsqueeze(dim=2)
-        data_package.append(features)
+def prepare_gps_data_grid(df,mat_padding_value_grid,data_padding_value_grid,max_len,feature_stats=None):
+    """
 
-    gps_data = torch.cat(data_package, dim=2)
+    Args:
+        df: ogrid_list and gps features,
+        mat_padding_value: default num_grids
+        data_padding_value: default 0
 
+    Returns:
+        gps_data: (batch, gps_max_length, num_features)
+        gps_assign_mat: (batch, gps_max_length)
 
-    # todo 临时处理的方式, 把时间戳那维特征置1
-    gps_data[:, :, 0] = torch.ones_like(gps_data[:, :, 0])
+    """
+    return prepare_gps_features(df, 'ogrid_list', mat_padding_value_grid, data_padding_value_grid, max_len, feature_stats)
 
-    # 对除第一维特征进行标准化
-    for i in range(1, gps_data.shape[2]):
-        fea = gps_data[:, :, i]
-        nozero_fea = torch.masked_select(fea, torch.isnan(fea).logical_not())  # 计算不为nan的值的fea的mean与std
-        gps_data[:, :, i] = (gps_data[:, :, i] - torch.mean(nozero_fea)) / torch.std(nozero_fea)
+def prepare_time_data(df, timestamp_col, interval_col, utc_offset=UTC_OFFSET):
+    """
+    prepare_route_data 和 prepare_grid_data 的时间特征，在拼接后的时间戳上一次解码
 
-    gps_data = torch.where(torch.isnan(gps_data), torch.full_like(gps_data, data_padding_value_grid), gps_data)
+    Args:
+        df: timestamp_col and interval_col,
+        timestamp_col: road_timestamp 或 grid_timestamp
+        interval_col: road_interval 或 grid_interval
+        utc_offset: 城市所在时区相对 UTC 的偏移，单位小时
 
-    return gps_data, gps_assign_mat
+    Returns:
+        weekday_data: (batch, max_length), padding_value = 0
+        minute_data: (batch, max_length), padding_value = 0
+        delta_data: (batch, max_length), padding_value = -1
 
-def prepare_route_data(df,mat_padding_value,data_padding_value,max_len):
+    """
+    timestamps, timestamp_lengths = ragged_arrays(df[timestamp_col])
+    weekday, minute = decode_weekday_and_minute(timestamps, utc_offset)
+
+    # timestamp 比序列本身的长度多1，包含结束的时间戳，去掉每条序列的最后一个
+    keep = np.ones(len(timestamps), dtype=bool)
+    keep[np.cumsum(timestamp_lengths)[timestamp_lengths > 0] - 1] = False
+    lengths = np.maximum(timestamp_lengths - 1, 0)
+    weekday_data = pad_ragged(torch.from_numpy(weekday[keep]), lengths, 0)
+    minute_data = pad_ragged(torch.from_numpy(minute[keep]), lengths, 0)
+
+    intervals, interval_lengths = ragged_arrays(df[interval_col])
+    delta_data = pad_ragged(torch.as_tensor(np.asarray(intervals, dtype=np.float32)).long(), interval_lengths, -1)
+
+    return weekday_data, minute_data, delta_data
+
+def prepare_route_data(df,mat_padding_value,data_padding_value,max_len,utc_offset=UTC_OFFSET):
     """
 
     Args:
         df: cpath_list,
         mat_padding_value: default num_nodes
         data_padding_value: default 0
+        utc_offset: 城市所在时区相对 UTC 的偏移，单位小时
 
     Returns:
         route_data: (batch, route_max_length, num_features)
@@ -125,24 +237,11 @@ def prepare_route_data(df,mat_padding_value,data_padding_value,max_len):
 
     """
     # padding capath_list
-    cpath_list = [torch.tensor(cpath_list, dtype=torch.float32) for cpath_list in df['cpath_list']]
-    route_assign_mat = rnn_utils.pad_sequence(cpath_list, padding_value=mat_padding_value,
-                                                               batch_first=True)
+    cpath_values, cpath_lengths = ragged_arrays(df['cpath_list'])
+    route_assign_mat = pad_ragged(torch.as_tensor(cpath_values, dtype=torch.float32), cpath_lengths, mat_padding_value)
 
     # padding route data
-    weekday_route_list, minute_route_list = zip(
-        *df['road_timestamp'].apply(extract_weekday_and_minute_from_list))
-
-    weekday_route_list = [torch.tensor(weekday[:-1]).long() for weekday in weekday_route_list] # road_timestamp 比 route 本身的长度多1，包含结束的时间戳
-    minute_route_list = [torch.tensor(minute[:-1]).long() for minute in minute_route_list]# road_timestamp 比 route 本身的长度多1，包含结束的时间戳
-    weekday_data = rnn_utils.pad_sequence(weekday_route_list, padding_value=0, batch_first=True)
-    minute_data = rnn_utils.pad_sequence(minute_route_list, padding_value=0, batch_first=True)
-
-    new_road_interval = []
-    for interval_list in df['road_interval']:
-        new_road_interval.append(torch.Tensor(interval_list).long())
-
-    delta_data = rnn_utils.pad_sequence(new_road_interval, padding_value=-1, batch_first=True)
+    weekday_data, minute_data, delta_data = prepare_time_data(df, 'road_timestamp', 'road_interval', utc_offset)
 
     route_data = torch.cat([weekday_data.unsqueeze(dim=2), minute_data.unsqueeze(dim=2), delta_data.unsqueeze(dim=2)], dim=-1)# (batch_size,max_len,2)
 
@@ -151,13 +250,14 @@ def prepare_route_data(df,mat_padding_value,data_padding_value,max_len):
 
     return route_data, route_assign_mat
 
-def prepare_grid_data(df,mat_padding_value_grid, data_padding_value_grid, max_len):
+def prepare_grid_data(df,mat_padding_value_grid, data_padding_value_grid, max_len, utc_offset=UTC_OFFSET):
     """
 
     Args:
         df: cpath_list,
         mat_padding_value: default num_nodes
         data_padding_value: default 0
+        utc_offset: 城市所在时区相对 UTC 的偏移，单位小时
 
     Returns:
         grid_data: (batch, grid_max_length, num_features)
@@ -165,31 +265,15 @@ def prepare_grid_data(df,mat_padding_value_grid, data_padding_value_grid, max_le
 
     """
     # padding cgrid_list
-    cgrid_list = [torch.tensor(cgrid_list, dtype=torch.float32) for cgrid_list in df['cgrid_list']]
-    grid_assign_mat = rnn_utils.pad_sequence(cgrid_list, padding_value=mat_padding_value_grid,
-                                                               batch_first=True)
-    grid_fea = [torch.tensor(fea, dtype=torch.float32) for fea in df['grid_fea']]
-    mx_len = max(fea.size(0) for fea in grid_fea)
-    num_features = grid_fea[0].size(1) if grid_fea else 0
+    cgrid_values, cgrid_lengths = ragged_arrays(df['cgrid_list'])
+    grid_assign_mat = pad_ragged(torch.as_tensor(cgrid_values, dtype=torch.float32), cgrid_lengths, mat_padding_value_grid)
 
     # 用最大长度填充 grid_fea
-    grid_fea_padded = [torch.cat([fea, torch.zeros(mx_len - fea.size(0), num_features)], dim=0) for fea in grid_fea]
-    grid_fea = torch.stack(grid_fea_padded, dim=0)
+    grid_fea_values, grid_fea_lengths = ragged_arrays(df['grid_fea'])
+    grid_fea = pad_ragged(torch.as_tensor(np.asarray(grid_fea_values, dtype=np.float32)), grid_fea_lengths, 0)
 
     # padding grid data
-    weekday_grid_list, minute_grid_list = zip(
-        *df['grid_timestamp'].apply(extract_weekday_and_minute_from_list))
-
-    weekday_grid_list = [torch.tensor(weekday[:-1]).long() for weekday in weekday_grid_list] # grid_timestamp 比 grid 本身的长度多1，包含结束的时间戳
-    minute_grid_list = [torch.tensor(minute[:-1]).long() for minute in minute_grid_list]# grid_timestamp 比 grid 本身的长度多1，包含结束的时间戳
-    weekday_data = rnn_utils.pad_sequence(weekday_grid_list, padding_value=0, batch_first=True)
-    minute_data = rnn_utils.pad_sequence(minute_grid_list, padding_value=0, batch_first=True)
-
-    new_grid_interval = []
-    for interval_list in df['grid_interval']:
-        new_grid_interval.append(torch.Tensor(interval_list).long())
-
-    delta_data = rnn_utils.pad_sequence(new_grid_interval, padding_value=-1, batch_first=True)
+    weekday_data, minute_data, delta_data = prepare_time_data(df, 'grid_timestamp', 'grid_interval', utc_offset)
 
     grid_data = torch.cat([weekday_data.unsqueeze(dim=2), minute_data.unsqueeze(dim=2), delta_data.unsqueeze(dim=2), grid_fea], dim=-1)# (batch_size,max_len,2)
 
@@ -199,10 +283,17 @@ def prepare_grid_data(df,mat_padding_value_grid, data_padding_value_grid, max_le
     return grid_data, grid_assign_mat
 
 class StaticDataset(Dataset):
-    def __init__(self, data, mat_padding_value, mat_padding_value_grid, data_padding_value, data_padding_value_grid, gps_max_len,route_max_len, grid_max_len):
+    TENSOR_NAMES = ('gps_data', 'gps_assign_mat', 'route_data', 'route_assign_mat',
+                    'gps_data_grid', 'gps_assign_mat_grid', 'grid_data', 'grid_assign_mat',
+                    'gps_length', 'gps_length_grid')
+    PADDING_NAMES = ('mat_padding_value', 'mat_padding_value_grid')
+
+    def __init__(self, data, mat_padding_value, mat_padding_value_grid, data_padding_value, data_padding_value_grid, gps_max_len,route_max_len, grid_max_len, utc_offset=UTC_OFFSET):
         # 仅包含gps轨迹和route轨迹，route中包含路段的特征
         # 不包含路段过去n个时间戳的流量数据
         self.data = data
+        self.mat_padding_value = mat_padding_value
+        self.mat_padding_value_grid = mat_padding_value_grid
         gps_length = data['opath_list'].apply(lambda opath_list: self._split_duplicate_subseq(opath_list, data['route_length'].max())).tolist()
         self.gps_length = torch.tensor(gps_length, dtype=torch.int)
 
@@ -223,7 +314,7 @@ class StaticDataset(Dataset):
 
         # todo 路段本身的属性特征怎么放进去
         route_data, route_assign_mat = prepare_route_data(data[['cpath_list', 'road_timestamp','road_interval']],\
-                                                          mat_padding_value, data_padding_value, route_max_len)
+                                                          mat_padding_value, data_padding_value, route_max_len, utc_offset)
 
         # route对应的信息，从road_interval生成，padding_value = 0
         self.route_data = route_data # shape = (num_samples,route_max_length,1)
@@ -244,7 +335,7 @@ class StaticDataset(Dataset):
 
 
         grid_data, grid_assign_mat = prepare_grid_data(data[['cgrid_list', 'grid_timestamp','grid_interval','grid_fea']],\
-                                                          mat_padding_value_grid, data_padding_value_grid, grid_max_len)
+                                                          mat_padding_value_grid, data_padding_value_grid, grid_max_len, utc_offset)
         # grid对应的信息，从road_interval生成，padding_value = 0
         self.grid_data = grid_data # shape = (num_samples,grid_max_length,3+13)
         # 表示grid的序列信息，从cgrid_list生成，padding_value = grid_nodes
@@ -262,8 +353,27 @@ class StaticDataset(Dataset):
         length_list.append(len(subsequence))
         return length_list + [0]*(max_len-len(length_list))
 
+    @classmethod
+    def from_tensors(cls, tensors):
+        # 从缓存的预处理结果构建，不保留原始 DataFrame
+        dataset = cls.__new__(cls)
+        dataset.data = None
+        for name in cls.TENSOR_NAMES + cls.PADDING_NAMES:
+            setattr(dataset, name, tensors[name])
+        return dataset
+
+    def tensors(self):
+        return {name: getattr(self, name) for name in self.TENSOR_NAMES + self.PADDING_NAMES}
+
+    def lengths(self):
+        # 每条轨迹的 (路段数, gps点数, grid数)，用于按长度分桶
+        route_length = (self.route_assign_mat != self.mat_padding_value).int().sum(1)
+        gps_length = (self.gps_assign_mat != self.mat_padding_value).int().sum(1)
+        grid_length = (self.grid_assign_mat != self.mat_padding_value_grid).int().sum(1)
+        return route_length, gps_length, grid_length
+
     def __len__(self):
-        return self.data.shape[0]
+        return self.route_data.shape[0]
 
     def __getitem__(self, idx):
         return (self.gps_data[idx], self.gps_assign_mat[idx], self.route_data[idx], self.route_assign_mat[idx], 
@@ -312,49 +422,246 @@ def get_loader(data_path, batch_size, num_worker, route_min_len, route_max_len,
 
     return train_loader, val_loader, test_loader
 
-def get_train_loader(data_path, batch_size, num_worker, route_min_len, route_max_len, gps_min_len, gps_max_len, grid_min_len, grid_max_len, num_samples, seed):
+def get_train_dataset(data_path, route_min_len, route_max_len, gps_min_len, gps_max_len, grid_min_len, grid_max_len, num_samples, seed, utc_offset=UTC_OFFSET):
 
-    dataset = pickle.load(open(data_path, 'rb'))
+    # data_path 可以是 pickle 文件，也可以是 traj_store.py 转换得到的列式存储目录
+    dataset = load_trajectories(data_path)
     print(dataset.columns)
 
-    dataset['route_length'] = dataset['cpath_list'].map(len)
-    dataset = dataset[
-        (dataset['route_length'] > route_min_len) & (dataset['route_length'] < route_max_len)].reset_index(drop=True)
-
-    dataset['gps_length'] = dataset['opath_list'].map(len)
-    dataset = dataset[
-        (dataset['gps_length'] > gps_min_len) & (dataset['gps_length'] < gps_max_len)].reset_index(drop=True)
-
-    dataset = dataset[
-        (dataset['grid_length'] > grid_min_len) & (dataset['grid_length'] < grid_max_len)].reset_index(drop=True)
+    route_length = trajectory_lengths(dataset, 'cpath_list')
+    gps_length = trajectory_lengths(dataset, 'opath_list')
+    grid_length = trajectory_lengths(dataset, 'grid_length')
+    keep = (route_length > route_min_len) & (route_length < route_max_len) & \
+           (gps_length > gps_min_len) & (gps_length < gps_max_len) & \
+           (grid_length > grid_min_len) & (grid_length < grid_max_len)
+    rows = np.nonzero(keep)[0]
 
-    print(dataset.shape)
+    print((len(rows), dataset.shape[1]))
     print(num_samples)
-    assert dataset.shape[0] >= num_samples
+    assert len(rows) >= num_samples
 
     # 获取最大路段id
-    uniuqe_path_list = []
-    dataset['cpath_list'].apply(lambda cpath_list: uniuqe_path_list.extend(list(set(cpath_list))))
-    uniuqe_path_list = list(set(uniuqe_path_list))
-
-    mat_padding_value = max(uniuqe_path_list) + 1
+    mat_padding_value = int(column_max(dataset, 'cpath_list', rows)) + 1
     data_padding_value = 0.0
 
     # 获取最大栅格id
-    uniuqe_grid_list = []
-    dataset['cgrid_list'].apply(lambda cgrid_list: uniuqe_grid_list.extend(list(set(cgrid_list))))
-    uniuqe_grid_list = list(set(uniuqe_grid_list))
-
-    mat_padding_value_grid = max(uniuqe_grid_list) + 1
-    data_padding_value_grid = 0.0    
+    mat_padding_value_grid = int(column_max(dataset, 'cgrid_list', rows)) + 1
+    data_padding_value_grid = 0.0
 
     # 前13天作为训练集，第14天作为测试集，第15天作为验证集，已经提前分好
-    train_data = dataset
-    train_data = train_data.sample(n=num_samples, replace=False, random_state=seed)
+    # 与 DataFrame.sample(n=num_samples, replace=False, random_state=seed) 的采样结果一致，只物化被采样的行
+    rows = rows[np.random.RandomState(seed).choice(len(rows), size=num_samples, replace=False)]
+    train_data = take_rows(dataset, rows)
+    train_data['route_length'] = route_length[rows]
+    train_data['gps_length'] = gps_length[rows]
 
-    train_dataset = StaticDataset(train_data, mat_padding_value, mat_padding_value_grid, data_padding_value, data_padding_value_grid, gps_max_len,route_max_len, grid_max_len)
+    train_dataset = StaticDataset(train_data, mat_padding_value, mat_padding_value_grid, data_padding_value, data_padding_value_grid, gps_max_len,route_max_len, grid_max_len, utc_offset)
 
-    train_loader = DataLoader(train_dataset, batch_size=batch_size, drop_last=True, num_workers=num_worker)
+    return train_dataset
+
+class LengthBucketBatchSampler(Sampler):
+    """
+    按长度分桶的 batch sampler，长度相近的轨迹放在同一个 batch 中，配合 TrimCollate 减少 padding 的计算量
+
+    每个 epoch 先把所有轨迹随机打乱，再按 batch_size * bucket_size 切成若干个桶，
+    桶内按 (gps点数, 路段数, grid数) 排序后切成 batch，最后打乱 batch 的顺序，训练仍然是随机的
+
+    Args:
+        lengths: (route_length, gps_length, grid_length)，StaticDataset.lengths() 的返回值
+        batch_size: batch 大小
+        bucket_size: 每个桶包含的 batch 数量，越大 padding 越少，随机性越弱
+        num_replicas, rank: 分布式训练时，所有 rank 用相同的随机数生成 batch，每个 rank 取其中的 1/num_replicas
+
+    与 DistributedSampler 一样，每个 epoch 开始前调用 set_epoch(epoch) 改变随机顺序
+    """
+    def __init__(self, lengths, batch_size, bucket_size=100, drop_last=True, seed=0, num_replicas=1, rank=0):
+        self.route_length, self.gps_length, self.grid_length = [np.asarray(length) for length in lengths]
+        self.batch_size = batch_size
+        self.bucket_size = bucket_size
+        self.drop_last = drop_last
+        self.seed = seed
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __iter__(self):
+        rng = np.random.RandomState(self.seed + self.epoch)
+
+        indices = rng.permutation(len(self.route_length))
+        bucket = self.batch_size * self.bucket_size
+        batches = []
+        for start in range(0, len(indices), bucket):
+            bucket_indices = indices[start:start + bucket]
+            order = np.lexsort((self.grid_length[bucket_indices], self.route_length[bucket_indices],
+                                self.gps_length[bucket_indices]))
+            bucket_indices = bucket_indices[order]
+            for batch_start in range(0, len(bucket_indices), self.batch_size):
+                batches.append(bucket_indices[batch_start:batch_start + self.batch_size].tolist())
+
+        if self.drop_last:
+            batches = [batch for batch in batches if len(batch) == self.batch_size]
+        order = rng.permutation(len(batches))
+        # 每个 rank 的 batch 数相同，多出的 batch 丢弃
+        order = order[self.rank:len(order) - len(order) % self.num_replicas:self.num_replicas]
+        for i in order:
+            yield batches[i]
+
+    def __len__(self):
+        if self.drop_last:
+            num_batches = len(self.route_length) // self.batch_size
+        else:
+            num_batches = (len(self.route_length) + self.batch_size - 1) // self.batch_size
+        return num_batches // self.num_replicas
+
+class TrimCollate(object):
+    """
+    把 batch 截断到 batch 内的最大长度，StaticDataset 中的数据都 padding 到了整个数据集的最大长度
+    """
+    def __init__(self, mat_padding_value, mat_padding_value_grid):
+        self.mat_padding_value = mat_padding_value
+        self.mat_padding_value_grid = mat_padding_value_grid
+
+    def __call__(self, batch):
+        gps_data, gps_assign_mat, route_data, route_assign_mat, \
+        gps_data_grid, gps_assign_mat_grid, grid_data, grid_assign_mat, \
+        gps_length, gps_length_grid = default_collate(batch)
+
+        gps_len = int((gps_assign_mat != self.mat_padding_value).int().sum(1).max())
+        route_len = int((route_assign_mat != self.mat_padding_value).int().sum(1).max())
+        gps_len_grid = int((gps_assign_mat_grid != self.mat_padding_value_grid).int().sum(1).max())
+        grid_len = int((grid_assign_mat != self.mat_padding_value_grid).int().sum(1).max())
+        # gps_length 中每个非0值对应一个路段/grid上的gps点数
+        seg_len = int((gps_length > 0).int().sum(1).max())
+        seg_len_grid = int((gps_length_grid > 0).int().sum(1).max())
+
+        return (gps_data[:, :gps_len].contiguous(), gps_assign_mat[:, :gps_len].contiguous(),
+                route_data[:, :route_len].contiguous(), route_assign_mat[:, :route_len].contiguous(),
+                gps_data_grid[:, :gps_len_grid].contiguous(), gps_assign_mat_grid[:, :gps_len_grid].contiguous(),
+                grid_data[:, :grid_len].contiguous(), grid_assign_mat[:, :grid_len].contiguous(),
+                gps_length[:, :seg_len].contiguous(), gps_length_grid[:, :seg_len_grid].contiguous())
+
+# 训练 batch，字段顺序与 MVTraj.forward 的参数一致，可以直接 model(*batch)
+TrainBatch = namedtuple('TrainBatch', [
+    'route_data', 'masked_route_assign_mat', 'gps_data', 'masked_gps_assign_mat', 'route_assign_mat', 'gps_length',
+    'grid_data', 'masked_grid_assign_mat', 'gps_data_grid', 'masked_gps_assign_mat_grid', 'grid_assign_mat', 'gps_length_grid'])
+
+class MaskCollate(object):
+    """
+    在 DataLoader 的 worker 进程中完成组 batch 和 random_mask，返回 TrainBatch
+
+    Args:
+        mask_token: 路段的 mask id，即 vocab_size
+        mask_token_grid: grid 的 mask id，即 grid_vocab_size
+        collate_fn: 组 batch 的函数，默认 default_collate，按长度分桶时为 TrimCollate
+    """
+    def __init__(self, mask_token, mask_token_grid, mask_length=1, mask_prob=0.2, collate_fn=default_collate):
+        self.mask_token = mask_token
+        self.mask_token_grid = mask_token_grid
+        self.mask_length = mask_length
+        self.mask_prob = mask_prob
+        self.collate_fn = collate_fn
+
+    def __call__(self, batch):
+        gps_data, gps_assign_mat, route_data, route_assign_mat, \
+        gps_data_grid, gps_assign_mat_grid, grid_data, grid_assign_mat, \
+        gps_length, gps_length_grid = self.collate_fn(batch)
+
+        masked_route_assign_mat, masked_gps_assign_mat = random_mask(gps_assign_mat, route_assign_mat, gps_length,
+                                                                    self.mask_token, self.mask_length, self.mask_prob)
+        masked_grid_assign_mat, masked_gps_assign_mat_grid = random_mask(gps_assign_mat_grid, grid_assign_mat, gps_length_grid,
+                                                                        self.mask_token_grid, self.mask_length, self.mask_prob)
+
+        return TrainBatch(route_data, masked_route_assign_mat, gps_data, masked_gps_assign_mat, route_assign_mat, gps_length,
+                          grid_data, masked_grid_assign_mat, gps_data_grid, masked_gps_assign_mat_grid, grid_assign_mat, gps_length_grid)
+
+class DevicePrefetcher(object):
+    """
+    把 DataLoader 的 batch 搬到 device 上，GPU 上用单独的 cuda stream 提前拷贝下一个 batch，与当前 batch 的计算重叠
+    配合 pin_memory=True 使用时拷贝是异步的；device 为 cpu 时直接返回原 batch
+    """
+    def __init__(self, loader, device):
+        self.loader = loader
+        self.device = torch.device(device)
+        self.stream = torch.cuda.Stream(self.device) if self.device.type == 'cuda' else None
+
+    def __len__(self):
+        return len(self.loader)
+
+    def _to_device(self, batch):
+        if isinstance(batch, torch.Tensor):
+            return batch.to(self.device, non_blocking=True)
+        if isinstance(batch, tuple) and hasattr(batch, '_fields'):
+            return type(batch)(*(self._to_device(item) for item in batch))
+        if isinstance(batch, (list, tuple)):
+            return type(batch)(self._to_device(item) for item in batch)
+        return batch
+
+    def _record_stream(self, batch):
+        # batch 在 self.stream 上分配，在当前 stream 上使用，防止被 caching allocator 提前回收
+        if isinstance(batch, torch.Tensor):
+            batch.record_stream(torch.cuda.current_stream(self.device))
+        elif isinstance(batch, (list, tuple)):
+            for item in batch:
+                self._record_stream(item)
+
+    def __iter__(self):
+        if self.stream is None:
+            for batch in self.loader:
+                yield batch
+            return
+
+        loader = iter(self.loader)
+        next_batch = self._preload(loader)
+        while next_batch is not None:
+            torch.cuda.current_stream(self.device).wait_stream(self.stream)
+            batch = next_batch
+            self._record_stream(batch)
+            # 当前 batch 计算的同时拷贝下一个 batch
+            next_batch = self._preload(loader)
+            yield batch
+
+    def _preload(self, loader):
+        batch = next(loader, None)
+        if batch is None:
+            return None
+        with torch.cuda.stream(self.stream):
+            return self._to_device(batch)
+
+def get_train_loader(data_path, batch_size, num_worker, route_min_len, route_max_len, gps_min_len, gps_max_len, grid_min_len, grid_max_len, num_samples, seed, utc_offset=UTC_OFFSET, cache_dir=None, cache_size_gb=20, length_bucket=False, bucket_size=100,
+                     mask_token=None, mask_token_grid=None, mask_length=1, mask_prob=0.2, pin_memory=False, num_replicas=1, rank=0):
+
+    # 预处理结果按 (数据文件的路径/大小/修改时间, 以下参数) 缓存在 cache_dir 中，cache_dir 为 None 时每次重新预处理
+    params = {'loader': 'train', 'route_min_len': route_min_len, 'route_max_len': route_max_len,
+              'gps_min_len': gps_min_len, 'gps_max_len': gps_max_len, 'grid_min_len': grid_min_len,
+              'grid_max_len': grid_max_len, 'num_samples': num_samples, 'seed': seed, 'utc_offset': utc_offset}
+    tensors = cached_call(cache_dir, data_path, params, lambda: get_train_dataset(
+        data_path, route_min_len, route_max_len, gps_min_len, gps_max_len, grid_min_len, grid_max_len,
+        num_samples, seed, utc_offset).tensors(), cache_size_gb)
+    train_dataset = StaticDataset.from_tensors(tensors)
+
+    collate_fn = default_collate
+    if length_bucket:
+        # 长度相近的轨迹组成一个 batch，并截断到 batch 内的最大长度
+        collate_fn = TrimCollate(train_dataset.mat_padding_value, train_dataset.mat_padding_value_grid)
+    if mask_token is not None:
+        # 给定 mask id 时在 worker 进程中 mask，batch 为 TrainBatch
+        collate_fn = MaskCollate(mask_token, mask_token_grid, mask_length, mask_prob, collate_fn)
+
+    loader_kwargs = {'collate_fn': collate_fn, 'num_workers': num_worker, 'pin_memory': pin_memory,
+                     'persistent_workers': num_worker > 0}
+    # num_replicas > 1 时（DDP）每个 rank 只读取自己的那一份数据，各 rank 每个 epoch 的 batch 数相同
+    if length_bucket:
+        batch_sampler = LengthBucketBatchSampler(train_dataset.lengths(), batch_size, bucket_size, drop_last=True, seed=seed,
+                                                 num_replicas=num_replicas, rank=rank)
+        train_loader = DataLoader(train_dataset, batch_sampler=batch_sampler, **loader_kwargs)
+    elif num_replicas > 1:
+        sampler = DistributedSampler(train_dataset, num_replicas, rank, shuffle=False, seed=seed, drop_last=True)
+        train_loader = DataLoader(train_dataset, batch_size=batch_size, sampler=sampler, drop_last=True, **loader_kwargs)
+    else:
+        train_loader = DataLoader(train_dataset, batch_size=batch_size, drop_last=True, **loader_kwargs)
 
     return train_loader
 
@@ -370,7 +677,8 @@ def random_mask(gps_assign_mat, route_assign_mat, gps_length, mask_token, mask_l
         dtype=torch.float32,
         device=route_assign_mat.device).uniform_(0, 1) < mask_prob
 
-    route_mask_pos = torch.stack(sum([[col]*mask_length for col in route_mask_pos.t()], []), dim=1)
+    # 每一列重复 mask_length 次，连续的 mask_length 个路段一起被 mask
+    route_mask_pos = torch.repeat_interleave(route_mask_pos, mask_length, dim=1)
 
     # 截断
     if route_mask_pos.shape[1] > route_assign_mat.shape[1]:
@@ -379,19 +687,15 @@ def random_mask(gps_assign_mat, route_assign_mat, gps_length, mask_token, mask_l
     masked_route_assign_mat = route_assign_mat.clone()
     masked_route_assign_mat[route_mask_pos] = mask_token
 
-    # mask gps
+    # mask gps: 路段的 mask 按该路段上的 gps 点数展开到每个 gps 点
+    seq_len = route_mask_pos.shape[1]
+    seg_length = gps_length[:, :seq_len].long()
+    if seg_length.shape[1] < seq_len:
+        seg_length = torch.cat([seg_length, seg_length.new_zeros(batch_size, seq_len - seg_length.shape[1])], dim=1)
+    point_mask_pos = torch.repeat_interleave(route_mask_pos.reshape(-1), seg_length.reshape(-1))
+    gps_mask_pos = pad_ragged(point_mask_pos, seg_length.sum(1), False, max_len=gps_assign_mat.shape[1])
+
     masked_gps_assign_mat = gps_assign_mat.clone()
-    gps_mask_pos = []
-    for idx, row in enumerate(gps_assign_mat):
-        route_mask = route_mask_pos[idx]
-        length_list = gps_length[idx]
-        unpad_mask_pos_list = sum([[mask] * length_list[_idx].item() for _idx, mask in enumerate(route_mask)], [])
-        pad_mask_pos_list = unpad_mask_pos_list + [torch.tensor(False)] * (
-                    gps_assign_mat.shape[1] - len(unpad_mask_pos_list))
-        pad_mask_pos = torch.stack(pad_mask_pos_list)
-        gps_mask_pos.append(pad_mask_pos)
-    gps_mask_pos = torch.stack(gps_mask_pos, dim=0)
     masked_gps_assign_mat[gps_mask_pos] = mask_token
-    # 获得每个gps点对应路段的长度
 
     return masked_route_assign_mat, masked_gps_assign_mat
@@ -3,18 +3,13 @@ sys.path.append("..")
 import numpy as np
 import pandas as pd
 import time
-import pickle
 from task import road_cls, speed_inf, time_est
-from evluation_utils import get_road, fair_sampling, get_road_emb_from_traj, prepare_data, get_seq_emb_from_node
+from evluation_utils import get_road, fair_sampling, get_road_emb_from_traj, prepare_data_from_file, get_seq_emb_from_node
 import torch
 import os
 torch.set_num_threads(5)
 
-dev_id = 0
-os.environ['CUDA_VISIBLE_DEVICES'] = str(dev_id)
-torch.cuda.set_device(dev_id)
-
-def evaluation(city, exp_path, model_name, start_time):
+def evaluation(city, exp_path, model_name, start_time, cache_dir=None, device='cuda:0'):
     route_min_len, route_max_len, gps_min_len, gps_max_len, grid_min_len, grid_max_len = 10, 100, 10, 256, 10, 100
     model_path = os.path.join(exp_path, 'model', model_name)
     embedding_name = model_name.split('.')[0]
@@ -26,23 +21,20 @@ def evaluation(city, exp_path, model_name, start_time):
     # load adj
     edge_index = np.load("line_graph_edge_idx.npy".format(city))
     print("edge_index shape:", edge_index.shape)
-    # load origin train data
-    test_node_data = pickle.load(
-        open('{}/{}_train.pkl'.format(city, city), 'rb'))
-    road_list = get_road(test_node_data)
-    print('number of road obervased in test data: {}'.format(len(road_list)))
+    # origin train data, 也可以是 traj_store.py 转换后的列式存储目录
+    data_path = '{}/{}_train.pkl'.format(city, city)
 
     # sample train data
     num_samples = 'all'
+    preprocess, preprocess_params = None, {}
     if num_samples == 1000:
         pass
     elif isinstance(num_samples, int):
-        test_node_data = fair_sampling(test_node_data, num_samples)
-    road_list = get_road(test_node_data)
-    print('number of road obervased after sampling: {}'.format(len(road_list)))
+        preprocess, preprocess_params = fair_sampling, {'num_samples': num_samples}
+        cache_dir = None # fair_sampling 是随机采样，结果不缓存
 
     # load model
-    seq_model = torch.load(model_path, map_location="cuda:{}".format(dev_id))['model']
+    seq_model = torch.load(model_path, map_location=device)['model']
     seq_model.eval()
 
     print('start time : {}'.format(time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(start_time))))
@@ -51,8 +43,11 @@ def evaluation(city, exp_path, model_name, start_time):
     # prepare road task dataset
     route_data, masked_route_assign_mat, gps_data, masked_gps_assign_mat, route_assign_mat, \
             grid_data, masked_grid_assign_mat, gps_data_grid, masked_gps_assign_mat_grid, grid_assign_mat, \
-            gps_length, gps_length_grid, dataset, mat_padding_value, mat_padding_value_grid = prepare_data(
-        test_node_data, route_min_len, route_max_len, gps_min_len, gps_max_len, grid_min_len, grid_max_len)
+            gps_length, gps_length_grid, dataset, mat_padding_value, mat_padding_value_grid = prepare_data_from_file(
+        data_path, route_min_len, route_max_len, gps_min_len, gps_max_len, grid_min_len, grid_max_len,
+        cache_dir=cache_dir, preprocess=preprocess, **preprocess_params)
+    road_list = get_road(dataset)
+    print('number of road obervased after sampling: {}'.format(len(road_list)))
     test_node_data = (route_data, masked_route_assign_mat, gps_data, masked_gps_assign_mat, route_assign_mat, \
             grid_data, masked_grid_assign_mat, gps_data_grid, masked_gps_assign_mat_grid, grid_assign_mat, \
             gps_length, gps_length_grid, dataset)
@@ -65,12 +60,15 @@ def evaluation(city, exp_path, model_name, start_time):
 
     if os.path.exists(emb_path):
         # load road embedding from inference result
-        road_embedding = torch.load(emb_path, map_location='cuda:{}'.format(dev_id))['road_embedding']
+        road_embedding = torch.load(emb_path, map_location=device)['road_embedding']
     else:
-        # infer road embedding
+        # infer road embedding，中断后从 checkpoint 继续累加
+        checkpoint_path = emb_path + '.ckpt'
         road_embedding = get_road_emb_from_traj(seq_model, test_node_data, without_gps=False, batch_size=256,
-                                                update_road=update_road, city=city)
+                                                update_road=update_road, city=city, checkpoint_path=checkpoint_path)
         torch.save({'road_embedding': road_embedding}, emb_path)
+        if os.path.exists(checkpoint_path):
+            os.remove(checkpoint_path)
 
     # task 1
     road_cls.evaluation(road_embedding, feature_df)
@@ -86,5 +84,7 @@ if __name__ == '__main__':
 
     start_time = time.time()
     log_path = os.path.join(exp_path, 'evaluation')
-    evaluation(city, exp_path, model_name, start_time)
+    cache_dir = 'research/cache/' # 预处理结果的缓存目录，None 表示不缓存
+    device = 'cuda:0' if torch.cuda.is_available() else 'cpu' # 模型、评估数据和下游任务都在该 device 上
+    evaluation(city, exp_path, model_name, start_time, cache_dir, device)
 
@@ -4,20 +4,15 @@ sys.path.append("..")
 import numpy as np
 import pandas as pd
 import time
-import pickle
 from utils import Logger
 import argparse
 from task import road_cls, speed_inf, time_est
-from evluation_utils import get_road, fair_sampling, get_seq_emb_from_traj_withRouteOnly, get_seq_emb_from_traj_withALLModel, prepare_data
+from evluation_utils import get_road, fair_sampling, get_seq_emb_from_traj_withRouteOnly, get_seq_emb_from_traj_withALLModel, prepare_data_from_file, sample_trajectories
 import torch
 import os
 torch.set_num_threads(5)
 
-dev_id = 0
-os.environ['CUDA_VISIBLE_DEVICES'] = str(dev_id)
-torch.cuda.set_device(dev_id)
-
-def evaluation(city, exp_path, model_name, start_time):
+def evaluation(city, exp_path, model_name, start_time, cache_dir=None, device='cuda:0'):
     route_min_len, route_max_len, gps_min_len, gps_max_len, grid_min_len, grid_max_len = 10, 100, 10, 256, 10, 100
     model_path = os.path.join(exp_path, 'model', model_name)
     embedding_name = model_name.split('.')[0]
@@ -27,23 +22,18 @@ def evaluation(city, exp_path, model_name, start_time):
     num_nodes = len(feature_df)
     print("num_nodes:", num_nodes)
 
-    seq_model = torch.load(model_path, map_location="cuda:{}".format(dev_id))['model'] # model.to()包含inplace操作，不需要对象承接
+    seq_model = torch.load(model_path, map_location=device)['model'] # model.to()包含inplace操作，不需要对象承接
     seq_model.eval()
 
     print('start time : {}'.format(time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(start_time))))
     print("\n=== Evaluation ===")
 
     # prepare sequence task
-    test_seq_data = pickle.load(
-        open('{}/{}_eval.pkl'.format(city, city),
-             'rb'))
-    test_seq_data = test_seq_data.sample(50000, random_state=0)
-
-    route_length = test_seq_data['route_length'].values
     route_data, masked_route_assign_mat, gps_data, masked_gps_assign_mat, route_assign_mat, \
             grid_data, masked_grid_assign_mat, gps_data_grid, masked_gps_assign_mat_grid, grid_assign_mat, \
-            gps_length, gps_length_grid, dataset, mat_padding_value, mat_padding_value_grid = prepare_data(
-        test_seq_data, route_min_len, route_max_len, gps_min_len, gps_max_len, grid_min_len, grid_max_len)
+            gps_length, gps_length_grid, dataset, mat_padding_value, mat_padding_value_grid = prepare_data_from_file(
+        '{}/{}_eval.pkl'.format(city, city), route_min_len, route_max_len, gps_min_len, gps_max_len, grid_min_len, grid_max_len,
+        cache_dir=cache_dir, preprocess=sample_trajectories, num_samples=50000, random_state=0)
     
     seq_model.vocab_size = mat_padding_value
     seq_model.grid_vocab_size = mat_padding_value_grid
@@ -70,4 +60,6 @@ if __name__ == '__main__':
 
     start_time = time.time()
     log_path = os.path.join(exp_path, 'evaluation')
-    evaluation(city, exp_path, model_name, start_time)
+    cache_dir = 'research/cache/' # 预处理结果的缓存目录，None 表示不缓存
+    device = 'cuda:0' if torch.cuda.is_available() else 'cpu' # 模型、评估数据和下游任务都在该 device 上
+    evaluation(city, exp_path, model_name, start_time, cache_dir, device)
@@ -0,0 +1,189 @@
+#!/usr/bin/python
+# 推理阶段轨迹表示的流式导出
+# 按 chunk 读取轨迹（推荐用 traj_store 转换后的列式存储，只 mmap 不整体加载），在 DataLoader 的 worker 进程中预处理，
+# 模型在 eval 模式下逐 batch 推理，结果逐 chunk 写入 memmap 的 .npy 文件，内存占用只和 chunk_size 有关
+#
+# Usage:
+#     python embedding_export.py research/exp/.../model/xxx.pt xian_test_store xian_traj_emb/ --device cuda:0
+#
+# 输出目录:
+#     embeddings.npy: (num_traj, 4 * hidden_size) float32，与 get_seq_emb_from_traj_withALLModel 相同（四个视角 joint 表示的拼接）
+#     ids.npy: (num_traj,) int64，轨迹 id（id_col 列，数据中没有该列时为行号）
+#     meta.json: 模型的哈希和 padding id、导出参数和已写完的 chunk 数，中断后以相同模型和参数重新运行会从下一个 chunk 继续，模型不同时重新导出
+#
+# 所有轨迹都会导出：route / grid 超过位置编码长度 (route_max_len - 1) 的部分被截断，而不是像评估时那样过滤掉；
+# gps 特征用整个数据集的 mean / std 标准化（导出前流式扫描一遍特征列），结果与 chunk 的划分无关
+import os
+import json
+import time
+import argparse
+
+import numpy as np
+import torch
+from torch.utils.data import DataLoader, Dataset
+
+from dataloader import UTC_OFFSET, TrainBatch, gps_feature_stats
+from evluation_utils import prepare_data
+from traj_store import load_trajectories, take_rows
+from utils import model_device, model_fingerprint
+from MVTraj import QUEUE_VIEWS
+
+META_FILE = 'meta.json'
+EMBEDDING_FILE = 'embeddings.npy'
+ID_FILE = 'ids.npy'
+# 截断时需要对齐的列，值为比序列本身多出的长度（timestamp 包含结束时间戳）
+ROUTE_COLUMNS = {'cpath_list': 0, 'road_interval': 0, 'road_timestamp': 1}
+GRID_COLUMNS = {'cgrid_list': 0, 'grid_interval': 0, 'grid_fea': 0, 'grid_timestamp': 1}
+
+
+def truncate_trajectories(df, max_len):
+    # route / grid 只保留前 max_len 个路段/栅格，gps 点不截断（split_duplicate_subseq 只统计前 max_len 段）
+    truncated = np.zeros(len(df), dtype=bool)
+    for length_col, columns in (('cpath_list', ROUTE_COLUMNS), ('cgrid_list', GRID_COLUMNS)):
+        too_long = df[length_col].map(len).values > max_len
+        if too_long.any():
+            for name, extra in columns.items():
+                df[name] = df[name].map(lambda row: row[:max_len + extra])
+        truncated |= too_long
+    return df, int(truncated.sum())
+
+
+class TrajChunkDataset(Dataset):
+    """
+    每个元素为连续 chunk_size 条轨迹预处理后的结果，DataLoader 按顺序返回，多个 worker 并行预处理
+    返回 (chunk 编号, 轨迹 id, 截断的轨迹数, TrainBatch)
+    """
+    def __init__(self, dataset, chunk_size, max_len, mat_padding_value, mat_padding_value_grid, feature_stats=None,
+                 utc_offset=UTC_OFFSET, id_col='traj_id', start_chunk=0):
+        self.dataset = dataset
+        self.chunk_size = chunk_size
+        self.max_len = max_len
+        self.mat_padding_value = mat_padding_value
+        self.mat_padding_value_grid = mat_padding_value_grid
+        self.feature_stats = feature_stats
+        self.utc_offset = utc_offset
+        self.id_col = id_col
+        self.start_chunk = start_chunk
+        self.num_chunks = (len(dataset) + chunk_size - 1) // chunk_size
+
+    def __len__(self):
+        return self.num_chunks - self.start_chunk
+
+    def __getitem__(self, idx):
+        chunk = self.start_chunk + idx
+        rows = np.arange(chunk * self.chunk_size, min(len(self.dataset), (chunk + 1) * self.chunk_size))
+        df = take_rows(self.dataset, rows)
+        ids = np.asarray(df[self.id_col], dtype=np.int64) if self.id_col in df.columns else rows.astype(np.int64)
+        df, truncated = truncate_trajectories(df, self.max_len)
+
+        # 长度条件全部放开，chunk 内的轨迹一条都不过滤；padding id 使用模型的路段/栅格数量，gps 特征使用全局的统计量
+        route_data, masked_route_assign_mat, gps_data, masked_gps_assign_mat, route_assign_mat, \
+            grid_data, masked_grid_assign_mat, gps_data_grid, masked_gps_assign_mat_grid, grid_assign_mat, \
+            gps_length, gps_length_grid, _, _, _ = prepare_data(df, -1, np.inf, -1, np.inf, -1, np.inf, self.utc_offset,
+                                                                self.mat_padding_value, self.mat_padding_value_grid,
+                                                                self.feature_stats)
+        batch = TrainBatch(route_data, masked_route_assign_mat, gps_data, masked_gps_assign_mat, route_assign_mat, gps_length,
+                           grid_data, masked_grid_assign_mat, gps_data_grid, masked_gps_assign_mat_grid, grid_assign_mat,
+                           gps_length_grid)
+        return chunk, torch.from_numpy(ids), truncated, batch
+
+
+def traj_embedding(seq_model, batch):
+    # 四个视角 joint 轨迹表示的拼接，与 get_seq_emb_from_traj_withALLModel 一致
+    reps = seq_model.encode(batch, outputs=('traj',))
+    return torch.cat([reps['{}_traj'.format(view)] for view in QUEUE_VIEWS], dim=1)
+
+
+def _write_meta(out_dir, meta):
+    tmp_path = os.path.join(out_dir, META_FILE + '.tmp')
+    with open(tmp_path, 'w') as f:
+        json.dump(meta, f)
+    os.replace(tmp_path, os.path.join(out_dir, META_FILE))
+
+
+def _open_output(out_dir, meta, embed_size):
+    # 模型和参数相同的未完成导出从断点继续，否则重新创建输出文件
+    meta_path = os.path.join(out_dir, META_FILE)
+    if os.path.exists(meta_path):
+        old_meta = json.load(open(meta_path, 'r'))
+        done_chunks = old_meta.pop('done_chunks')
+        truncated = old_meta.pop('truncated')
+        if old_meta == meta:
+            embeddings = np.load(os.path.join(out_dir, EMBEDDING_FILE), mmap_mode='r+')
+            ids = np.load(os.path.join(out_dir, ID_FILE), mmap_mode='r+')
+            return embeddings, ids, done_chunks, truncated
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+    embeddings = np.lib.format.open_memmap(os.path.join(out_dir, EMBEDDING_FILE), mode='w+', dtype=np.float32,
+                                           shape=(meta['num_traj'], embed_size))
+    ids = np.lib.format.open_memmap(os.path.join(out_dir, ID_FILE), mode='w+', dtype=np.int64, shape=(meta['num_traj'],))
+    return embeddings, ids, 0, 0
+
+
+def export_embeddings(seq_model, data_path, out_dir, chunk_size=8192, batch_size=256, num_workers=4,
+                      route_max_len=100, utc_offset=UTC_OFFSET, id_col='traj_id'):
+    """
+    Args:
+        seq_model: MVTraj，推理在其所在的 device 上进行
+        data_path: 列式存储目录或 pickle 的 DataFrame（pickle 需要整体加载，只适合小数据集）
+        out_dir: 输出目录
+        chunk_size: 每个 worker 一次预处理的轨迹数，内存占用约为 (num_workers + 1) 个 chunk
+        batch_size: 推理的 batch 大小
+        route_max_len: 模型位置编码的长度，route / grid 最多保留 route_max_len - 1 个位置（第0位为cls）
+
+    Returns:
+        (embeddings, ids) 只读 memmap
+    """
+    device = model_device(seq_model)
+    seq_model.eval()
+    dataset = load_trajectories(data_path)
+    meta = {'model': model_fingerprint(seq_model), 'source': os.path.abspath(data_path), 'num_traj': len(dataset), 'chunk_size': chunk_size,
+            'route_max_len': route_max_len, 'utc_offset': utc_offset, 'id_col': id_col,
+            # padding id 不在 state_dict 中，评估脚本会修改这两个值
+            'vocab_size': int(seq_model.vocab_size), 'grid_vocab_size': int(seq_model.grid_vocab_size)}
+    embeddings, ids, done_chunks, truncated = _open_output(out_dir, meta, len(QUEUE_VIEWS) * seq_model.fc2.out_features)
+
+    chunks = TrajChunkDataset(dataset, chunk_size, route_max_len - 1, seq_model.vocab_size, seq_model.grid_vocab_size,
+                              gps_feature_stats(dataset), utc_offset, id_col, start_chunk=done_chunks)
+    loader = DataLoader(chunks, batch_size=None, shuffle=False, num_workers=num_workers,
+                        pin_memory=device.type == 'cuda')
+    st = time.time()
+    for chunk, chunk_ids, chunk_truncated, chunk_batch in loader:
+        start = chunk * chunk_size
+        num = chunk_ids.shape[0]
+        for i in range(0, num, batch_size):
+            batch = TrainBatch(*[item[i:i + batch_size].to(device, non_blocking=True) for item in chunk_batch])
+            embeddings[start + i:start + i + batch.route_data.shape[0]] = traj_embedding(seq_model, batch).float().cpu().numpy()
+        ids[start:start + num] = chunk_ids.numpy()
+        embeddings.flush()
+        ids.flush()
+        truncated += chunk_truncated
+        # 数据落盘后再更新进度
+        _write_meta(out_dir, dict(meta, done_chunks=chunk + 1, truncated=truncated))
+        print('chunk {}/{} | {} trajectories | {:.1f} traj/s'.format(
+            chunk + 1, chunks.num_chunks, start + num, (start + num - done_chunks * chunk_size) / (time.time() - st)))
+
+    if truncated:
+        print('{} trajectories longer than {} were truncated'.format(truncated, route_max_len - 1))
+    del embeddings, ids
+    return np.load(os.path.join(out_dir, EMBEDDING_FILE), mmap_mode='r'), np.load(os.path.join(out_dir, ID_FILE), mmap_mode='r')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='export trajectory embeddings of a pretrained MVTraj into a memory-mapped file')
+    parser.add_argument('model_path')
+    parser.add_argument('data_path', help='columnar store written by traj_store.py or a pickled DataFrame')
+    parser.add_argument('out_dir')
+    parser.add_argument('--device', default='cuda:0' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument('--chunk_size', type=int, default=8192)
+    parser.add_argument('--batch_size', type=int, default=256)
+    parser.add_argument('--num_workers', type=int, default=4)
+    parser.add_argument('--route_max_len', type=int, default=100)
+    parser.add_argument('--utc_offset', type=float, default=UTC_OFFSET)
+    parser.add_argument('--id_col', default='traj_id')
+    args = parser.parse_args()
+
+    seq_model = torch.load(args.model_path, map_location=args.device)['model']
+    embeddings, ids = export_embeddings(seq_model, args.data_path, args.out_dir, args.chunk_size, args.batch_size,
+                                        args.num_workers, args.route_max_len, args.utc_offset, args.id_col)
+    print('{} embeddings written to {}'.format(embeddings.shape[0], args.out_dir))
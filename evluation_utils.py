@@ -1,10 +1,15 @@
+import os
+import warnings
 import joblib
 import torch
-from dataloader import prepare_gps_data, prepare_route_data, prepare_gps_data_grid, prepare_grid_data
-import math
+from dataloader import prepare_gps_data, prepare_route_data, prepare_gps_data_grid, prepare_grid_data, UTC_OFFSET
 from update_road_representation import MeanAggregator, WeightedMeanAggregator
 import numpy as np
 import torch.nn.utils.rnn as rnn_utils
+from traj_store import TrajFrame, load_trajectories, trajectory_lengths, take_rows, ragged_arrays
+from data_cache import cached_call
+from utils import model_device, model_fingerprint, tensor_fingerprint
+from MVTraj import QUEUE_VIEWS
 
 
 # 回归label标准化
@@ -21,6 +26,8 @@ def pred_unnorm(pred,mean,std):
 
 # 获取数据中出现至少一次的路段
 def get_road(df):
+    if isinstance(df, TrajFrame):
+        return np.unique(df['cpath_list'].values).tolist()
     road_list = []
     df['cpath_list'].apply(lambda row: road_list.extend(row))
     return list(set(road_list))
@@ -41,40 +48,47 @@ def split_duplicate_subseq(opath_list, max_len):
     return length_list + [0] * (max_len - len(length_list))
 
 # 准备评估时使用的训练数据
-def prepare_data(dataset, route_min_len, route_max_len, gps_min_len, gps_max_len, grid_min_len, grid_max_len):
-
-    dataset['route_length'] = dataset['cpath_list'].map(len)
-    dataset = dataset[
-        (dataset['route_length'] > route_min_len) & (dataset['route_length'] < route_max_len)].reset_index(drop=True)
-
-    dataset['gps_length'] = dataset['opath_list'].map(len)
-    dataset = dataset[
-        (dataset['gps_length'] > gps_min_len) & (dataset['gps_length'] < gps_max_len)].reset_index(drop=True)
-    
-    dataset['grid_length'] = dataset['cgrid_list'].map(len)
-    dataset = dataset[
-        (dataset['grid_length'] > grid_min_len) & (dataset['grid_length'] < grid_max_len)].reset_index(drop=True)
+# dataset 可以是 DataFrame，也可以是 traj_store.open_store 打开的列式存储，此时只物化满足长度条件的行
+# mat_padding_value / mat_padding_value_grid 为 None 时取数据中最大的路段/栅格 id + 1
+# gps_feature_stats 为 dataloader.gps_feature_stats 的结果，为 None 时 gps 特征在 dataset 内标准化
+def prepare_data(dataset, route_min_len, route_max_len, gps_min_len, gps_max_len, grid_min_len, grid_max_len, utc_offset=UTC_OFFSET,
+                 mat_padding_value=None, mat_padding_value_grid=None, gps_feature_stats=None):
+
+    route_length = trajectory_lengths(dataset, 'cpath_list')
+    gps_length = trajectory_lengths(dataset, 'opath_list')
+    grid_length = trajectory_lengths(dataset, 'cgrid_list')
+    keep = (route_length > route_min_len) & (route_length < route_max_len) & \
+           (gps_length > gps_min_len) & (gps_length < gps_max_len) & \
+           (grid_length > grid_min_len) & (grid_length < grid_max_len)
+    rows = np.nonzero(keep)[0]
+
+    dataset = take_rows(dataset, rows)
+    dataset['route_length'] = route_length[rows]
+    dataset['gps_length'] = gps_length[rows]
+    dataset['grid_length'] = grid_length[rows]
 
     # 获取最大路段id
-    uniuqe_path_list = []
-    dataset['cpath_list'].apply(lambda cpath_list: uniuqe_path_list.extend(list(set(cpath_list))))
-    uniuqe_path_list = list(set(uniuqe_path_list))
+    if mat_padding_value is None:
+        uniuqe_path_list = []
+        dataset['cpath_list'].apply(lambda cpath_list: uniuqe_path_list.extend(list(set(cpath_list))))
+        uniuqe_path_list = list(set(uniuqe_path_list))
 
-    mat_padding_value = max(uniuqe_path_list) + 1
+        mat_padding_value = max(uniuqe_path_list) + 1
     data_padding_value = 0.0
 
     # 获取最大栅格id
-    uniuqe_grid_list = []
-    dataset['cgrid_list'].apply(lambda cgrid_list: uniuqe_grid_list.extend(list(set(cgrid_list))))
-    uniuqe_grid_list = list(set(uniuqe_grid_list))
+    if mat_padding_value_grid is None:
+        uniuqe_grid_list = []
+        dataset['cgrid_list'].apply(lambda cgrid_list: uniuqe_grid_list.extend(list(set(cgrid_list))))
+        uniuqe_grid_list = list(set(uniuqe_grid_list))
 
-    mat_padding_value_grid = max(uniuqe_grid_list) + 1
+        mat_padding_value_grid = max(uniuqe_grid_list) + 1
     data_padding_value_grid = 0.0 
 
 
     # 处理route
     route_data, route_assign_mat = prepare_route_data(dataset[['cpath_list', 'road_timestamp', 'road_interval']], \
-                                                    mat_padding_value, data_padding_value, route_max_len)
+                                                    mat_padding_value, data_padding_value, route_max_len, utc_offset)
     masked_route_assign_mat = route_assign_mat  # 在evaluation时，关闭mask机制
 
     # 处理gps
@@ -86,7 +100,7 @@ def prepare_data(dataset, route_min_len, route_max_len, gps_min_len, gps_max_len
                                                     'lng_list', 'lat_list', \
                                                     'speed', 'acceleration', \
                                                     'angle_delta', 'interval', \
-                                                    'dist']], mat_padding_value, data_padding_value, gps_max_len)
+                                                    'dist']], mat_padding_value, data_padding_value, gps_max_len, gps_feature_stats)
     masked_gps_assign_mat = gps_assign_mat # 在evaluation时，关闭mask机制
 
     gps_length_grid = dataset['ogrid_list'].apply(
@@ -97,128 +111,259 @@ def prepare_data(dataset, route_min_len, route_max_len, gps_min_len, gps_max_len
                                                         'lng_list', 'lat_list',\
                                                         'speed', 'acceleration',\
                                                         'angle_delta', 'interval',\
-                                                        'dist']], mat_padding_value_grid, data_padding_value_grid, gps_max_len)
+                                                        'dist']], mat_padding_value_grid, data_padding_value_grid, gps_max_len,
+                                                        gps_feature_stats)
     masked_gps_assign_mat_grid = gps_assign_mat_grid
     grid_data, grid_assign_mat = prepare_grid_data(dataset[['cgrid_list', 'grid_timestamp','grid_interval','grid_fea']],\
-                                                        mat_padding_value_grid, data_padding_value_grid, grid_max_len)
+                                                        mat_padding_value_grid, data_padding_value_grid, grid_max_len, utc_offset)
     masked_grid_assign_mat = grid_assign_mat
     return route_data, masked_route_assign_mat, gps_data, masked_gps_assign_mat, route_assign_mat, \
             grid_data, masked_grid_assign_mat, gps_data_grid, masked_gps_assign_mat_grid, grid_assign_mat, \
             gps_length, gps_length_grid, dataset, mat_padding_value, mat_padding_value_grid
 
-# 从全量的训练数据中采样部分数据，并保证出现的路段种类尽可能多
-def fair_sampling(df,num_samples):
-    road_list = []
-    df['cpath_list'].apply(lambda row: road_list.extend(row))
-    road_count = {}
-    for rid in set(road_list):
-        count = road_list.count(rid)
-        road_count[rid] = 1/math.log(math.exp(1)+count)
+PREPARED_NAMES = ('route_data', 'masked_route_assign_mat', 'gps_data', 'masked_gps_assign_mat', 'route_assign_mat',
+                  'grid_data', 'masked_grid_assign_mat', 'gps_data_grid', 'masked_gps_assign_mat_grid', 'grid_assign_mat',
+                  'gps_length', 'gps_length_grid', 'dataset', 'mat_padding_value', 'mat_padding_value_grid')
+# evaluation 时关闭了 mask 机制，masked_* 与原矩阵是同一个 tensor，只缓存一份
+MASKED_ALIASES = {'masked_route_assign_mat': 'route_assign_mat', 'masked_grid_assign_mat': 'grid_assign_mat'}
+# 下游任务用到的 dataset 列，缓存中只保存这些列，不保存 gps 点等大的列
+TASK_COLUMNS = ('cpath_list', 'route_length', 'total_time', 'pre_label')
+
+# 从数据文件准备评估数据，结果按 (数据文件的路径/大小/修改时间, 长度过滤, 预处理参数) 缓存在 cache_dir 中
+# preprocess(dataset, **preprocess_params) 在 prepare_data 之前执行，如采样，需要是确定性的
+def prepare_data_from_file(data_path, route_min_len, route_max_len, gps_min_len, gps_max_len, grid_min_len, grid_max_len,
+                           utc_offset=UTC_OFFSET, cache_dir=None, preprocess=None, **preprocess_params):
+    def build():
+        dataset = load_trajectories(data_path)
+        if preprocess is not None:
+            dataset = preprocess(dataset, **preprocess_params)
+        prepared = dict(zip(PREPARED_NAMES, prepare_data(dataset, route_min_len, route_max_len, gps_min_len, gps_max_len,
+                                                         grid_min_len, grid_max_len, utc_offset)))
+        dataset = prepared['dataset']
+        prepared['dataset'] = dataset[[name for name in TASK_COLUMNS if name in dataset.columns]]
+        return {name: item for name, item in prepared.items() if name not in MASKED_ALIASES}
+
+    params = {'loader': 'eval', 'columns': TASK_COLUMNS, 'route_min_len': route_min_len, 'route_max_len': route_max_len,
+              'gps_min_len': gps_min_len, 'gps_max_len': gps_max_len, 'grid_min_len': grid_min_len,
+              'grid_max_len': grid_max_len, 'utc_offset': utc_offset,
+              'preprocess': None if preprocess is None else preprocess.__name__, 'preprocess_params': preprocess_params}
+    prepared = cached_call(cache_dir, data_path, params, build)
+    return tuple(prepared[MASKED_ALIASES.get(name, name)] for name in PREPARED_NAMES)
+
+# 随机采样固定数量的轨迹，可作为 prepare_data_from_file 的 preprocess
+def sample_trajectories(df, num_samples, random_state=0):
+    return df.sample(num_samples, random_state=random_state)
+
+# 每条轨迹的采样权重：路段的权重为 1/log(e + 该路段在数据中出现的次数)，轨迹取所经过路段权重的最大值
+# 在拼接后的路段数组上 bincount + reduceat 计算，O(总路段数)
+def road_frequency_weights(df):
+    values, lengths = ragged_arrays(df['cpath_list'])
+    values = np.asarray(values, dtype=np.int64)
+    road_weight = 1 / np.log(np.e + np.bincount(values))
+
+    prob = np.zeros(len(lengths))
+    nonempty = lengths > 0
+    starts = (np.cumsum(lengths) - lengths)[nonempty]
+    prob[nonempty] = np.maximum.reduceat(road_weight[values], starts)
+    return prob
+
+def _take_sampled(df, rows, prob):
+    # 与 DataFrame.sample 一样保留原来的 index，并附上 prob 列
+    if isinstance(df, TrajFrame):
+        sampled = df.take(rows)
+        return TrajFrame([(name, sampled[name]) for name in sampled.columns] + [('prob', prob[rows])])
+    df['prob'] = prob
+    return df.iloc[rows]
 
-    df['prob'] = df['cpath_list'].apply(lambda cpath_list: max([road_count[cpath] for cpath in cpath_list]))
-    df = df.sample(num_samples, weights=df['prob'])
-    return df
+# 从全量的训练数据中采样部分数据，并保证出现的路段种类尽可能多
+# df 可以是 DataFrame 或 TrajFrame；DataFrame 给定相同 random_state 时与原来 df.sample(weights=prob) 的采样结果一致
+def fair_sampling(df, num_samples, random_state=None):
+    prob = road_frequency_weights(df)
+    rng = np.random if random_state is None else np.random.RandomState(random_state) # 与 DataFrame.sample 一致
+    rows = rng.choice(len(prob), size=num_samples, replace=False, p=prob / prob.sum())
+    return _take_sampled(df, rows, prob)
+
+# 分层覆盖采样：保证数据中出现过的每个路段至少被 min(k, 经过该路段的轨迹数) 条采样轨迹经过
+# 从最稀有的路段开始，在经过该路段且未被采样的轨迹中优先选经过路段种类最多的（相同时随机），剩余名额按 fair_sampling 的权重采样
+# 覆盖需要的轨迹数超过 num_samples 时返回全部覆盖轨迹并给出警告
+def coverage_sampling(df, num_samples, k=1, random_state=0):
+    rng = np.random.RandomState(random_state)
+    values, lengths = ragged_arrays(df['cpath_list'])
+    values = np.asarray(values, dtype=np.int64)
+    num_traj = len(lengths)
+    num_roads = int(values.max()) + 1 if len(values) > 0 else 0
+
+    # 每条轨迹经过的不同路段，(轨迹, 路段) 对按轨迹排序，traj_offsets 为每条轨迹的起点
+    pairs = np.unique(np.repeat(np.arange(num_traj, dtype=np.int64), lengths) * num_roads + values)
+    pair_traj, pair_road = pairs // num_roads, pairs % num_roads
+    traj_offsets = np.searchsorted(pair_traj, np.arange(num_traj + 1))
+    num_distinct = np.diff(traj_offsets)
+
+    # 路段 -> 经过该路段的轨迹的倒排索引，同一路段内按经过路段种类数从多到少排列
+    order = np.lexsort((rng.permutation(num_traj)[pair_traj], -num_distinct[pair_traj], pair_road))
+    road_traj = pair_traj[order]
+    road_offsets = np.searchsorted(pair_road[order], np.arange(num_roads + 1))
+    road_total = np.diff(road_offsets)
+    need = np.minimum(k, road_total)
+
+    coverage = np.zeros(num_roads, dtype=np.int64)
+    selected = np.zeros(num_traj, dtype=bool)
+    for road in np.argsort(road_total, kind='stable'):
+        if coverage[road] >= need[road]:
+            continue
+        candidates = road_traj[road_offsets[road]:road_offsets[road + 1]]
+        candidates = candidates[~selected[candidates]][:need[road] - coverage[road]]
+        selected[candidates] = True
+        for traj in candidates:
+            coverage[pair_road[traj_offsets[traj]:traj_offsets[traj + 1]]] += 1
+
+    prob = road_frequency_weights(df)
+    rows = np.nonzero(selected)[0]
+    if len(rows) > num_samples:
+        warnings.warn('{} trajectories are needed to cover every road {} times, more than num_samples={}'.format(
+            len(rows), k, num_samples))
+    elif len(rows) < num_samples:
+        rest = np.nonzero(~selected)[0]
+        extra = rng.choice(rest, size=num_samples - len(rows), replace=False, p=prob[rest] / prob[rest].sum())
+        rows = np.sort(np.concatenate([rows, extra]))
+    return _take_sampled(df, rows, prob)
+
+# 观测到的路段的表示：该路段在所有轨迹中出现的位置上 gps / route 两个视角表示的均值
+# 按路段 id 一次 index_add 得到每个路段的表示之和与出现次数，road_list 之外的 id（如 padding）不参与
+def scatter_road_mean(road_list, gps_road_joint_rep, route_road_joint_rep, route_assign_mat, num_roads, device):
+    num_traj, max_len, hidden_size = gps_road_joint_rep.shape
+    rep_device = gps_road_joint_rep.device
+    road_ids = route_assign_mat[:num_traj, :max_len].long().reshape(-1).to(rep_device)
+    observed = torch.zeros(max(num_roads, int(road_ids.max()) + 1), dtype=torch.bool, device=rep_device)
+    observed[torch.as_tensor(road_list, dtype=torch.long, device=rep_device)] = True
+    keep = observed[road_ids]
+    road_ids = road_ids[keep]
+
+    # 用 float64 累加，与逐路段 torch.mean 的结果一致
+    road_rep = gps_road_joint_rep.reshape(-1, hidden_size)[keep].double() + route_road_joint_rep.reshape(-1, hidden_size)[keep].double()
+    road_sum = torch.zeros((num_roads, hidden_size), dtype=torch.float64, device=rep_device).index_add_(0, road_ids, road_rep)
+    road_count = torch.bincount(road_ids, minlength=num_roads)
+    road_embedding = road_sum / (2 * road_count).clamp(min=1).unsqueeze(1)
+    return road_embedding.float().to(device), road_count.to(device)
+
+# 未被观测到（表示全为0）的路段用 road_rep 中对应的行补充
+def fill_unseen_roads(road_embedding, road_rep):
+    unseen = torch.sum(road_embedding, dim=1) == 0
+    road_embedding[unseen] = road_rep[unseen]
+    return road_embedding
 
 # 没见过的路段用邻域的embedding的平均值补充
-def get_road_embedding1(road_list,gps_road_joint_rep,route_road_joint_rep,route_assign_mat,seq_model):
-    # 处理在训练时被观测到的路段
-    road_joint_rep = torch.cat([gps_road_joint_rep.unsqueeze(2), route_road_joint_rep.unsqueeze(2)], dim=2)
-    road_embedding = torch.zeros((seq_model.node_embedding.weight.shape[0], road_joint_rep.shape[-1])).cuda()
-    route_assign_mat = route_assign_mat[:road_joint_rep.shape[0]]
-    for road_id in road_list:
-        indexes = torch.nonzero(route_assign_mat==road_id)
-        rep_list = [road_joint_rep[index[0]][index[1]] for index in indexes]
-        road_rep = torch.cat(rep_list, dim=0)
-        road_rep = torch.mean(road_rep, dim=0)
-        road_embedding[road_id] = road_rep
-
-    # 处理在训练时被未被观测到的路段
+def fill_unseen_by_neighbors(road_embedding, seq_model):
     aggregator = MeanAggregator() # 邻居的均值
     road_rep = aggregator(road_embedding, seq_model.edge_index)
-    indexes = torch.nonzero(torch.sum(road_embedding, dim=1) == 0)
-    for index in indexes:
-        road_embedding[index.item()] = road_rep[index.item()]
-
-    return road_embedding.detach()
+    return fill_unseen_roads(road_embedding, road_rep)
 
 # 没见过的路段用邻域的embedding的加权平均值补充
-def get_road_embedding2(road_list, gps_road_joint_rep, route_road_joint_rep, route_assign_mat, seq_model, city):
-    # 处理在训练时被观测到的路段
+def fill_unseen_by_weighted_neighbors(road_embedding, seq_model, city):
     weight_path = '/data/mazp/dataset/JMTR/didi_{}/transition_prob_mat.npy'.format(city)
-    road_joint_rep = torch.cat([gps_road_joint_rep.unsqueeze(2), route_road_joint_rep.unsqueeze(2)], dim=2)
-    road_embedding = torch.zeros((seq_model.node_embedding.weight.shape[0], road_joint_rep.shape[-1])).cuda()
-    route_assign_mat = route_assign_mat[:road_joint_rep.shape[0]]
-
-    for road_id in road_list:
-        indexes = torch.nonzero(route_assign_mat==road_id)
-        rep_list = [road_joint_rep[index[0]][index[1]] for index in indexes]
-        road_rep = torch.cat(rep_list, dim=0)
-        road_rep = torch.mean(road_rep, dim=0)
-        road_embedding[road_id] = road_rep
-
-    # 处理在训练时被未被观测到的路段
     trans_mat = np.load(weight_path)
-    weights = []
-    for i, j in seq_model.edge_index.transpose(0, 1):
-        weights.append(trans_mat[i][j])
-    weights = torch.tensor(weights).cuda()
+    edge_index = seq_model.edge_index.cpu().numpy()
+    weights = torch.tensor(trans_mat[edge_index[0], edge_index[1]], device=road_embedding.device)
 
     aggregator = WeightedMeanAggregator() # 邻居的加权均值
     road_rep = aggregator(road_embedding, seq_model.edge_index, weights)
-    indexes = torch.nonzero(torch.sum(road_embedding, dim=1)==0)
-    for index in indexes:
-        road_embedding[index.item()] = road_rep[index.item()]
-
-    return road_embedding.detach()
+    return fill_unseen_roads(road_embedding, road_rep)
 
 # 没见过的路段用路段作为序列长度为1的序列输入route_encoder得到
-def get_road_embedding3(road_list, gps_road_joint_rep, route_road_joint_rep, route_assign_mat, seq_model):
-    # 处理在训练时被观测到的路段
-    road_joint_rep = torch.cat([gps_road_joint_rep.unsqueeze(2), route_road_joint_rep.unsqueeze(2)], dim=2)
-    road_embedding = torch.zeros((seq_model.node_embedding.weight.shape[0], road_joint_rep.shape[-1])).cuda()
-    route_assign_mat = route_assign_mat[:road_joint_rep.shape[0]]
-    for road_id in road_list:
-        indexes = torch.nonzero(route_assign_mat==road_id)
-        rep_list = [road_joint_rep[index[0]][index[1]] for index in indexes]
-        road_rep = torch.cat(rep_list, dim=0)
-        road_rep = torch.mean(road_rep, dim=0)
-        road_embedding[road_id] = road_rep.cuda()
+def fill_unseen_by_route_encoder(road_embedding, seq_model, batch_size=4096):
+    unseen = torch.nonzero(torch.sum(road_embedding, dim=1) == 0).view(-1)
+    road_embedding[unseen] = seq_model.encode_single(unseen, view='route', batch_size=batch_size).to(road_embedding)
+    return road_embedding
 
+def get_road_embedding1(road_list,gps_road_joint_rep,route_road_joint_rep,route_assign_mat,seq_model):
+    # 处理在训练时被观测到的路段
+    road_embedding, _ = scatter_road_mean(road_list, gps_road_joint_rep, route_road_joint_rep, route_assign_mat,
+                                          seq_model.node_embedding.weight.shape[0], model_device(seq_model))
     # 处理在训练时被未被观测到的路段
-    indexes = torch.nonzero(torch.sum(road_embedding, dim=1) == 0)
-    unseen_route_assign_mat = indexes
-    road_rep, _ = seq_model.encode_route(None, unseen_route_assign_mat, unseen_route_assign_mat)
-    for i, index in enumerate(indexes):
-        road_embedding[index.item()] = road_rep[i]
+    return fill_unseen_by_neighbors(road_embedding, seq_model).detach()
 
-    return road_embedding.detach()
+def get_road_embedding2(road_list, gps_road_joint_rep, route_road_joint_rep, route_assign_mat, seq_model, city):
+    road_embedding, _ = scatter_road_mean(road_list, gps_road_joint_rep, route_road_joint_rep, route_assign_mat,
+                                          seq_model.node_embedding.weight.shape[0], model_device(seq_model))
+    return fill_unseen_by_weighted_neighbors(road_embedding, seq_model, city).detach()
 
+def get_road_embedding3(road_list, gps_road_joint_rep, route_road_joint_rep, route_assign_mat, seq_model):
+    road_embedding, _ = scatter_road_mean(road_list, gps_road_joint_rep, route_road_joint_rep, route_assign_mat,
+                                          seq_model.node_embedding.weight.shape[0], model_device(seq_model))
+    return fill_unseen_by_route_encoder(road_embedding, seq_model).detach()
 
-# 没见过的路段用路段作为序列长度为1的序列输入route_encoder得到
 def get_road_embedding4(road_list, gps_road_joint_rep, route_road_joint_rep, route_assign_mat, seq_model):
-    # 处理在训练时被观测到的路段
-    road_joint_rep = torch.cat([gps_road_joint_rep.unsqueeze(2), route_road_joint_rep.unsqueeze(2)], dim=2)
-    road_embedding = torch.zeros((seq_model.node_embedding.weight.shape[0], road_joint_rep.shape[-1])).cuda()
-    route_assign_mat = route_assign_mat[:road_joint_rep.shape[0]]
-    for road_id in road_list:
-        indexes = torch.nonzero(route_assign_mat==road_id)
-        rep_list = [road_joint_rep[index[0]][index[1]] for index in indexes]
-        road_rep = torch.cat(rep_list, dim=0)
-        road_rep = torch.mean(road_rep, dim=0)
-        road_embedding[road_id] = road_rep.cuda()
-
-    # 处理在训练时被未被观测到的路段
-    indexes = torch.nonzero(torch.sum(road_embedding, dim=1) == 0)
-    unseen_route_assign_mat = indexes
-    road_rep, _ = seq_model.encode_route(None, unseen_route_assign_mat, unseen_route_assign_mat)
-    for i, index in enumerate(indexes):
-        road_embedding[index.item()] = road_rep[i]
-
-    return road_embedding.detach()
+    road_embedding, _ = scatter_road_mean(road_list, gps_road_joint_rep, route_road_joint_rep, route_assign_mat,
+                                          seq_model.node_embedding.weight.shape[0], model_device(seq_model))
+    return fill_unseen_by_route_encoder(road_embedding, seq_model).detach()
+
+class RoadAccumulator(object):
+    """
+    按路段 id 在线累加 token 表示：每个 batch 折叠进 (num_roads, hidden_size) 的 sum 和 count，
+    welford=True 时同时维护每个路段的均值和平方差之和（Welford / Chan 合并），用于求方差
+    内存为 O(num_roads * hidden_size)，与轨迹数无关；state_dict / load_state_dict 用于中断后续算
+    """
+    def __init__(self, num_roads, hidden_size, device, welford=False):
+        self.sum = torch.zeros((num_roads, hidden_size), dtype=torch.float64, device=device)
+        self.count = torch.zeros(num_roads, dtype=torch.long, device=device)
+        self.welford = welford
+        if welford:
+            self.m2 = torch.zeros_like(self.sum)
+        self.num_batches = 0 # 已累加的 batch 数
+
+    def update(self, road_rep, road_ids):
+        # road_rep (token_num, hidden_size)，road_ids (token_num,)
+        road_rep = road_rep.to(self.sum.device, torch.float64)
+        road_ids = road_ids.to(self.sum.device).long()
+        batch_sum = torch.zeros_like(self.sum).index_add_(0, road_ids, road_rep)
+        batch_count = torch.bincount(road_ids, minlength=self.count.shape[0])
+        if self.welford:
+            # batch 内的均值和平方差之和，再与之前的统计量合并
+            batch_mean = batch_sum / batch_count.clamp(min=1).unsqueeze(1)
+            batch_m2 = torch.zeros_like(self.sum).index_add_(0, road_ids, (road_rep - batch_mean[road_ids]) ** 2)
+            total = (self.count + batch_count).clamp(min=1).unsqueeze(1).double()
+            delta = batch_mean - self.mean()
+            self.m2 += batch_m2 + delta ** 2 * (self.count * batch_count).unsqueeze(1).double() / total
+        self.sum += batch_sum
+        self.count += batch_count
+
+    def update_batch(self, road_reps, assign_mat, padding_value):
+        # road_reps 为多个视角的路段表示 (batch_size, max_len, hidden_size)，assign_mat 中不等于 padding_value 的位置参与累加
+        assign_mat = assign_mat[:, :road_reps[0].shape[1]].to(self.sum.device)
+        valid = assign_mat != padding_value
+        for road_rep in road_reps:
+            self.update(road_rep[:, :assign_mat.shape[1]][valid], assign_mat[valid])
+        self.num_batches += 1
+
+    def mean(self):
+        # 没有被观测到的路段为0
+        return self.sum / self.count.clamp(min=1).unsqueeze(1)
+
+    def variance(self):
+        assert self.welford, 'variance requires welford=True'
+        return self.m2 / self.count.clamp(min=1).unsqueeze(1)
+
+    def state_dict(self):
+        state = {'sum': self.sum, 'count': self.count, 'num_batches': self.num_batches}
+        if self.welford:
+            state['m2'] = self.m2
+        return state
+
+    def load_state_dict(self, state):
+        self.sum.copy_(state['sum'])
+        self.count.copy_(state['count'])
+        self.num_batches = state['num_batches']
+        if self.welford:
+            self.m2.copy_(state['m2'])
 
 # 从观测到的轨迹生成路段的表示
 # 输入的是完整的数据，包括路由与GPS
-def get_road_emb_from_traj(seq_model, test_data, without_gps=False, batch_size=1024, update_road='mean', city='chengdu'):
+# 每个 batch 的路段表示直接累加到 RoadAccumulator 中，不保存整个数据集的 token 表示；
+# 给定 checkpoint_path 时每 checkpoint_every 个 batch 保存一次累加状态，中断后以相同模型、数据和参数重新运行会从断点继续
+# welford=True 时返回 (路段表示, 每个路段表示的方差)，方差只在观测到的路段上有意义，未观测到的路段为0
+def get_road_emb_from_traj(seq_model, test_data, without_gps=False, batch_size=1024, update_road='mean', city='chengdu',
+                           checkpoint_path=None, checkpoint_every=50, welford=False):
+    device = model_device(seq_model)
     assert update_road in ['mean', 'weight', 'route'], 'update_road must be one of [\'mean\', \'weight\', \'route\']'
 
     route_data, masked_route_assign_mat, gps_data, masked_gps_assign_mat, route_assign_mat, \
@@ -230,68 +375,49 @@ def get_road_emb_from_traj(seq_model, test_data, without_gps=False, batch_size=1
         masked_gps_assign_mat = torch.zeros_like(masked_gps_assign_mat) # 无实际意义，用于补位
         gps_length = torch.ones_like(gps_length) # 无实际意义，用于补位
 
-    # 都放到显存里面放不下，需要分batch处理
-    max_len = dataset['route_length'].max()
-    with torch.no_grad():
-        gps_road_joint_rep_list, route_road_joint_rep_list = [], []
-        for i in range(route_data.shape[0] // batch_size + 1):  # 最后不足batch_size的case不要了
-            start_idx = i * batch_size
-            end_idx = (i + 1) * batch_size
-            if end_idx > route_data.shape[0]:
-                end_idx = None
-            batch_route_data = route_data[start_idx:end_idx].cuda()
-            batch_masked_route_assign_mat = masked_route_assign_mat[start_idx:end_idx].cuda()
-            batch_gps_data = gps_data[start_idx:end_idx].cuda()
-            batch_masked_gps_assign_mat = masked_gps_assign_mat[start_idx:end_idx].cuda()
-            batch_route_assign_mat = route_assign_mat[start_idx:end_idx].cuda()
-            batch_gps_length = gps_length[start_idx:end_idx].cuda()
-
-            batch_grid_data = grid_data[start_idx:end_idx].cuda()
-            batch_masked_grid_assign_mat = masked_grid_assign_mat[start_idx:end_idx].cuda()
-            batch_gps_data_grid = gps_data_grid[start_idx:end_idx].cuda()
-            batch_masked_gps_assign_mat_grid = masked_gps_assign_mat_grid[start_idx:end_idx].cuda()
-            batch_grid_assign_mat = grid_assign_mat[start_idx:end_idx].cuda()
-            batch_gps_length_grid = gps_length_grid[start_idx:end_idx].cuda()
-
-            _, _, _, _, _, _, _, _, _, _, _, _, gps_road_joint_rep, route_road_joint_rep, gps_grid_joint_rep, grid_road_joint_rep \
-                = seq_model(batch_route_data, batch_masked_route_assign_mat, batch_gps_data,
-                            batch_masked_gps_assign_mat, batch_route_assign_mat, batch_gps_length,
-                            batch_grid_data, batch_masked_grid_assign_mat, batch_gps_data_grid,
-                            batch_masked_gps_assign_mat_grid, batch_grid_assign_mat, batch_gps_length_grid
-                            )
-            del batch_route_data, batch_masked_route_assign_mat, batch_gps_data, batch_masked_gps_assign_mat, batch_route_assign_mat, batch_gps_length, \
-                batch_grid_data, batch_masked_grid_assign_mat, batch_gps_data_grid, batch_masked_gps_assign_mat_grid, batch_grid_assign_mat, batch_gps_length_grid
-            padding = torch.zeros(
-                (
-                gps_road_joint_rep.shape[0], max_len - gps_road_joint_rep.shape[1], gps_road_joint_rep.shape[2])).cuda()
-
-            gps_road_joint_rep = torch.cat([gps_road_joint_rep, padding], dim=1).cpu()
-            route_road_joint_rep = torch.cat([route_road_joint_rep, padding], dim=1).cpu()
+    accumulator = RoadAccumulator(seq_model.node_embedding.weight.shape[0], seq_model.fc2.out_features, device, welford)
+    checkpoint_meta = {'model': model_fingerprint(seq_model) if checkpoint_path is not None else None,
+                       'data': tensor_fingerprint(route_assign_mat, masked_gps_assign_mat, grid_assign_mat)
+                       if checkpoint_path is not None else None,
+                       'num_traj': route_data.shape[0], 'batch_size': batch_size, 'without_gps': without_gps, 'welford': welford}
+    if checkpoint_path is not None and os.path.exists(checkpoint_path):
+        checkpoint = torch.load(checkpoint_path, map_location=device)
+        if checkpoint['meta'] == checkpoint_meta:
+            accumulator.load_state_dict(checkpoint['accumulator'])
+            print('resume road embedding from batch {}'.format(accumulator.num_batches))
 
-            gps_road_joint_rep_list.append(gps_road_joint_rep)
-            route_road_joint_rep_list.append(route_road_joint_rep)
-
-            del gps_road_joint_rep, route_road_joint_rep, gps_grid_joint_rep, grid_road_joint_rep
-            # torch.cuda.empty_cache() # 清空显存
-
-    gps_road_joint_rep = torch.cat(gps_road_joint_rep_list, dim=0).cpu()  # 注意gps_road_joint_rep_list中不能为空
-    route_road_joint_rep = torch.cat(gps_road_joint_rep_list, dim=0).cpu()
+    # 都放到显存里面放不下，需要分batch处理
+    for start_idx in range(accumulator.num_batches * batch_size, route_data.shape[0], batch_size):
+        end_idx = start_idx + batch_size
+        batch = [item[start_idx:end_idx].to(device) for item in (
+            route_data, masked_route_assign_mat, gps_data, masked_gps_assign_mat, route_assign_mat, gps_length,
+            grid_data, masked_grid_assign_mat, gps_data_grid, masked_gps_assign_mat_grid, grid_assign_mat, gps_length_grid)]
+        reps = seq_model.encode(batch, outputs=('road',))
+        # gps 和 route 两个视角的表示都计入路段的均值
+        accumulator.update_batch([reps['gps_road'], reps['route_road']], batch[4], seq_model.vocab_size)
+        del batch, reps
+
+        if checkpoint_path is not None and accumulator.num_batches % checkpoint_every == 0:
+            # 先写临时文件再 os.replace，保存时中断不会留下不完整的 checkpoint
+            torch.save({'meta': checkpoint_meta, 'accumulator': accumulator.state_dict()}, checkpoint_path + '.tmp')
+            os.replace(checkpoint_path + '.tmp', checkpoint_path)
 
     road_list = get_road(dataset)
     print('number of roads observed: {}'.format(len(road_list)))
 
+    road_embedding = accumulator.mean().float()
     if update_road == 'mean':
-        road_embedding = get_road_embedding1(road_list, gps_road_joint_rep, route_road_joint_rep, route_assign_mat,
-                                            seq_model)
+        road_embedding = fill_unseen_by_neighbors(road_embedding, seq_model)
     elif update_road == 'weight':
-        road_embedding = get_road_embedding2(road_list, gps_road_joint_rep, route_road_joint_rep, route_assign_mat,
-                                            seq_model, city)
+        road_embedding = fill_unseen_by_weighted_neighbors(road_embedding, seq_model, city)
     elif update_road == 'route':
-        road_embedding = get_road_embedding3(road_list, gps_road_joint_rep, route_road_joint_rep, route_assign_mat,
-                                            seq_model)
-    return road_embedding
+        road_embedding = fill_unseen_by_route_encoder(road_embedding, seq_model)
+    if welford:
+        return road_embedding.detach(), accumulator.variance().float()
+    return road_embedding.detach()
 
 def get_road_emb_from_traj_nomode(seq_model, test_data, without_gps=False, batch_size=1024, update_road='mean', city='chengdu'):
+    device = model_device(seq_model)
     assert update_road in ['mean', 'weight', 'route'], 'update_road must be one of [\'mean\', \'weight\', \'route\']'
 
     route_data, masked_route_assign_mat, gps_data, masked_gps_assign_mat, route_assign_mat, gps_length, dataset = test_data
@@ -310,19 +436,19 @@ def get_road_emb_from_traj_nomode(seq_model, test_data, without_gps=False, batch
             end_idx = (i + 1) * batch_size
             if end_idx > route_data.shape[0]:
                 end_idx = None
-            batch_route_data = route_data[start_idx:end_idx].cuda()
-            batch_masked_route_assign_mat = masked_route_assign_mat[start_idx:end_idx].cuda()
-            batch_gps_data = gps_data[start_idx:end_idx].cuda()
-            batch_masked_gps_assign_mat = masked_gps_assign_mat[start_idx:end_idx].cuda()
-            batch_route_assign_mat = route_assign_mat[start_idx:end_idx].cuda()
-            batch_gps_length = gps_length[start_idx:end_idx].cuda()
+            batch_route_data = route_data[start_idx:end_idx].to(device)
+            batch_masked_route_assign_mat = masked_route_assign_mat[start_idx:end_idx].to(device)
+            batch_gps_data = gps_data[start_idx:end_idx].to(device)
+            batch_masked_gps_assign_mat = masked_gps_assign_mat[start_idx:end_idx].to(device)
+            batch_route_assign_mat = route_assign_mat[start_idx:end_idx].to(device)
+            batch_gps_length = gps_length[start_idx:end_idx].to(device)
             gps_road_rep, _, route_road_rep, _ \
                 = seq_model(batch_route_data, batch_masked_route_assign_mat, batch_gps_data,
                             batch_masked_gps_assign_mat, batch_route_assign_mat, batch_gps_length)
             del batch_route_data, batch_masked_route_assign_mat, batch_gps_data, batch_masked_gps_assign_mat, batch_route_assign_mat, batch_gps_length
             padding = torch.zeros(
                 (
-                gps_road_rep.shape[0], max_len - gps_road_rep.shape[1], gps_road_rep.shape[2])).cuda()
+                gps_road_rep.shape[0], max_len - gps_road_rep.shape[1], gps_road_rep.shape[2]), device=device)
 
             gps_road_rep = torch.cat([gps_road_rep, padding], dim=1).cpu()
             route_road_rep = torch.cat([route_road_rep, padding], dim=1).cpu()
@@ -334,7 +460,7 @@ def get_road_emb_from_traj_nomode(seq_model, test_data, without_gps=False, batch
             # torch.cuda.empty_cache() # 清空显存
 
     gps_road_rep = torch.cat(gps_road_rep_list, dim=0).cpu()  # 注意gps_road_joint_rep_list中不能为空
-    route_road_rep = torch.cat(gps_road_rep_list, dim=0).cpu()
+    route_road_rep = torch.cat(route_road_rep_list, dim=0).cpu()
 
     road_list = get_road(dataset)
     print('number of roads observed: {}'.format(len(road_list)))
@@ -353,6 +479,7 @@ def get_road_emb_from_traj_nomode(seq_model, test_data, without_gps=False, batch
 # 从观测到的轨迹生成轨迹的表示
 # 输入的是完整的数据, 包括gps
 def get_seq_emb_from_traj_withALLModel(seq_model, test_data, without_gps=False, batch_size=1024):
+    device = model_device(seq_model)
 
     route_data, masked_route_assign_mat, gps_data, masked_gps_assign_mat, route_assign_mat, \
             grid_data, masked_grid_assign_mat, gps_data_grid, masked_gps_assign_mat_grid, grid_assign_mat, \
@@ -362,79 +489,45 @@ def get_seq_emb_from_traj_withALLModel(seq_model, test_data, without_gps=False,
         masked_gps_assign_mat = torch.zeros_like(masked_gps_assign_mat)  # 无实际意义，用于补位
         gps_length = torch.ones_like(gps_length)  # 无实际意义，用于补位
 
-    # 都放到显存里面放不下，需要分batch处理
-    with torch.no_grad():
-        gps_traj_joint_rep_list, route_traj_joint_rep_list, gps_traj_grid_joint_rep_list, grid_traj_joint_rep_list = [], [], [], []
-        for i in range(route_data.shape[0] // batch_size + 1):  # 最后不足batch_size的case不要了
-            print(i, route_data.shape[0] // batch_size + 1)
-            start_idx = i * batch_size
-            end_idx = (i + 1) * batch_size
-            if end_idx > route_data.shape[0]:
-                end_idx = None
-                break
-            batch_route_data = route_data[start_idx:end_idx].cuda()
-            batch_masked_route_assign_mat = masked_route_assign_mat[start_idx:end_idx].cuda()
-            batch_gps_data = gps_data[start_idx:end_idx].cuda()
-            batch_masked_gps_assign_mat = masked_gps_assign_mat[start_idx:end_idx].cuda()
-            batch_route_assign_mat = route_assign_mat[start_idx:end_idx].cuda()
-            batch_gps_length = gps_length[start_idx:end_idx].cuda()
-
-            batch_grid_data = grid_data[start_idx:end_idx].cuda()
-            batch_masked_grid_assign_mat = masked_grid_assign_mat[start_idx:end_idx].cuda()
-            batch_gps_data_grid = gps_data_grid[start_idx:end_idx].cuda()
-            batch_masked_gps_assign_mat_grid = masked_gps_assign_mat_grid[start_idx:end_idx].cuda()
-            batch_grid_assign_mat = grid_assign_mat[start_idx:end_idx].cuda()
-            batch_gps_length_grid = gps_length_grid[start_idx:end_idx].cuda()
-
-
-            _, _, _, _, _, _, _, _,gps_traj_joint_rep, route_traj_joint_rep, gps_traj_grid_joint_rep, grid_traj_joint_rep, _, _, _, _ \
-                = seq_model(batch_route_data, batch_masked_route_assign_mat, batch_gps_data,
-                            batch_masked_gps_assign_mat, batch_route_assign_mat, batch_gps_length,
-                            batch_grid_data, batch_masked_grid_assign_mat, batch_gps_data_grid,
-                            batch_masked_gps_assign_mat_grid, batch_grid_assign_mat, batch_gps_length_grid
-                            )
-            del batch_route_data, batch_masked_route_assign_mat, batch_gps_data, batch_masked_gps_assign_mat, batch_route_assign_mat, batch_gps_length, \
-                batch_grid_data, batch_masked_grid_assign_mat, batch_gps_data_grid, batch_masked_gps_assign_mat_grid, batch_grid_assign_mat, batch_gps_length_grid
-            
-            gps_traj_joint_rep_list.append(gps_traj_joint_rep)
-            route_traj_joint_rep_list.append(route_traj_joint_rep)
-            gps_traj_grid_joint_rep_list.append(gps_traj_grid_joint_rep)
-            grid_traj_joint_rep_list.append(grid_traj_joint_rep)
-            del gps_traj_joint_rep, route_traj_joint_rep, gps_traj_grid_joint_rep, grid_traj_joint_rep
-            # torch.cuda.empty_cache() # 清空显存
-
-    gps_traj_joint_rep = torch.cat(gps_traj_joint_rep_list, dim=0)  # 注意gps_road_joint_rep_list中不能为空
-    route_traj_joint_rep = torch.cat(route_traj_joint_rep_list, dim=0)
-    gps_traj_grid_joint_rep = torch.cat(gps_traj_grid_joint_rep_list, dim=0)
-    grid_traj_joint_rep = torch.cat(grid_traj_joint_rep_list, dim=0)
-    if without_gps:
-        traj_joint_rep = route_traj_joint_rep
-    else:
-        traj_joint_rep = torch.cat([gps_traj_joint_rep.unsqueeze(1), route_traj_joint_rep.unsqueeze(1), gps_traj_grid_joint_rep.unsqueeze(1), grid_traj_joint_rep.unsqueeze(1)], dim=2)
-        traj_joint_rep = torch.mean(traj_joint_rep, dim=1)
+    # 都放到显存里面放不下，需要分batch处理；每个batch只保留最终的轨迹表示，暂存在内存中
+    # 大数据集请使用 embedding_export.py 流式导出
+    traj_joint_rep_list = []
+    for start_idx in range(0, route_data.shape[0], batch_size):
+        end_idx = start_idx + batch_size
+        batch = [item[start_idx:end_idx].to(device) for item in (
+            route_data, masked_route_assign_mat, gps_data, masked_gps_assign_mat, route_assign_mat, gps_length,
+            grid_data, masked_grid_assign_mat, gps_data_grid, masked_gps_assign_mat_grid, grid_assign_mat, gps_length_grid)]
+        # 只需要 joint 之后的轨迹表示，不计算路段表示
+        reps = seq_model.encode(batch, outputs=('traj',))
+        del batch
+
+        if without_gps:
+            traj_joint_rep = reps['route_traj']
+        else:
+            # 四个视角的 joint 表示拼接为 (batch_size, 4 * hidden_size)
+            traj_joint_rep = torch.cat([reps['{}_traj'.format(view)] for view in QUEUE_VIEWS], dim=1)
+        traj_joint_rep_list.append(traj_joint_rep.cpu())
+        del reps, traj_joint_rep
 
+    traj_joint_rep = torch.cat(traj_joint_rep_list, dim=0).to(device)  # 与 test_data 的行一一对应，最后不足batch_size的轨迹也保留
     return traj_joint_rep
 
 def get_seq_emb_from_traj_withRouteOnly(seq_model, test_data, batch_size=1024):
+    device = model_device(seq_model)
 
     route_data, masked_route_assign_mat, _, _, route_assign_mat, _, _, _, _, _, _, _, _ = test_data
 
-    # 都放到显存里面放不下，需要分batch处理
-    with torch.no_grad():
-        route_traj_rep_list = []
-        for i in range(route_data.shape[0] // batch_size + 1):  # 最后不足batch_size的case不要了
-            start_idx = i * batch_size
-            end_idx = (i + 1) * batch_size
-            if end_idx > route_data.shape[0]:
-                end_idx = None
-            batch_route_data = route_data[start_idx:end_idx].cuda()
-            batch_masked_route_assign_mat = masked_route_assign_mat[start_idx:end_idx].cuda()
-            batch_route_assign_mat = route_assign_mat[start_idx:end_idx].cuda()
-            route_road_rep, route_traj_rep = seq_model.encode_route(batch_route_data, batch_route_assign_mat, batch_masked_route_assign_mat)
-            del batch_route_data, batch_masked_route_assign_mat, batch_route_assign_mat
-            route_traj_rep_list.append(route_traj_rep)
-            del route_traj_rep
-            # torch.cuda.empty_cache() # 清空显存
+    # 都放到显存里面放不下，需要分batch处理；只运行 route 编码器
+    route_traj_rep_list = []
+    for start_idx in range(0, route_data.shape[0], batch_size):
+        end_idx = start_idx + batch_size
+        batch_route_data = route_data[start_idx:end_idx].to(device)
+        batch_masked_route_assign_mat = masked_route_assign_mat[start_idx:end_idx].to(device)
+        batch_route_assign_mat = route_assign_mat[start_idx:end_idx].to(device)
+        batch = (batch_route_data, batch_masked_route_assign_mat, None, None, batch_route_assign_mat, None,
+                 None, None, None, None, None, None)
+        route_traj_rep_list.append(seq_model.encode(batch, views=('route',), outputs=('traj',))['route_traj'])
+        del batch, batch_route_data, batch_masked_route_assign_mat, batch_route_assign_mat
 
     route_traj_rep = torch.cat(route_traj_rep_list, dim=0)
 
@@ -464,6 +557,6 @@ def get_seq_emb_from_node(node_embedding, route_assgin_mat, route_length, batch_
         batch_seq_rep = torch.stack(batch_seq_rep, dim=0).squeeze(1)
         all_seq_rep .append(batch_seq_rep)
 
-    all_seq_rep = torch.cat(all_seq_rep, dim=0).cuda()
+    all_seq_rep = torch.cat(all_seq_rep, dim=0).to(node_embedding.device)
 
     return all_seq_rep
\ No newline at end of file
@@ -3,23 +3,142 @@ import torch.nn.functional as F
 import torch.nn as nn
 from transformers import get_linear_schedule_with_warmup, AdamW
 from utils import weight_init
-from dataloader import get_train_loader, random_mask
-from utils import setup_seed
+from dataloader import get_train_loader, DevicePrefetcher
+from utils import setup_seed, autocast, make_grad_scaler, reset_peak_memory, peak_memory_mb
 import numpy as np
 import json
 from torch.utils.tensorboard import SummaryWriter
 from datetime import datetime
-from MVTraj import MVTraj
-from cl_loss import get_traj_cl_loss, get_road_cl_loss, get_traj_cluster_loss, get_traj_match_loss
+from MVTraj import MVTraj, QUEUE_VIEWS
+from cl_loss import get_traj_cl_loss, get_road_cl_loss, get_traj_cluster_loss, get_traj_match_loss, gather_traj_rep
 # from dcl import DCL
 import os
-
-dev_id = 0
-os.environ['CUDA_VISIBLE_DEVICES'] = str(dev_id)
-torch.cuda.set_device(dev_id)
-torch.set_num_threads(10)
-
-def train(config):
+import copy
+import time
+import contextlib
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from torch.nn.parallel import DistributedDataParallel as DDP
+
+def get_pretrain_loss(model, batch, match_hard_k=0, use_queue=False):
+    """
+    一个 batch (TrainBatch) 的预训练 loss
+
+    Returns:
+        loss, 各项 loss {tensorboard tag: loss},
+        投影后的轨迹表示 (gps, route, gps_grid, grid)，DDP 训练时为所有 rank 的表示按 rank 顺序拼接，用于写入负样本队列
+    """
+    route_assign_mat, masked_route_assign_mat = batch.route_assign_mat, batch.masked_route_assign_mat
+    grid_assign_mat, masked_grid_assign_mat = batch.grid_assign_mat, batch.masked_grid_assign_mat
+
+    # route-gps 4个 、、grid-gps 4个 、、 过joint后的 head表示，  MLM表示
+    gps_road_rep, gps_traj_rep, route_road_rep, route_traj_rep, \
+    gps_grid_rep, gps_traj_grid_rep, grid_road_rep, grid_traj_rep, \
+    gps_traj_joint_rep, route_traj_joint_rep, gps_traj_grid_joint_rep, grid_traj_joint_rep, \
+    gps_road_joint_rep, route_road_joint_rep, gps_grid_joint_rep, grid_road_joint_rep \
+        = model(*batch)
+
+    # project rep into the same space
+    gps_traj_rep, route_traj_rep, gps_traj_grid_rep, grid_traj_rep = \
+        model.project_traj(gps_traj_rep, route_traj_rep, gps_traj_grid_rep, grid_traj_rep)
+    # 额外的负样本候选：DDP 下其他 rank 的表示（对比的 batch 随 world_size 增大）和队列中之前 batch 的表示
+    queue, gathered = {}, []
+    for view, rep in zip(QUEUE_VIEWS, [gps_traj_rep, route_traj_rep, gps_traj_grid_rep, grid_traj_rep]):
+        others, all_reps = gather_traj_rep(rep)
+        gathered.append(all_reps)
+        queue[view] = torch.cat([F.normalize(others, dim=1)] + ([model.queued(view)] if use_queue else []), dim=0)
+    if queue['gps'].shape[0] == 0:
+        queue = None
+    batch_size = gps_traj_rep.shape[0]
+
+    # (GRM LOSS) get gps & route rep matching loss
+    tau = 0.07
+    match_loss = get_traj_match_loss(gps_traj_rep, route_traj_rep, model, batch_size, tau, match_hard_k,
+                                     None if queue is None else (queue['gps'], queue['route']))
+    # (GRM LOSS) get gps & grid rep matching loss
+    tau2 = 0.07
+    match_loss2 = get_traj_match_loss(gps_traj_grid_rep, grid_traj_rep, model, batch_size, tau2, match_hard_k,
+                                      None if queue is None else (queue['gps_grid'], queue['grid']))
+    # (GRM LOSS) get gps1 & gps2 rep matching loss
+    tau3 = 0.07
+    match_loss3 = get_traj_match_loss(gps_traj_rep, gps_traj_grid_rep, model, batch_size, tau3, match_hard_k,
+                                      None if queue is None else (queue['gps'], queue['gps_grid']))
+
+    # prepare label and mask_pos: 被 mask 的 (轨迹, 路段) 位置，按行优先顺序，padding 位不会被 mask
+    # route 和 gps mask 位置是一样的；joint rep 的宽度为 batch 内最大路段数
+    road_len = route_road_joint_rep.shape[1]
+    masked_pos = torch.nonzero(route_assign_mat[:, :road_len] != masked_route_assign_mat[:, :road_len], as_tuple=True)
+    y_label = route_assign_mat[masked_pos].long()
+
+    # (MLM 1 LOSS) get gps rep road loss
+    gps_mlm_loss = model.gps_mlm_head.loss(gps_road_joint_rep[masked_pos], y_label) # project head 也会被更新
+
+    # (MLM 2 LOSS) get route rep road loss
+    route_mlm_loss = model.route_mlm_head.loss(route_road_joint_rep[masked_pos], y_label) # project head 也会被更新
+
+    # prepare label and mask_pos: grid 和 gps mask 位置是一样的
+    grid_len = grid_road_joint_rep.shape[1]
+    masked_pos_grid = torch.nonzero(grid_assign_mat[:, :grid_len] != masked_grid_assign_mat[:, :grid_len], as_tuple=True)
+    y_label_grid = grid_assign_mat[masked_pos_grid].long()
+
+    # (MLM 3 LOSS) get gps2 rep road loss
+    gps_grid_mlm_loss = model.gps_grid_mlm_head.loss(gps_grid_joint_rep[masked_pos_grid], y_label_grid) # project head 也会被更新
+
+    # (MLM 4 LOSS) get grid rep road loss
+    grid_mlm_loss = model.grid_mlm_head.loss(grid_road_joint_rep[masked_pos_grid], y_label_grid) # project head 也会被更新
+
+    # MLM 1 LOSS + MLM 2 LOSS + GRM LOSS
+    loss = (2*route_mlm_loss + 2*gps_mlm_loss + 1*match_loss + \
+            2*grid_mlm_loss + 2*gps_grid_mlm_loss + 1*match_loss2 + 1*match_loss3) / 7
+
+    losses = {
+        'match_loss/match_loss': match_loss,
+        'mlm_loss/gps_mlm_loss': gps_mlm_loss,
+        'mlm_loss/route_mlm_loss': route_mlm_loss,
+        'match_loss/match_loss2': match_loss2,
+        'mlm_loss/gps_grid_mlm_loss': gps_grid_mlm_loss,
+        'mlm_loss/grid_mlm_loss': grid_mlm_loss,
+        'match_loss/match_loss3': match_loss3,
+    }
+    return loss, losses, tuple(gathered)
+
+class PretrainModule(nn.Module):
+    """
+    MVTraj 的 forward 和 loss 计算 (project / mlm / matching head) 放在同一个 forward 中，
+    DDP 只能同步在 forward 中用到的参数
+    """
+    def __init__(self, model, match_hard_k=0, use_queue=False):
+        super(PretrainModule, self).__init__()
+        self.model = model
+        self.match_hard_k = match_hard_k
+        self.use_queue = use_queue
+
+    def forward(self, batch):
+        return get_pretrain_loss(self.model, batch, self.match_hard_k, self.use_queue)
+
+def optimizer_step(model, optimizer, scaler, grad_clip=0):
+    # grad_clip > 0 时先 unscale 再按全局范数裁剪；fp16 下梯度出现 inf/nan 时 scaler 跳过这一步并减小 scale
+    if grad_clip > 0:
+        scaler.unscale_(optimizer)
+        nn.utils.clip_grad_norm_(model.parameters(), grad_clip)
+    scaler.step(optimizer)
+    scaler.update()
+    optimizer.zero_grad()
+
+def dist_context(config, local_rank=0):
+    """
+    (rank, local_rank, world_size, nproc_per_node, init_method)
+    torchrun 启动时从环境变量 RANK / LOCAL_RANK / WORLD_SIZE / LOCAL_WORLD_SIZE 读取；
+    否则由 config 的 node_rank / nproc_per_node 计算：rank = node_rank * nproc_per_node + local_rank
+    """
+    if 'RANK' in os.environ:
+        return int(os.environ['RANK']), int(os.environ['LOCAL_RANK']), int(os.environ['WORLD_SIZE']), \
+               int(os.environ.get('LOCAL_WORLD_SIZE', os.environ['WORLD_SIZE'])), 'env://'
+    nproc_per_node = config['nproc_per_node']
+    rank = config['node_rank'] * nproc_per_node + local_rank
+    return rank, local_rank, config['world_size'], nproc_per_node, config['dist_url']
+
+def train(config, local_rank=0):
 
     city = config['city']
 
@@ -60,209 +179,185 @@ def train(config):
     verbose = config['verbose']
     version = config['version']
     seed = config['random_seed']
+    utc_offset = config['utc_offset']
+    cache_dir = config['cache_dir']
+    cache_size_gb = config['cache_size_gb']
+    length_bucket = config['length_bucket']
+    bucket_size = config['bucket_size']
 
     mask_length = config['mask_length']
     mask_prob = config['mask_prob']
-
-    # 设置随机种子
-    setup_seed(seed)
+    mlm_num_sampled = config['mlm_num_sampled']
+    match_hard_k = config['match_hard_k']
+    queue_size = config['queue_size']
+    momentum = config['momentum']
+    precision = config['precision']
+    accum_steps = config['accum_steps']
+    grad_clip = config['grad_clip']
+    num_threads = config['num_threads']
+    rank, local_rank, world_size, nproc_per_node, init_method = dist_context(config, local_rank)
+    distributed = world_size > 1
+    is_main = rank == 0
+
+    # 分布式训练：每个进程一个 rank，gloo 后端在 CPU 上也可以使用；同一台机器上的进程平分 num_threads 个线程
+    torch.set_num_threads(max(1, num_threads // nproc_per_node))
+    if distributed:
+        dist.init_process_group(config['dist_backend'], init_method=init_method, world_size=world_size, rank=rank)
+    device = torch.device(config['device'])
+    if device.type == 'cuda':
+        if distributed:
+            # 每台机器上按 local rank 选择 GPU
+            device = torch.device('cuda', (device.index or 0) + local_rank)
+        if device.index is not None:
+            torch.cuda.set_device(device)
+
+    # 设置随机种子，DDP 会把 rank 0 的参数广播到其他 rank，不同 rank 的 mask 和 dropout 不同
+    setup_seed(seed + rank)
 
     # define model, parmeters and optimizer
     edge_index = np.load(adj_path)
     model = MVTraj(vocab_size, grid_vocab_size, route_max_len, road_feat_num, road_embed_size, gps_feat_num,
-                    gps_embed_size, route_embed_size, hidden_size, edge_index, drop_edge_rate, drop_route_rate, drop_road_rate, mode='x').cuda()
-    init_road_emb = torch.load('{}/init_w2v_road_emb.pt'.format(city), map_location='cuda:{}'.format(dev_id))
+                    gps_embed_size, route_embed_size, hidden_size, edge_index, drop_edge_rate, drop_route_rate, drop_road_rate, mode='x',
+                    mlm_num_sampled=mlm_num_sampled, queue_size=queue_size).to(device)
+    init_road_emb = torch.load('{}/init_w2v_road_emb.pt'.format(city), map_location=device)
     model.node_embedding.weight = torch.nn.Parameter(init_road_emb['init_road_embd'])
     model.node_embedding.requires_grad_(True)
-    print('load parameters in device {}'.format(model.node_embedding.weight.device)) # check process device
-
-    optimizer = AdamW(model.parameters(), lr=learning_rate, weight_decay=weight_decay)
+    print('rank {}: load parameters in device {}'.format(rank, model.node_embedding.weight.device)) # check process device
 
-    # exp information
+    # exp information，只有 rank 0 写日志和 checkpoint
     nowtime = datetime.now().strftime("%y%m%d%H%M%S")
     model_name = 'JTMR_{}_{}_{}_{}_{}'.format(city, version, num_epochs, num_samples, nowtime)
     model_path = os.path.join(save_path, 'JTMR_{}_{}'.format(city, nowtime), 'model')
     log_path = os.path.join(save_path, 'JTMR_{}_{}'.format(city, nowtime), 'log')
 
-    if not os.path.exists(model_path):
-        os.makedirs(model_path)
-    if not os.path.exists(log_path):
-        os.makedirs(log_path)
-
-    checkpoints = [f for f in os.listdir(model_path) if f.startswith(model_name)]
-    writer = SummaryWriter(log_path)
+    writer = None
+    if is_main:
+        if not os.path.exists(model_path):
+            os.makedirs(model_path)
+        if not os.path.exists(log_path):
+            os.makedirs(log_path)
+        writer = SummaryWriter(log_path)
     # if not retrain and checkpoints:
     if not retrain :
         checkpoint_path = '/research/exp/JTMR_xian_240818201031/model/JTMR_xian_v1_50_98900_240818201031_49.pt'
-        model = torch.load(checkpoint_path, map_location="cuda:{}".format(dev_id))['model']
+        model = torch.load(checkpoint_path, map_location=device)['model']
     else:
         model.apply(weight_init)
 
-    train_loader = get_train_loader(data_path, batch_size, num_worker, route_min_len, route_max_len, gps_min_len, gps_max_len, grid_min_len, grid_max_len, num_samples, seed)
-    print('dataset is ready.')
+    # 负样本队列在各 rank 上由相同的 (all_gather 后的) 表示更新，不需要广播 buffer；
+    # grid_embedding 等参数不参与计算 (find_unused_parameters)
+    loss_module = PretrainModule(model, match_hard_k, queue_size > 0)
+    if distributed:
+        loss_module = DDP(loss_module, device_ids=[device.index] if device.type == 'cuda' else None,
+                          broadcast_buffers=False, find_unused_parameters=True)
+    optimizer = AdamW(model.parameters(), lr=learning_rate, weight_decay=weight_decay)
 
-    epoch_step = train_loader.dataset.route_data.shape[0] // batch_size
+    # 每台机器上由 local rank 0 先预处理并写入缓存，其他 rank 在 barrier 之后直接从缓存加载，避免同时构建和写入同一个 entry
+    if distributed and local_rank != 0:
+        dist.barrier()
+    train_loader = get_train_loader(data_path, batch_size, num_worker, route_min_len, route_max_len, gps_min_len, gps_max_len, grid_min_len, grid_max_len, num_samples, seed, utc_offset,
+                                    cache_dir, cache_size_gb, length_bucket, bucket_size,
+                                    vocab_size, grid_vocab_size, mask_length, mask_prob, pin_memory=device.type == 'cuda',
+                                    num_replicas=world_size, rank=rank)
+    if distributed and local_rank == 0:
+        dist.barrier()
+    if is_main:
+        print('dataset is ready.')
+
+    epoch_step = len(train_loader)
     total_steps = epoch_step * num_epochs
     scheduler = get_linear_schedule_with_warmup(optimizer, num_warmup_steps=warmup_step, num_training_steps=total_steps)
 
+    # matching loss 的负样本队列由 momentum encoder（参数为 model 的滑动平均）的表示填充，momentum 为 0 时直接写入当前 batch 的表示
+    # 在 DDP 广播参数之后复制，各 rank 的 momentum encoder 相同
+    momentum_model = None
+    if queue_size > 0 and momentum > 0:
+        momentum_model = copy.deepcopy(model)
+        momentum_model.requires_grad_(False)
+
+    # 混合精度：fp16 需要 loss scaling，bf16 / fp32 时 scaler 不起作用
+    scaler = make_grad_scaler(device, precision)
+
     for epoch in range(num_epochs):
         model.train()
-        for idx, batch in enumerate(train_loader):
-            gps_data, gps_assign_mat, route_data, route_assign_mat, \
-            gps_data_grid, gps_assign_mat_grid, grid_data, grid_assign_mat, \
-            gps_length, gps_length_grid = batch
-
-            masked_route_assign_mat, masked_gps_assign_mat = random_mask(gps_assign_mat, route_assign_mat, gps_length,
-                                                                        vocab_size, mask_length, mask_prob)
-            masked_grid_assign_mat, masked_gps_assign_mat_grid = random_mask(gps_assign_mat_grid, grid_assign_mat, gps_length_grid,
-                                                                        grid_vocab_size, mask_length, mask_prob)
-
-            route_data, masked_route_assign_mat, gps_data, masked_gps_assign_mat, route_assign_mat, gps_length =\
-                route_data.cuda(), masked_route_assign_mat.cuda(), gps_data.cuda(), masked_gps_assign_mat.cuda(), route_assign_mat.cuda(), gps_length.cuda()
-            grid_data, masked_grid_assign_mat, gps_data_grid, masked_gps_assign_mat_grid, grid_assign_mat, gps_length_grid = \
-                grid_data.cuda(), masked_grid_assign_mat.cuda(), gps_data_grid.cuda(), masked_gps_assign_mat_grid.cuda(), grid_assign_mat.cuda(), gps_length_grid.cuda()
-
-
-            # route-gps 4个 、、grid-gps 4个 、、 过joint后的 head表示，  MLM表示
-            gps_road_rep, gps_traj_rep, route_road_rep, route_traj_rep, \
-            gps_grid_rep, gps_traj_grid_rep, grid_road_rep, grid_traj_rep, \
-            gps_traj_joint_rep, route_traj_joint_rep, gps_traj_grid_joint_rep, grid_traj_joint_rep, \
-            gps_road_joint_rep, route_road_joint_rep, gps_grid_joint_rep, grid_road_joint_rep \
-                = model(route_data, masked_route_assign_mat, gps_data, masked_gps_assign_mat, route_assign_mat, gps_length, \
-                        grid_data, masked_grid_assign_mat, gps_data_grid, masked_gps_assign_mat_grid, grid_assign_mat, gps_length_grid)
-
-            # flatten road_rep
-            mat2flatten = {}
-            y_label = []
-            route_length = (route_assign_mat != model.vocab_size).int().sum(1)
-            gps_road_list, route_road_list, gps_road_joint_list, route_road_joint_list = [], [], [], []
-            now_flatten_idx = 0
-            for i, length in enumerate(route_length):
-                y_label.append(route_assign_mat[i, :length]) # route 和 gps mask 位置是一样的
-                gps_road_list.append(gps_road_rep[i, :length])
-                route_road_list.append(route_road_rep[i, :length])
-                gps_road_joint_list.append(gps_road_joint_rep[i, :length])
-                route_road_joint_list.append(route_road_joint_rep[i, :length])
-                for l in range(length):
-                    mat2flatten[(i, l)] = now_flatten_idx
-                    now_flatten_idx += 1
-
-            y_label = torch.cat(y_label, dim=0)
-            gps_road_rep = torch.cat(gps_road_list, dim=0)
-            route_road_rep = torch.cat(route_road_list, dim=0)
-            gps_road_joint_rep = torch.cat(gps_road_joint_list, dim=0)
-            route_road_joint_rep = torch.cat(route_road_joint_list, dim=0)
-
-            # flatten grid_rep
-            mat2flatten_grid = {}
-            y_label_grid = []
-            grid_length = (grid_assign_mat != model.grid_vocab_size).int().sum(1)
-            gps_grid_list, grid_road_list, gps_grid_joint_list, grid_road_joint_list = [], [], [], []
-            now_flatten_idx_grid = 0
-            for i, length in enumerate(grid_length):
-                y_label_grid.append(grid_assign_mat[i, :length]) # grid 和 gps mask 位置是一样的
-                gps_grid_list.append(gps_grid_rep[i, :length])
-                grid_road_list.append(grid_road_rep[i, :length])
-                gps_grid_joint_list.append(gps_grid_joint_rep[i, :length])
-                grid_road_joint_list.append(grid_road_joint_rep[i, :length])
-                for l in range(length):
-                    mat2flatten_grid[(i, l)] = now_flatten_idx_grid
-                    now_flatten_idx_grid += 1
-
-            y_label_grid = torch.cat(y_label_grid, dim=0)
-            gps_grid_rep = torch.cat(gps_grid_list, dim=0)
-            grid_road_rep = torch.cat(grid_road_list, dim=0)
-            gps_grid_joint_rep = torch.cat(gps_grid_joint_list, dim=0)
-            grid_road_joint_rep = torch.cat(grid_road_joint_list, dim=0)
-
-            # project rep into the same space
-            gps_traj_rep = model.gps_proj_head(gps_traj_rep)
-            route_traj_rep = model.route_proj_head(route_traj_rep)
-
-            # project rep into the same space
-            gps_traj_grid_rep = model.gps_proj_grid_head(gps_traj_grid_rep)
-            grid_traj_rep = model.grid_proj_head(grid_traj_rep)
-
-            # (GRM LOSS) get gps & route rep matching loss
-            tau = 0.07
-            match_loss = get_traj_match_loss(gps_traj_rep, route_traj_rep, model, batch_size, tau)
-            # (GRM LOSS) get gps & grid rep matching loss
-            tau2 = 0.07
-            match_loss2 = get_traj_match_loss(gps_traj_grid_rep, grid_traj_rep, model, batch_size, tau2)
-            # (GRM LOSS) get gps1 & gps2 rep matching loss
-            tau3 = 0.07
-            match_loss3 = get_traj_match_loss(gps_traj_rep, gps_traj_grid_rep, model, batch_size, tau3)
-
-            
-
-            # prepare label and mask_pos
-            masked_pos = torch.nonzero(route_assign_mat != masked_route_assign_mat)
-            masked_pos = [mat2flatten[tuple(pos.tolist())] for pos in masked_pos]
-            y_label = y_label[masked_pos].long()
-
-            # (MLM 1 LOSS) get gps rep road loss
-            gps_mlm_pred = model.gps_mlm_head(gps_road_joint_rep) # project head 也会被更新
-            masked_gps_mlm_pred = gps_mlm_pred[masked_pos]
-            gps_mlm_loss = nn.CrossEntropyLoss()(masked_gps_mlm_pred, y_label)
-
-            # (MLM 2 LOSS) get route rep road loss
-            route_mlm_pred = model.route_mlm_head(route_road_joint_rep) # project head 也会被更新
-            masked_route_mlm_pred = route_mlm_pred[masked_pos]
-            route_mlm_loss = nn.CrossEntropyLoss()(masked_route_mlm_pred, y_label)
-
-            # prepare label and mask_pos
-            masked_pos_grid = torch.nonzero(grid_assign_mat != masked_grid_assign_mat)
-            masked_pos_grid = [mat2flatten_grid[tuple(pos.tolist())] for pos in masked_pos_grid]
-            y_label_grid = y_label_grid[masked_pos_grid].long()
-
-            # (MLM 3 LOSS) get gps2 rep road loss
-            gps_grid_mlm_pred = model.gps_grid_mlm_head(gps_grid_joint_rep) # project head 也会被更新
-            masked_gps_grid_mlm_pred = gps_grid_mlm_pred[masked_pos_grid]
-            gps_grid_mlm_loss = nn.CrossEntropyLoss()(masked_gps_grid_mlm_pred, y_label_grid)
-
-            # (MLM 4 LOSS) get grid rep road loss
-            grid_mlm_pred = model.grid_mlm_head(grid_road_joint_rep) # project head 也会被更新
-            masked_grid_mlm_pred = grid_mlm_pred[masked_pos_grid]
-            grid_mlm_loss = nn.CrossEntropyLoss()(masked_grid_mlm_pred, y_label_grid)
-
-
-
-
-            # MLM 1 LOSS + MLM 2 LOSS + GRM LOSS
-            loss = (2*route_mlm_loss + 2*gps_mlm_loss + 1*match_loss + \
-                    2*grid_mlm_loss + 2*gps_grid_mlm_loss + 1*match_loss2 + 1*match_loss3) / 7
-            
+        optimizer.zero_grad()
+        reset_peak_memory(device)
+        sampler = train_loader.batch_sampler if length_bucket else train_loader.sampler
+        if hasattr(sampler, 'set_epoch'):
+            sampler.set_epoch(epoch)
+        epoch_st, traj_num = time.time(), 0
+        # mask 在 DataLoader 的 worker 中完成，下一个 batch 的 H2D 拷贝与当前 batch 的计算重叠
+        for idx, batch in enumerate(DevicePrefetcher(train_loader, device)):
+            # 梯度累积：每 accum_steps 个 batch 更新一次，有效 batch size 为 batch_size * accum_steps * world_size
+            # 不更新参数的 batch 不需要在 rank 间同步梯度
+            update = not (idx + 1) % accum_steps or idx + 1 == epoch_step
+            with (loss_module.no_sync() if distributed and not update else contextlib.nullcontext()):
+                with autocast(device, precision):
+                    loss, losses, traj_reps = loss_module(batch)
+                scaler.scale(loss / accum_steps).backward()
+            if update:
+                optimizer_step(model, optimizer, scaler, grad_clip)
+                if momentum_model is not None:
+                    momentum_model.momentum_update(model, momentum)
+
+            # 各项 loss 在所有 rank 上取平均后由 rank 0 记录
             step = epoch_step*epoch + idx
-            writer.add_scalar('match_loss/match_loss', match_loss, step)
-            writer.add_scalar('mlm_loss/gps_mlm_loss', gps_mlm_loss, step)
-            writer.add_scalar('mlm_loss/route_mlm_loss', route_mlm_loss, step)
-            writer.add_scalar('match_loss/match_loss2', match_loss2, step)
-            writer.add_scalar('mlm_loss/gps_grid_mlm_loss', gps_grid_mlm_loss, step)
-            writer.add_scalar('mlm_loss/grid_mlm_loss', grid_mlm_loss, step)
-            writer.add_scalar('match_loss/match_loss3', match_loss3, step)
-
-            writer.add_scalar('loss', loss, step)
-
-            optimizer.zero_grad()
-            loss.backward()
-            optimizer.step()
-
-            if not (idx + 1) % verbose:
+            loss_values = torch.stack([loss.detach().float()] + [value.detach().float() for value in losses.values()])
+            if distributed:
+                dist.all_reduce(loss_values)
+                loss_values /= world_size
+            loss_values = loss_values.tolist()
+            if is_main:
+                for tag, value in zip(losses.keys(), loss_values[1:]):
+                    writer.add_scalar(tag, value, step)
+                writer.add_scalar('loss', loss_values[0], step)
+
+            # 更新负样本队列
+            if queue_size > 0:
+                if momentum_model is not None:
+                    with torch.no_grad(), autocast(device, precision):
+                        outputs_m = momentum_model(*batch)
+                        traj_reps = [gather_traj_rep(rep)[1] for rep in
+                                     momentum_model.project_traj(outputs_m[1], outputs_m[3], outputs_m[5], outputs_m[7])]
+                model.enqueue(*traj_reps)
+            traj_num += batch.route_data.shape[0] * world_size
+
+            if is_main and not (idx + 1) % verbose:
                 t = datetime.now().strftime('%m-%d %H:%M:%S')
-                print(f'{t} | (Train) | Epoch={epoch}\tbatch_id={idx + 1}\tloss={loss.item():.4f}')
+                print(f'{t} | (Train) | Epoch={epoch}\tbatch_id={idx + 1}\tloss={loss_values[0]:.4f}')
 
         scheduler.step()
 
-        torch.save({
-            'epoch': epoch,
-            'model': model,
-            'optimizer_state_dict': optimizer.state_dict()
-        }, os.path.join(model_path, "_".join([model_name, f'{epoch}.pt'])))
-
+        if is_main:
+            # 吞吐 (所有 rank 合计) 和 rank 0 的显存峰值，与 precision=fp32 的结果对比（也可以用 benchmark/precision.py）
+            throughput = traj_num / (time.time() - epoch_st)
+            max_memory = peak_memory_mb(device)
+            writer.add_scalar('perf/traj_per_sec', throughput, epoch)
+            writer.add_scalar('perf/max_memory_mb', max_memory, epoch)
+            print(f'Epoch={epoch} | precision={precision} | world_size={world_size} | {throughput:.1f} traj/s | max memory {max_memory:.0f} MB')
+
+            torch.save({
+                'epoch': epoch,
+                'model': model,
+                'optimizer_state_dict': optimizer.state_dict(),
+                'scaler_state_dict': scaler.state_dict()
+            }, os.path.join(model_path, "_".join([model_name, f'{epoch}.pt'])))
+
+    if distributed:
+        dist.destroy_process_group()
     return model
 
+def train_worker(local_rank, config):
+    # torch.multiprocessing.spawn 的入口，第一个参数为本机上的 local rank
+    train(config, local_rank)
+
 if __name__ == '__main__':
     config = json.load(open('config/xian.json', 'r'))
-    train(config)
+    if 'RANK' not in os.environ and config['world_size'] > 1:
+        # 多机训练时在每台机器上运行一次，config 中设置各自的 node_rank，dist_url 为 node_rank=0 的机器地址
+        mp.spawn(train_worker, args=(config,), nprocs=config['nproc_per_node'])
+    else:
+        # 单进程，或由 torchrun 为每个 rank 启动一个进程
+        train(config)
 
 
@@ -58,7 +58,7 @@ def evaluation(seq_embedding, task_data, num_nodes, k=1, fold=5, acc_at = 1):
     train_loader = DataLoader(train_dataset, batch_size=128, shuffle=True)
     test_loader = DataLoader(test_dataset, batch_size=128, shuffle=False)
 
-    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    device = seq_embedding.device
     model = Seq2Seq(seq_embedding.shape[-1], 128, num_nodes, k).to(device)
     criterion = nn.CrossEntropyLoss()
     optimizer = optim.Adam(model.parameters(), lr=0.003)
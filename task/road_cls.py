@@ -43,7 +43,7 @@ def evaluation(model, feature_df, fold=100):
         x_train, x_eval = x[train_idx], x[eval_idx]
         y_train, y_eval = y[train_idx], y[eval_idx]
 
-        model = Classifier(x.shape[1], len(valid_labels)).cuda()
+        model = Classifier(x.shape[1], len(valid_labels)).to(x.device)
 
         if device_flag:
             print('device: ', next(model.parameters()).device)
@@ -54,7 +54,7 @@ def evaluation(model, feature_df, fold=100):
         best_acc = 0.
         for e in range(1, 101):
             model.train()
-            ce_loss = nn.CrossEntropyLoss()(model(x_train), y_train.cuda())
+            ce_loss = nn.CrossEntropyLoss()(model(x_train), y_train.to(x.device))
 
             opt.zero_grad()
             ce_loss.backward()
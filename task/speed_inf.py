@@ -34,7 +34,7 @@ def evaluation(model, feature_df, fold=5):
         y_train = qt.fit_transform(y_train.reshape(-1, 1))
         y_train = torch.tensor(y_train.flatten(), dtype=torch.float)
         # y_train, mean, std = label_norm(y_train)  # 01标准化
-        model = Regressor(x.shape[1]).cuda()
+        model = Regressor(x.shape[1]).to(x.device)
 
         if device_flag:
             print('device: ', next(model.parameters()).device)
@@ -46,7 +46,7 @@ def evaluation(model, feature_df, fold=5):
         for e in range(1, 101):
             model.train()
             opt.zero_grad()
-            loss = nn.MSELoss()(model(x_train), y_train.cuda())
+            loss = nn.MSELoss()(model(x_train), y_train.to(x.device))
             loss.backward()
             opt.step()
 
@@ -80,7 +80,7 @@ def evaluation(seq_embedding, task_data, num_nodes, fold=5):
         fold_trues.append(y_eval)
 
         y_train, mean, std = label_norm(y_train) # 标准化
-        model = MLPReg(x.shape[1], 3, nn.ReLU()).cuda()
+        model = MLPReg(x.shape[1], 3, nn.ReLU()).to(x.device)
 
         if device_flag:
             print('device: ', next(model.parameters()).device)
@@ -102,7 +102,7 @@ def evaluation(seq_embedding, task_data, num_nodes, fold=5):
                 opt.zero_grad()
                 x_batch = x_train[batch_index]
                 y_batch = y_train[batch_index]
-                loss = nn.MSELoss()(model(x_batch), y_batch.cuda())
+                loss = nn.MSELoss()(model(x_batch), y_batch.to(x.device))
                 loss.backward()
                 opt.step()
 
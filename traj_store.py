@@ -0,0 +1,214 @@
+#!/usr/bin/python
+# 轨迹数据的列式存储
+# 把 pickle 的 DataFrame（每个单元格是一个 python list）转换成 flat 数组 + offset 数组，
+# 每列单独存成 .npy，加载时用 mmap 打开，不需要一次性 unpickle 整个数据集
+#
+# Usage:
+#     python traj_store.py xian_train.pkl xian_train_store
+#
+# data_path 指向转换后的目录时，get_train_loader / prepare_data 会直接读取列式存储
+import os
+import json
+import pickle
+import argparse
+
+import numpy as np
+import pandas as pd
+
+META_FILE = 'meta.json'
+STORE_VERSION = 1
+
+
+class RaggedColumn(object):
+    """
+    变长列：所有行的值拼接成一个 flat 数组，第 i 行为 values[offsets[i]:offsets[i+1]]
+
+    Args:
+        values: (total_len, ...) flat value array, can be a np.memmap
+        offsets: (num_rows + 1,) int64 row offsets, offsets[0] == 0
+    """
+    def __init__(self, values, offsets):
+        self.values = values
+        self.offsets = offsets
+
+    @classmethod
+    def from_lists(cls, lists):
+        lengths = np.fromiter((len(x) for x in lists), dtype=np.int64, count=len(lists))
+        offsets = np.zeros(len(lists) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        arrays = [np.asarray(x) for x in lists if len(x) > 0]
+        values = np.concatenate(arrays, axis=0) if arrays else np.zeros((0,), dtype=np.float64)
+        return cls(values, offsets)
+
+    @property
+    def lengths(self):
+        return np.diff(self.offsets)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, idx):
+        # 单行切片是 memmap 上的 view，不发生拷贝
+        return self.values[self.offsets[idx]:self.offsets[idx + 1]]
+
+    def __iter__(self):
+        for idx in range(len(self)):
+            yield self[idx]
+
+    def take(self, rows):
+        rows = np.asarray(rows, dtype=np.int64)
+        starts = self.offsets[rows]
+        lengths = self.offsets[rows + 1] - starts
+        offsets = np.zeros(len(rows) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        # 每个值在原 flat 数组中的位置 = 所在行的起点 + 行内偏移
+        index = np.repeat(starts - offsets[:-1], lengths) + np.arange(offsets[-1])
+        return RaggedColumn(np.asarray(self.values[index]), offsets)
+
+    def tolist(self):
+        return [self[idx].tolist() for idx in range(len(self))]
+
+
+class TrajFrame(object):
+    """
+    列式轨迹数据集，接口和 DataFrame 保持一致的部分：columns / shape / len / frame[col] / frame[[cols]]
+    列为 RaggedColumn（变长列）或 np.ndarray（定长列）
+    """
+    def __init__(self, columns):
+        self._columns = dict(columns)
+
+    @property
+    def columns(self):
+        return list(self._columns.keys())
+
+    @property
+    def shape(self):
+        return len(self), len(self._columns)
+
+    def __len__(self):
+        for col in self._columns.values():
+            return len(col)
+        return 0
+
+    def __contains__(self, name):
+        return name in self._columns
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            return self._columns[key]
+        return TrajFrame([(name, self._columns[name]) for name in key])
+
+    def take(self, rows):
+        rows = np.asarray(rows, dtype=np.int64)
+        columns = []
+        for name, col in self._columns.items():
+            if isinstance(col, RaggedColumn):
+                columns.append((name, col.take(rows)))
+            else:
+                columns.append((name, np.asarray(col[rows])))
+        return TrajFrame(columns)
+
+    def sample(self, n, random_state=None):
+        # 与 DataFrame.sample(n, random_state=random_state) 采样到的行一致
+        rows = np.random.RandomState(random_state).choice(len(self), size=n, replace=False)
+        return self.take(rows)
+
+    def to_pandas(self):
+        data = {}
+        for name, col in self._columns.items():
+            data[name] = col.tolist() if isinstance(col, RaggedColumn) else np.asarray(col)
+        return pd.DataFrame(data, columns=self.columns)
+
+
+def _is_ragged(series):
+    for value in series:
+        return isinstance(value, (list, tuple, np.ndarray))
+    return False
+
+
+def write_store(df, store_path):
+    if not os.path.exists(store_path):
+        os.makedirs(store_path)
+
+    meta = {'version': STORE_VERSION, 'num_rows': len(df), 'columns': {}}
+    for name in df.columns:
+        if _is_ragged(df[name]):
+            col = RaggedColumn.from_lists(df[name].tolist())
+            np.save(os.path.join(store_path, '{}.values.npy'.format(name)), col.values)
+            np.save(os.path.join(store_path, '{}.offsets.npy'.format(name)), col.offsets)
+            meta['columns'][name] = 'ragged'
+        else:
+            np.save(os.path.join(store_path, '{}.npy'.format(name)), np.asarray(df[name].tolist()))
+            meta['columns'][name] = 'scalar'
+
+    # meta 最后写入，作为转换完成的标志
+    with open(os.path.join(store_path, META_FILE), 'w') as f:
+        json.dump(meta, f)
+
+
+def is_store(path):
+    return os.path.isdir(path) and os.path.exists(os.path.join(path, META_FILE))
+
+
+def open_store(store_path):
+    with open(os.path.join(store_path, META_FILE), 'r') as f:
+        meta = json.load(f)
+    assert meta['version'] == STORE_VERSION, 'unsupported store version {}'.format(meta['version'])
+
+    columns = []
+    for name, kind in meta['columns'].items():
+        if kind == 'ragged':
+            values = np.load(os.path.join(store_path, '{}.values.npy'.format(name)), mmap_mode='r')
+            offsets = np.load(os.path.join(store_path, '{}.offsets.npy'.format(name)))
+            columns.append((name, RaggedColumn(values, offsets)))
+        else:
+            columns.append((name, np.load(os.path.join(store_path, '{}.npy'.format(name)), mmap_mode='r')))
+    return TrajFrame(columns)
+
+
+def load_trajectories(data_path):
+    # 兼容原始的 pickle 文件和转换后的列式存储
+    if is_store(data_path):
+        return open_store(data_path)
+    return pickle.load(open(data_path, 'rb'))
+
+
+def trajectory_lengths(dataset, name):
+    # 变长列返回每行长度，定长列直接返回列的值
+    if isinstance(dataset, TrajFrame):
+        col = dataset[name]
+        return col.lengths if isinstance(col, RaggedColumn) else np.asarray(col)
+    if _is_ragged(dataset[name]):
+        return dataset[name].map(len).values
+    return dataset[name].values
+
+
+def ragged_arrays(column):
+    # 变长列 -> (flat values, lengths)，DataFrame 的 list 列和 RaggedColumn 都适用
+    if not isinstance(column, RaggedColumn):
+        column = RaggedColumn.from_lists(column.tolist())
+    return np.asarray(column.values), column.lengths
+
+
+def column_max(dataset, name, rows):
+    # 变长列在给定行上的最大值，用于确定 padding id
+    if isinstance(dataset, TrajFrame):
+        return dataset[name].take(rows).values.max()
+    return max(max(row) for row in dataset[name].iloc[rows])
+
+
+def take_rows(dataset, rows):
+    # 按行号取子集，返回 DataFrame
+    if isinstance(dataset, TrajFrame):
+        return dataset.take(rows).to_pandas()
+    return dataset.iloc[rows].reset_index(drop=True)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='convert a pickled trajectory DataFrame into a memory-mapped columnar store')
+    parser.add_argument('pkl_path')
+    parser.add_argument('store_path')
+    args = parser.parse_args()
+
+    write_store(pickle.load(open(args.pkl_path, 'rb')), args.store_path)
+    print('store written to {}'.format(args.store_path))
@@ -4,6 +4,7 @@ import torch.nn as nn
 import torch.nn.init as init
 import numpy as np
 import random
+import hashlib
 
 def setup_seed(seed):
     torch.manual_seed(seed)
@@ -109,4 +110,69 @@ class Logger(object):
         self.log.write(message)
 
     def flush(self):
-        pass
\ No newline at end of file
+        pass
+
+# mixed precision
+PRECISIONS = {'fp32': None, 'fp16': torch.float16, 'bf16': torch.bfloat16}
+
+def autocast(device, precision='fp32'):
+    """
+    precision 为 fp32 时关闭 autocast（在已开启 autocast 的区域内也可用来强制 fp32 计算）
+    torch>=1.10 使用 torch.autocast，支持 CPU bf16 和 CUDA fp16/bf16；更早的版本只有 torch.cuda.amp.autocast，只支持 CUDA fp16
+    """
+    device = torch.device(device)
+    dtype = PRECISIONS[precision]
+    if hasattr(torch, 'autocast'):
+        return torch.autocast(device.type, dtype=dtype, enabled=dtype is not None)
+    if dtype is not None and (device.type != 'cuda' or dtype != torch.float16):
+        raise ValueError('{} autocast on {} requires torch>=1.10'.format(precision, device.type))
+    return torch.cuda.amp.autocast(enabled=dtype is not None)
+
+def make_grad_scaler(device, precision='fp32'):
+    # 只有 fp16 需要 loss scaling，其余情况下 GradScaler 的 scale/unscale_/step 等价于直接调用
+    device = torch.device(device)
+    return torch.cuda.amp.GradScaler(enabled=precision == 'fp16' and device.type == 'cuda')
+
+
+# inference
+def inference_mode():
+    # torch>=1.9 的 inference_mode 不记录 autograd 信息（version counter、view 追踪），更早的版本退化为 no_grad
+    if hasattr(torch, 'inference_mode'):
+        return torch.inference_mode()
+    return torch.no_grad()
+
+
+# device
+def model_device(model):
+    return next(model.parameters()).device
+
+def model_fingerprint(model):
+    # state_dict 中所有参数和 buffer 的哈希，用于判断中断的计算是否来自同一个模型
+    sha1 = hashlib.sha1()
+    for name, tensor in model.state_dict().items():
+        sha1.update(name.encode('utf-8'))
+        sha1.update(tensor.detach().cpu().contiguous().numpy().tobytes())
+    return sha1.hexdigest()
+
+def tensor_fingerprint(*tensors):
+    # 若干 tensor 的形状和内容的哈希，用于判断中断的计算是否使用同一份数据
+    sha1 = hashlib.sha1()
+    for tensor in tensors:
+        sha1.update(str(tuple(tensor.shape)).encode('utf-8'))
+        sha1.update(tensor.detach().cpu().contiguous().numpy().tobytes())
+    return sha1.hexdigest()
+
+def synchronize(device):
+    if torch.device(device).type == 'cuda':
+        torch.cuda.synchronize(device)
+
+def reset_peak_memory(device):
+    if torch.device(device).type == 'cuda':
+        torch.cuda.reset_peak_memory_stats(device)
+
+def peak_memory_mb(device):
+    # GPU 上为 reset_peak_memory 之后的显存峰值；CPU 上为进程的峰值 RSS（无法重置）
+    if torch.device(device).type == 'cuda':
+        return torch.cuda.max_memory_allocated(device) / (1 << 20)
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (1 << 10)